@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+
+"""
+    benchmarks.hotpaths
+    ===================
+
+    Measure how deploying, waiting for, listing and running commands on
+    nodes scale with their number, without network access: the cloud and
+    the SSH servers are simulated, see `benchmarks.simulated`.
+
+    Each node count is measured in a fresh interpreter, so that its peak
+    memory usage can be reported.
+
+    Usage: python benchmarks/hotpaths.py [--nodes 1 10 100 1000]
+                                         [--output FILE] [...]
+
+    :copyright: (C) 2013 by Emanuele Rocca.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import resource
+import tempfile
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+NODES = ( 1, 10, 100, 1000 )
+
+def run(nodes, api_latency=0.05, boot_latency=1, ssh_latency=0.5,
+        poll_interval=0.5, parallel=50):
+    """Deploy `nodes` simulated nodes, list them and run a command on all of
+    them twice: first opening new SSH connections, then reusing them.
+
+    Return a dictionary of results for each phase."""
+    import logging
+    import paramiko
+
+    from nubo import cache
+    from nubo import remote
+    from nubo import history
+    from nubo.clouds import base
+    from benchmarks.simulated import SSHServer, SimulatedDriver
+    from benchmarks.simulated import SimulatedCloud
+
+    # SSH banner probes upset the simulated servers
+    logging.getLogger('paramiko').setLevel(logging.CRITICAL)
+
+    saved = (cache.CACHE_DIR, base.AVAILABLE_CLOUDS, history.HISTORYFILE,
+        remote.connections.port, remote.connections.max_size)
+
+    directory = tempfile.mkdtemp()
+    cache.CACHE_DIR = directory
+    base.AVAILABLE_CLOUDS = {}
+
+    # Simulated deployments do not belong to the history of the user
+    history.HISTORYFILE = os.path.join(directory, 'history')
+
+    privkey = os.path.join(directory, 'id_rsa')
+    key = paramiko.RSAKey.generate(1024)
+    key.write_private_key_file(privkey)
+    open(privkey + '.pub', 'w').write('ssh-rsa %s\n' % key.get_base64())
+
+    server = SSHServer()
+    remote.connections.port = server.port
+    remote.connections.max_size = max(nodes, remote.connections.max_size)
+
+    driver = SimulatedDriver(server, api_latency, boot_latency, ssh_latency)
+    cloud = SimulatedCloud(driver, privkey, poll_interval)
+
+    results = {}
+
+    def measure(phase, function):
+        driver.calls.clear()
+        server.stats.clear()
+
+        start = time.time()
+        outcomes = function()
+        wall = time.time() - start
+
+        calls = dict(driver.calls)
+        results[phase] = {
+            'wall_seconds': wall,
+            'api_calls': calls,
+            'api_calls_per_node': sum(calls.values()) / float(nodes),
+            'ssh_handshakes': server.stats['handshakes'],
+            'ssh_commands': server.stats['commands'],
+            'errors': len([ outcome for outcome in outcomes
+                if outcome.get('error') ]),
+        }
+
+        if server.stats['commands']:
+            results[phase]['handshakes_per_command'] = (
+                server.stats['handshakes'] /
+                float(server.stats['commands']))
+
+        return outcomes
+
+    try:
+        deployed = measure('deploy', lambda: cloud.deploy_many('1', nodes,
+            'bench-%d', parallel=parallel))
+
+        measure('list_nodes', lambda: [ dict(node.items())
+            for node in cloud.list_nodes() ])
+
+        group = cloud.remote_group([ result['node'] for result in deployed
+            if result['node'] ], parallel)
+
+        def execute():
+            return [ { 'error': result.error }
+                for result in group.run('uptime') ]
+
+        remote.connections.close()
+        measure('exec_cold', execute)
+        measure('exec_warm', execute)
+    finally:
+        remote.connections.close()
+        shutil.rmtree(directory)
+
+        (cache.CACHE_DIR, base.AVAILABLE_CLOUDS, history.HISTORYFILE,
+            remote.connections.port, remote.connections.max_size) = saved
+
+    results['peak_memory_kb'] = resource.getrusage(
+        resource.RUSAGE_SELF).ru_maxrss
+
+    return results
+
+def benchmark(nodes=NODES, python=sys.executable, **params):
+    """Run the benchmark for each number of nodes in a new interpreter."""
+    env = dict(os.environ)
+    env['PYTHONPATH'] = ROOT
+
+    results = {}
+    for count in nodes:
+        args = [ python, os.path.abspath(__file__), '--run', str(count) ]
+        for name, value in sorted(params.items()):
+            args += [ '--' + name.replace('_', '-'), str(value) ]
+
+        output = subprocess.Popen(args, stdout=subprocess.PIPE,
+            env=env).communicate()[0]
+        results[str(count)] = json.loads(output.splitlines()[-1])
+
+    return results
+
+def main():
+    arger = argparse.ArgumentParser(
+        description='Measure deploy, wait and exec against a simulated cloud')
+    arger.add_argument("--nodes", nargs='+', type=int, default=NODES)
+    arger.add_argument("--api-latency", default=0.05, type=float,
+        help='seconds taken by each API call')
+    arger.add_argument("--boot-latency", default=1, type=float,
+        help='seconds taken by nodes to be RUNNING')
+    arger.add_argument("--ssh-latency", default=0.5, type=float,
+        help='seconds taken by sshd to start on RUNNING nodes')
+    arger.add_argument("--poll-interval", default=0.5, type=float)
+    arger.add_argument("--parallel", default=50, type=int)
+    arger.add_argument("--output", default=None,
+        help='write results as JSON to this file')
+    arger.add_argument("--run", default=None, type=int,
+        help=argparse.SUPPRESS)
+    args = arger.parse_args()
+
+    params = dict(api_latency=args.api_latency,
+        boot_latency=args.boot_latency, ssh_latency=args.ssh_latency,
+        poll_interval=args.poll_interval, parallel=args.parallel)
+
+    if args.run is not None:
+        print json.dumps(run(args.run, **params))
+        return
+
+    results = benchmark(args.nodes, **params)
+
+    for count in args.nodes:
+        result = results[str(count)]
+        print "%d nodes, peak memory %dKB" % (count, result['peak_memory_kb'])
+
+        for phase in 'deploy', 'list_nodes', 'exec_cold', 'exec_warm':
+            print "  %-12s %8.2fs %7.2f API calls/node %5d handshakes %d errors" \
+                % (phase, result[phase]['wall_seconds'],
+                result[phase]['api_calls_per_node'],
+                result[phase]['ssh_handshakes'], result[phase]['errors'])
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=4, sort_keys=True)
+
+if __name__ == "__main__":
+    main()
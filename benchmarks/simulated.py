@@ -0,0 +1,278 @@
+# -*- coding: utf-8 -*-
+
+"""
+    benchmarks.simulated
+    ====================
+
+    Offline stand-ins for a cloud provider and for the SSH servers running on
+    its nodes, with configurable latencies.
+
+    Each simulated node gets its own loopback address (127.1.x.y), on which
+    the SSH stand-in starts listening when the node is created. It refuses to
+    talk until the node has booted and sshd had time to start.
+
+    :copyright: (C) 2013 by Emanuele Rocca.
+"""
+
+import time
+import errno
+import select
+import socket
+import threading
+
+from collections import Counter, OrderedDict
+
+import paramiko
+
+from libcloud.compute.base import Node, NodeSize, NodeImage, NodeLocation
+from libcloud.compute.types import NodeState
+
+from nubo.clouds.base import BaseCloud
+from nubo.poller import NodePoller
+
+# Seconds taken by each command on the simulated nodes
+EXEC_DELAY = 0.05
+
+class SSHServer(object):
+    """Accept SSH connections with any public key on any number of loopback
+    addresses, all using the same port. `whoami` prints the user name,
+    other commands are echoed back without being executed.
+
+    eg: SSHServer().add_host('127.1.0.1', time.time())
+    """
+
+    def __init__(self, host_key=None):
+        self.host_key = host_key or paramiko.RSAKey.generate(1024)
+
+        self.lock = threading.Lock()
+        self.stats = Counter()
+
+        # listening socket fd -> (socket, address)
+        self.listeners = {}
+
+        # address -> time at which sshd is up
+        self.ready_at = {}
+
+        self.poller = select.poll()
+        self.port = None
+        self.add_host('127.0.0.1', 0)
+
+        thread = threading.Thread(target=self.__serve)
+        thread.daemon = True
+        thread.start()
+
+    def count(self, what):
+        with self.lock:
+            self.stats[what] += 1
+
+    def add_host(self, address, ready_at):
+        """Start listening on `address`. Connections accepted before
+        `ready_at` are closed right away."""
+        sock = socket.socket()
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((address, self.port or 0))
+        sock.listen(128)
+
+        with self.lock:
+            if self.port is None:
+                self.port = sock.getsockname()[1]
+
+            self.ready_at[address] = ready_at
+            self.listeners[sock.fileno()] = (sock, address)
+
+        self.poller.register(sock.fileno(), select.POLLIN)
+
+    def __serve(self):
+        while True:
+            # Wake up now and then to notice new listeners
+            for fd, _ in self.poller.poll(100):
+                with self.lock:
+                    sock, address = self.listeners[fd]
+
+                try:
+                    conn, _ = sock.accept()
+                except socket.error, e:
+                    if e.errno in (errno.EAGAIN, errno.EINTR):
+                        continue
+                    raise
+
+                if time.time() < self.ready_at[address]:
+                    self.count('refused')
+                    conn.close()
+                    continue
+
+                transport = paramiko.Transport(conn)
+                transport.add_server_key(self.host_key)
+                transport.start_server(threading.Event(), StubServer(self))
+
+    def execute(self, channel, user, command):
+        # paramiko acknowledges the exec request after we return from
+        # check_channel_exec_request: clients give up on channels closed
+        # before that.
+        time.sleep(EXEC_DELAY)
+
+        self.count('commands')
+
+        if command == 'whoami':
+            channel.sendall(user + '\n')
+        else:
+            channel.sendall(command + '\n')
+
+        channel.send_exit_status(0)
+        channel.close()
+
+class StubServer(paramiko.ServerInterface):
+
+    def __init__(self, server):
+        self.server = server
+        self.user = None
+
+    def get_allowed_auths(self, username):
+        return 'publickey'
+
+    def check_auth_publickey(self, username, key):
+        self.server.count('handshakes')
+        self.user = username
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        if kind == 'session':
+            return paramiko.OPEN_SUCCEEDED
+
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_exec_request(self, channel, command):
+        # Called by the transport thread, which must not block
+        thread = threading.Thread(target=self.server.execute,
+            args=(channel, self.user, command))
+        thread.daemon = True
+        thread.start()
+        return True
+
+class SimulatedDriver(object):
+    """Stand-in for a libcloud NodeDriver. Each API call takes
+    `api_latency` seconds. New nodes are RUNNING after `boot_latency`
+    seconds and accept SSH connections `ssh_latency` seconds later.
+
+    Unlike real drivers, it can be shared among threads.
+    """
+
+    name = 'Simulated'
+
+    def __init__(self, server, api_latency=0.05, boot_latency=1,
+                 ssh_latency=0.5):
+        self.server = server
+        self.api_latency = api_latency
+        self.boot_latency = boot_latency
+        self.ssh_latency = ssh_latency
+
+        self.lock = threading.Lock()
+        self.calls = Counter()
+
+        # node id -> [ name, address, time at which it is RUNNING ]
+        self.nodes = OrderedDict()
+        self.created = 0
+
+    def __call(self, method):
+        with self.lock:
+            self.calls[method] += 1
+
+        time.sleep(self.api_latency)
+
+    def __node(self, node_id):
+        name, address, running_at = self.nodes[node_id]
+
+        state = NodeState.PENDING
+        if time.time() >= running_at:
+            state = NodeState.RUNNING
+
+        return Node(node_id, name, state, [ address ], [], self)
+
+    def create_node(self, **kwargs):
+        self.__call('create_node')
+
+        with self.lock:
+            self.created += 1
+            node_id = str(self.created)
+
+            # 127.1.0.2, 127.1.0.3, ... 127.1.1.1, ...
+            address = '127.1.%d.%d' % (
+                self.created / 250, self.created % 250 + 1)
+
+            running_at = time.time() + self.boot_latency
+            self.nodes[node_id] = [ kwargs.get('name'), address, running_at ]
+
+        self.server.add_host(address, running_at + self.ssh_latency)
+
+        with self.lock:
+            return self.__node(node_id)
+
+    def list_nodes(self):
+        self.__call('list_nodes')
+
+        with self.lock:
+            return [ self.__node(node_id) for node_id in self.nodes ]
+
+    def reboot_node(self, node):
+        self.__call('reboot_node')
+        return True
+
+    def destroy_node(self, node):
+        self.__call('destroy_node')
+
+        with self.lock:
+            return self.nodes.pop(node.id, None) is not None
+
+    def list_sizes(self, location=None):
+        self.__call('list_sizes')
+        return [ NodeSize('small', 'Small', 512, 20, None, 0.01, self) ]
+
+    def list_locations(self):
+        self.__call('list_locations')
+        return [ NodeLocation('1', 'Nowhere', 'XX', self) ]
+
+    def list_images(self, location=None):
+        self.__call('list_images')
+        return [ NodeImage(str(idx), 'Simulated %d' % idx, self)
+            for idx in range(1, 101) ]
+
+class SimulatedCloud(BaseCloud):
+    """BaseCloud using a SimulatedDriver."""
+
+    PROVIDER_NAME = 'DUMMY'
+
+    def __init__(self, driver, ssh_private_key, poll_interval=1):
+        self.simulated_driver = driver
+
+        # Checks are scheduled around the simulated latencies
+        self.EXPECTED_BOOT_TIME = driver.boot_latency
+        self.EXPECTED_SSH_TIME = driver.ssh_latency
+        self.MAX_POLL_INTERVAL = poll_interval * 10
+
+        BaseCloud.__init__(self, ssh_private_key,
+            poll_interval=poll_interval)
+
+    def driver_params(self):
+        # No credentials: simulated clouds are not configured in ~/.nuborc
+        return {}
+
+    def new_driver(self):
+        return self.simulated_driver
+
+    def new_poller(self):
+        # Nodes of the simulated driver are not seen by other clouds
+        return NodePoller(self.list_nodes, self.POLL_INTERVAL)
+
+    def deploy(self, image_id, size_idx=0, location_idx=0, name='test'):
+        class Image:
+            id = image_id
+
+        prerequisites = self.prepare({
+            'size': lambda: self.get_size(size_idx),
+            'location': lambda: self.get_location(location_idx),
+        })
+
+        return self.startup({
+            'size': prerequisites['size'], 'image': Image, 'name': name,
+            'location': prerequisites['location']
+        })
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+
+"""
+    benchmarks.startup
+    ==================
+
+    Measure how long each `nubo` subcommand takes to start, and which modules
+    it imports. No cloud provider is contacted: commands needing one are run
+    without NUBO_CLOUD set, hence they stop right after importing what they
+    need.
+
+    Usage: python benchmarks/startup.py [--repeat N] [--output FILE]
+
+    :copyright: (C) 2013 by Emanuele Rocca.
+"""
+
+import os
+import sys
+import time
+import json
+import argparse
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPT = os.path.join(ROOT, 'scripts', 'nubo')
+
+# Modules which should only be imported by the subcommands needing them
+HEAVY_MODULES = ( 'libcloud', 'paramiko', 'readline', 'texttable' )
+
+COMMANDS = (
+    [],
+    [ 'clouds' ],
+    [ 'config' ],
+    [ 'list' ],
+    [ 'images' ],
+    [ 'sizes' ],
+    [ 'start', 'ami-27013f53' ],
+    [ 'reboot', 'i-bb6c3b88' ],
+    [ 'delete', 'i-bb6c3b88' ],
+    [ 'exec', 'uptime', 'i-bb6c3b88' ],
+    [ 'push', 'file', '/tmp/file', 'i-bb6c3b88' ],
+)
+
+# Run the nubo script in a fresh interpreter and report how long it took,
+# as well as the modules it imported
+WRAPPER = r'''
+import os, sys, time, json, imp
+
+start = time.time()
+sys.argv = sys.argv[1:]
+stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+try:
+    imp.load_source('nubo_cli', sys.argv[0]).main()
+except SystemExit:
+    pass
+sys.stdout = stdout
+
+print json.dumps({ 'seconds': time.time() - start,
+                   'modules': sorted(sys.modules) })
+'''
+
+def measure(args, python=sys.executable):
+    """Run `nubo args` once. Return a dictionary with the time spent in the
+    script, the wall time including interpreter startup and the number of
+    modules imported."""
+    env = dict(os.environ)
+    env.pop('NUBO_CLOUD', None)
+    env['PYTHONPATH'] = ROOT
+
+    with open(os.devnull, 'r+') as devnull:
+        start = time.time()
+        output = subprocess.Popen([ python, '-c', WRAPPER, SCRIPT ] + args,
+            stdin=devnull, stdout=subprocess.PIPE, stderr=devnull,
+            env=env).communicate()[0]
+        wall = time.time() - start
+
+    result = json.loads(output.splitlines()[-1])
+    modules = result.pop('modules')
+
+    result['wall_seconds'] = wall
+    result['modules'] = len(modules)
+    result['heavy_modules'] = [ name for name in HEAVY_MODULES
+        if name in modules ]
+
+    return result
+
+def benchmark(repeat=5):
+    """Measure each subcommand `repeat` times, keeping the fastest run."""
+    results = {}
+
+    for args in COMMANDS:
+        runs = [ measure(args) for _ in range(repeat) ]
+        name = ' '.join(args[:1]) or '(no arguments)'
+        results[name] = min(runs, key=lambda run: run['wall_seconds'])
+
+    return results
+
+def main():
+    arger = argparse.ArgumentParser(
+        description='Measure the startup time of nubo subcommands')
+    arger.add_argument("--repeat", default=5, type=int)
+    arger.add_argument("--output", default=None,
+        help='write results as JSON to this file')
+    args = arger.parse_args()
+
+    results = benchmark(args.repeat)
+
+    for name in sorted(results):
+        result = results[name]
+        print "%-16s %6.1fms %6.1fms %4d modules  %s" % (name,
+            result['wall_seconds'] * 1000, result['seconds'] * 1000,
+            result['modules'], ', '.join(result['heavy_modules']))
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=4, sort_keys=True)
+
+if __name__ == "__main__":
+    main()
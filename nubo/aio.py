@@ -0,0 +1,685 @@
+# -*- coding: utf-8 -*-
+
+"""
+    nubo.aio
+    ========
+
+    Non-blocking interface to clouds and remote hosts, for programs managing
+    many nodes at once, such as orchestration services.
+
+    Every operation returns a `Future` right away. Provider API calls and SSH
+    commands run on a bounded pool of threads. Waiting for nodes to be
+    RUNNING and for their SSH servers to come up does not hold any thread:
+    all waits are served by a single `Watcher` thread, sharing one API call
+    per cloud and per polling interval, and using non-blocking sockets to
+    look for SSH banners.
+
+    eg: AsyncCloud(get_cloud('DIGITAL_OCEAN')()).deploy('12573').result()
+
+    :copyright: (C) 2013 by Emanuele Rocca.
+"""
+
+import sys
+import time
+import heapq
+import Queue
+import socket
+import logging
+import threading
+
+from multiprocessing.pool import ThreadPool
+
+from nubo.poller import Backoff, TERMINAL_STATES
+from nubo.parallel import MAX_PARALLEL, FOREVER
+
+PENDING = 'PENDING'
+RUNNING = 'RUNNING'
+CANCELLED = 'CANCELLED'
+FINISHED = 'FINISHED'
+
+class CancelledError(Exception):
+    pass
+
+class TimeoutError(Exception):
+    pass
+
+class Future(object):
+    """The result of an operation which may not be completed yet.
+
+    Callers can block on `result`, or register callbacks with
+    `add_done_callback`. Pending operations can be cancelled.
+
+    eg: cloud.list_nodes().result(timeout=60) -> list
+    """
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.state = PENDING
+        self.value = None
+
+        # (exception, traceback)
+        self.error = None
+
+        self.callbacks = []
+
+    def done(self):
+        return self.state in (CANCELLED, FINISHED)
+
+    def cancelled(self):
+        return self.state == CANCELLED
+
+    def set_running(self):
+        """Mark the operation as started. Return False if it got cancelled
+        in the meantime, in which case it should not be started at all."""
+        with self.cond:
+            if self.state != PENDING:
+                return False
+
+            self.state = RUNNING
+            return True
+
+    def __finish(self, state, value=None, error=None):
+        """Complete the operation, unless it is already done or, when
+        cancelling, already running. Return False if it was."""
+        with self.cond:
+            if self.done() or (state == CANCELLED and self.state == RUNNING):
+                return False
+
+            self.state, self.value, self.error = state, value, error
+            self.cond.notify_all()
+
+            callbacks, self.callbacks = self.callbacks, []
+
+        for callback in callbacks:
+            self.__call(callback)
+
+        return True
+
+    def __call(self, callback):
+        try:
+            callback(self)
+        except Exception, e:
+            logging.exception("Future callback failed: %s" % e)
+
+    def cancel(self):
+        """Cancel the operation. Operations already running on the thread
+        pool cannot be cancelled, waits always can."""
+        return self.__finish(CANCELLED)
+
+    def set_result(self, value):
+        return self.__finish(FINISHED, value)
+
+    def set_exception(self, exception, traceback=None):
+        return self.__finish(FINISHED, error=(exception, traceback))
+
+    def add_done_callback(self, callback):
+        """Call `callback(future)` once the operation is completed, right
+        away if it already is. Callbacks run in the thread completing the
+        operation, hence they should not block."""
+        with self.cond:
+            if not self.done():
+                self.callbacks.append(callback)
+                return
+
+        self.__call(callback)
+
+    def __wait(self, timeout):
+        with self.cond:
+            if timeout is None:
+                while not self.done():
+                    self.cond.wait()
+            else:
+                deadline = time.time() + timeout
+                while not self.done():
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise TimeoutError("Operation still in progress")
+
+                    self.cond.wait(remaining)
+
+        if self.cancelled():
+            raise CancelledError("Operation cancelled")
+
+    def exception(self, timeout=None):
+        """Wait at most `timeout` seconds for the operation to complete and
+        return the exception it raised, if any."""
+        self.__wait(timeout)
+
+        if self.error is not None:
+            return self.error[0]
+
+    def result(self, timeout=None):
+        """Wait at most `timeout` seconds for the operation to complete and
+        return its result. Raise TimeoutError if it did not complete in time,
+        CancelledError if it got cancelled, or the exception raised by the
+        operation itself."""
+        self.__wait(timeout)
+
+        if self.error is not None:
+            exception, traceback = self.error
+            raise exception, None, traceback
+
+        return self.value
+
+def link(future, source):
+    """Complete `future` as soon as `source` is, with the same outcome.
+    Cancelling `future` cancels `source`."""
+    def copy_outcome(source):
+        if source.cancelled():
+            future.cancel()
+        elif source.error is not None:
+            future.set_exception(*source.error)
+        else:
+            future.set_result(source.value)
+
+    def cancel_source(future):
+        if future.cancelled():
+            source.cancel()
+
+    source.add_done_callback(copy_outcome)
+    future.add_done_callback(cancel_source)
+
+def then(future, function):
+    """Return a Future completed with `function(future.result())` once
+    `future` is completed successfully. If `function` returns another
+    Future, wait for it as well. Errors and cancellations propagate.
+
+    eg: then(cloud.list_nodes(), len).result() -> int
+    """
+    chained = Future()
+
+    def proceed(future):
+        if future.cancelled():
+            chained.cancel()
+            return
+
+        if future.error is not None:
+            chained.set_exception(*future.error)
+            return
+
+        if chained.done():
+            # Cancelled in the meantime
+            return
+
+        try:
+            value = function(future.value)
+        except Exception:
+            chained.set_exception(*sys.exc_info()[1:])
+            return
+
+        if isinstance(value, Future):
+            link(chained, value)
+        else:
+            chained.set_result(value)
+
+    def cancel_source(chained):
+        if chained.cancelled():
+            future.cancel()
+
+    future.add_done_callback(proceed)
+    chained.add_done_callback(cancel_source)
+    return chained
+
+def as_completed(futures, timeout=None):
+    """Yield the given futures as they complete, failing with TimeoutError
+    if they are not all completed within `timeout` seconds."""
+    completed = Queue.Queue()
+    futures = list(futures)
+
+    for future in futures:
+        future.add_done_callback(completed.put)
+
+    deadline = timeout is not None and time.time() + timeout or None
+
+    for _ in futures:
+        remaining = None
+        if deadline is not None:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise TimeoutError("Operations still in progress")
+
+        try:
+            # Queue.get() without timeout cannot be interrupted by signals
+            yield completed.get(timeout=remaining or FOREVER)
+        except Queue.Empty:
+            raise TimeoutError("Operations still in progress")
+
+class Executor(object):
+    """Run blocking calls on at most `max_workers` threads. Threads are
+    started by the first call, and run until `shutdown`.
+
+    eg: with Executor(2) as executor: executor.submit(len, 'abc')
+    """
+
+    def __init__(self, max_workers=MAX_PARALLEL):
+        self.max_workers = max_workers
+        self.pool = None
+        self.closed = False
+        self.lock = threading.Lock()
+
+    def submit(self, function, *args, **kwargs):
+        """Schedule `function(*args, **kwargs)` and return a Future."""
+        future = Future()
+
+        def run():
+            if not future.set_running():
+                return
+
+            try:
+                future.set_result(function(*args, **kwargs))
+            except Exception:
+                future.set_exception(*sys.exc_info()[1:])
+
+        with self.lock:
+            if self.closed:
+                raise RuntimeError("Cannot submit calls after shutdown")
+
+            if self.pool is None:
+                self.pool = ThreadPool(self.max_workers)
+
+            self.pool.apply_async(run)
+
+        return future
+
+    def shutdown(self, wait=True):
+        """Stop the threads once the calls already submitted are over. With
+        `wait`, wait for them to terminate."""
+        with self.lock:
+            self.closed = True
+            pool, self.pool = self.pool, None
+
+        if pool is not None:
+            pool.close()
+            if wait:
+                pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+
+class Watcher(object):
+    """Wait on behalf of any number of callers using a single thread, which
+    only runs while there is something to wait for.
+
+    Nodes are waited on with their cloud's NodePoller: each round makes at
+    most one `list_nodes` call per cloud, no matter how many nodes are being
+    waited on. SSH servers are probed with a single SSHProber per port.
+    """
+
+    def __init__(self, interval=1):
+        self.interval = interval
+
+        self.cond = threading.Condition()
+        self.thread = None
+
+        # poller -> list of [node_id, future, deadline, backoff, next check]
+        self.nodes = {}
+
+        # port -> { host: list of (future, deadline) }
+        self.banners = {}
+
+        # heap of (deadline, sequence number, future)
+        self.timers = []
+        self.sequence = 0
+
+    def __add(self, future):
+        """Make sure the watcher thread is running. Call holding self.cond"""
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.__run)
+            self.thread.daemon = True
+            self.thread.start()
+
+        self.cond.notify()
+        return future
+
+    def sleep(self, seconds):
+        """Return a Future completed after `seconds` seconds."""
+        with self.cond:
+            self.sequence += 1
+            future = Future()
+            heapq.heappush(self.timers,
+                (time.time() + seconds, self.sequence, future))
+            return self.__add(future)
+
+    def wait_for_node(self, poller, node_id, timeout, backoff=None):
+        """Return a Future completed with the node as a dictionary once it
+        is RUNNING, or with None if the node reached a terminal state or
+        after `timeout` seconds. Same as `NodePoller.wait`.
+
+        The poller is called when the `nubo.poller.Backoff` of any of its
+        waits says so, and at most once every `poller.gap()` seconds."""
+        with self.cond:
+            future = Future()
+            now = time.time()
+            self.nodes.setdefault(poller, []).append([ node_id, future,
+                now + timeout, backoff or Backoff(interval=poller.interval),
+                now ])
+            return self.__add(future)
+
+    def wait_for_banner(self, host, timeout, port=None):
+        """Return a Future completed with `host` as soon as its SSH server
+        sends its banner (on port 22 by default), failing with TimeoutError
+        after `timeout` seconds."""
+        from nubo.remote import SSH_PORT
+
+        port = port or SSH_PORT
+        with self.cond:
+            future = Future()
+            self.banners.setdefault(port, {}).setdefault(host, []).append(
+                (future, time.time() + timeout))
+            return self.__add(future)
+
+    def __prune(self):
+        """Forget about completed (eg: cancelled) waits. Call holding
+        self.cond"""
+        for poller, waits in self.nodes.items():
+            waits[:] = [ wait for wait in waits if not wait[1].done() ]
+            if not waits:
+                del self.nodes[poller]
+
+        for port, hosts in self.banners.items():
+            for host, waits in hosts.items():
+                waits[:] = [ wait for wait in waits if not wait[0].done() ]
+                if not waits:
+                    del hosts[host]
+
+            if not hosts:
+                del self.banners[port]
+
+    def __fire_timers(self):
+        while True:
+            with self.cond:
+                if not self.timers or self.timers[0][0] > time.time():
+                    return
+
+                _, _, future = heapq.heappop(self.timers)
+
+            future.set_result(None)
+
+    def __poll(self, poller, waits):
+        polled = False
+        if any(wait[4] <= time.time() for wait in waits) and poller.due():
+            try:
+                poller.poll()
+                polled = True
+            except Exception, e:
+                logging.info("Cannot list nodes: %s" % e)
+
+        with poller.cond:
+            snapshot = poller.snapshot
+
+        now = time.time()
+        for wait in waits:
+            node_id, future, deadline, backoff, next_check = wait
+            node = polled and snapshot.get(node_id) or None
+
+            if node is not None and node['state'] == 'RUNNING':
+                future.set_result(dict(node.items()))
+            elif node is not None and node['state'] in TERMINAL_STATES:
+                logging.info("%s is %s, giving up" % (node_id, node['state']))
+                future.set_result(None)
+            elif now >= deadline:
+                future.set_result(None)
+            elif polled and next_check <= now:
+                wait[4] = now + backoff.delay()
+
+    def __probe(self, port, hosts, timeout):
+        from nubo.remote import SSHProber
+
+        ready = SSHProber(hosts.keys(), port).probe(timeout)
+        now = time.time()
+
+        for host, waits in hosts.items():
+            for future, deadline in waits:
+                if host in ready:
+                    future.set_result(host)
+                elif now >= deadline:
+                    future.set_exception(TimeoutError(
+                        "SSH not available on %s:%s" % (host, port)))
+
+    def __run(self):
+        next_round = time.time()
+
+        while True:
+            self.__fire_timers()
+
+            with self.cond:
+                self.__prune()
+
+                if not (self.nodes or self.banners or self.timers):
+                    self.thread = None
+                    return
+
+                nodes = [ (poller, list(waits))
+                    for poller, waits in self.nodes.items() ]
+                banners = [ (port, dict((host, list(waits))
+                    for host, waits in hosts.items()))
+                    for port, hosts in self.banners.items() ]
+
+                wakeups = []
+                if nodes or banners:
+                    wakeups.append(next_round)
+                if self.timers:
+                    wakeups.append(self.timers[0][0])
+
+                delay = min(wakeups) - time.time()
+                if delay > 0:
+                    self.cond.wait(delay)
+                    continue
+
+                if not (nodes or banners):
+                    # Only a timer is due
+                    continue
+
+            next_round = time.time() + self.interval
+
+            for poller, waits in nodes:
+                self.__poll(poller, waits)
+
+            for port, hosts in banners:
+                self.__probe(port, hosts,
+                    max(next_round - time.time(), 0.01))
+
+# Shared by all the AsyncCloud and AsyncRemoteHost objects by default
+shared_watcher = Watcher()
+
+class AsyncRemoteHost(object):
+    """Non-blocking version of RemoteHost.
+
+    eg: AsyncRemoteHost('198.199.72.211', key).run('uptime') -> Future
+    """
+
+    def __init__(self, host, private_key, executor=None, watcher=None):
+        from nubo.remote import RemoteHost
+
+        self.remotehost = RemoteHost(host, private_key)
+        self.host = host
+        self.owns_executor = executor is None
+        self.executor = executor or Executor()
+        self.watcher = watcher or shared_watcher
+
+    def close(self):
+        """Stop the threads of our executor, unless it was given to us."""
+        if self.owns_executor:
+            self.executor.shutdown()
+
+    def wait_for_banner(self, timeout):
+        return self.watcher.wait_for_banner(self.host, timeout,
+            self.remotehost.pool.port)
+
+    def run_command(self, command, user='root', timeout=None):
+        return self.executor.submit(self.remotehost.run_command, command,
+            user, timeout)
+
+    def run(self, command, user='root', timeout=None):
+        return self.executor.submit(self.remotehost.run, command, user,
+            timeout)
+
+    def put(self, localpath, remotepath, user='root', compress=False):
+        return self.executor.submit(self.remotehost.put, localpath,
+            remotepath, user, compress)
+
+    def get(self, remotepath, localpath, user='root'):
+        return self.executor.submit(self.remotehost.get, remotepath,
+            localpath, user)
+
+    def whoami(self, user='root'):
+        return self.executor.submit(self.remotehost.whoami, user)
+
+class AsyncCloud(object):
+    """Non-blocking version of a BaseCloud object.
+
+    Provider API calls go through an executor with `cloud.MAX_PARALLEL`
+    threads, unless another one is given. Deploying any number of nodes
+    only holds a thread while talking to the provider.
+
+    eg: AsyncCloud(cloud).deploy('ami-27013f53', name='web-1') -> Future
+    """
+
+    def __init__(self, cloud, executor=None, watcher=None):
+        self.cloud = cloud
+        self.owns_executor = executor is None
+        self.executor = executor or Executor(cloud.MAX_PARALLEL)
+        self.watcher = watcher or shared_watcher
+
+    def close(self):
+        """Stop the threads of our executor, unless it was given to us,
+        once the pending calls are over."""
+        if self.owns_executor:
+            self.executor.shutdown()
+
+    def list_nodes(self, fields=None):
+        return self.executor.submit(self.cloud.list_nodes, fields)
+
+    def find_nodes(self, targets=(), name_glob=None):
+        return self.executor.submit(self.cloud.find_nodes, targets,
+            name_glob)
+
+    def list_sizes(self, refresh=False):
+        return self.executor.submit(self.cloud.list_sizes, refresh)
+
+    def list_images(self, limit=None, keyword='', refresh=False):
+        return self.executor.submit(self.cloud.list_images, limit, keyword,
+            refresh)
+
+    def shutdown(self, node_id):
+        return self.executor.submit(self.cloud.shutdown, node_id)
+
+    def reboot(self, node_id):
+        return self.executor.submit(self.cloud.reboot, node_id)
+
+    def remote_host(self, node):
+        return AsyncRemoteHost(node['public_ips'][0],
+            self.cloud.ssh_private_key, self.executor, self.watcher)
+
+    def wait_for_node(self, node_id, timeout=None):
+        """Return a Future completed with the node as a dictionary once it
+        is RUNNING, or with None if it will never be or after `timeout`
+        seconds (default: `cloud.BOOT_TIMEOUT`)."""
+        if timeout is None:
+            timeout = self.cloud.BOOT_TIMEOUT
+
+        return self.watcher.wait_for_node(self.cloud.poller, node_id,
+            timeout, self.cloud.backoff(self.cloud.EXPECTED_BOOT_TIME))
+
+    def wait_for_ssh(self, node, timeout=None):
+        """Return a Future completed with the name of the user we can login
+        as once the node accepts SSH connections, failing with TimeoutError
+        after `timeout` seconds (default: `cloud.SSH_TIMEOUT`)."""
+        import paramiko
+
+        if timeout is None:
+            timeout = self.cloud.SSH_TIMEOUT
+
+        deadline = time.time() + timeout
+        backoff = self.cloud.backoff(self.cloud.EXPECTED_SSH_TIME)
+        remotehost = self.remote_host(node)
+        login_as = self.cloud.login_as
+
+        result = Future()
+
+        # The step in progress, cancelled along with the result
+        current = [ None ]
+
+        def attempt(_=None):
+            remaining = deadline - time.time()
+            if result.done():
+                return
+
+            if remaining <= 0:
+                result.set_exception(TimeoutError(
+                    "SSH not available on %s" % node['id']))
+                return
+
+            # Do not attempt to login until sshd is sending its banner
+            current[0] = then(remotehost.wait_for_banner(remaining),
+                lambda _: remotehost.whoami(login_as))
+            current[0].add_done_callback(done)
+
+        def cancel(result):
+            if result.cancelled() and current[0] is not None:
+                current[0].cancel()
+
+        def done(login):
+            if login.cancelled() or result.done():
+                return
+
+            try:
+                result.set_result(login.result())
+            except paramiko.PasswordRequiredException:
+                msg = 'Authentication failed for %s@%s. ' % (
+                    login_as, node['id'])
+                msg += 'Perhaps you should login as a different user?'
+                result.set_exception(Exception(msg))
+            except (socket.error, paramiko.SSHException):
+                # sshd might still be starting up or waiting for our key
+                logging.info("SSH not ready for user %s on %s" % (
+                    login_as, node['id']))
+                self.watcher.sleep(min(backoff.delay(),
+                    max(deadline - time.time(), 0))).add_done_callback(attempt)
+            except Exception:
+                result.set_exception(*sys.exc_info()[1:])
+
+        result.add_done_callback(cancel)
+        attempt()
+        return result
+
+    def __ready(self, node):
+        """Wait for a newly created node to be RUNNING and reachable."""
+        running = self.wait_for_node(node['id'])
+
+        def check(node):
+            if node is None:
+                raise Exception("Node did not reach the RUNNING state")
+
+            return then(self.wait_for_ssh(node), lambda user: node)
+
+        return then(running, check)
+
+    def startup(self, params):
+        """Start a new node. See `BaseCloud.startup`."""
+        def create():
+            with self.cloud.no_wait():
+                return self.cloud.startup(params)
+
+        return then(self.executor.submit(create), self.__ready)
+
+    def deploy(self, image_id, size_idx=0, location_idx=0, name='test'):
+        """Deploy a new node. See the `deploy` method of the cloud."""
+        def create():
+            with self.cloud.no_wait():
+                return self.cloud.deploy(image_id, size_idx, location_idx,
+                    name)
+
+        return then(self.executor.submit(create), self.__ready)
+
+    def deploy_many(self, image_id, count, name_template='node-%d',
+                    size_idx=0, location_idx=0):
+        """Deploy `count` nodes. Return a list of Futures."""
+        if '%' not in name_template:
+            name_template += '-%d'
+
+        return [ self.deploy(image_id, size_idx, location_idx,
+            name_template % (idx + 1)) for idx in range(count) ]
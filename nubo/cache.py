@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+
+"""
+    nubo.cache
+    ==========
+
+    On-disk cache for data which seldom changes, such as the list of images
+    available on a given cloud.
+
+    :copyright: (C) 2013 by Emanuele Rocca.
+"""
+
+import os
+import time
+import errno
+import zlib
+import logging
+import tempfile
+import threading
+import cPickle as pickle
+
+CACHE_DIR = os.path.join(
+    os.getenv('XDG_CACHE_HOME') or os.path.join(os.getenv('HOME'), '.cache'),
+    'nubo')
+
+# Cached data is considered fresh for one day
+DEFAULT_TTL = 24 * 60 * 60
+
+# Path of cached entries -> lock held while fetching them, see `fetching`
+FETCHING = {}
+FETCHING_LOCK = threading.Lock()
+
+def fetching(path):
+    """Return the lock serializing the fetches of the entries cached in
+    `path`, shared by all CatalogCache objects of this process."""
+    with FETCHING_LOCK:
+        return FETCHING.setdefault(path, threading.Lock())
+
+class CatalogCache(object):
+    """Cache lists of objects under CACHE_DIR/<provider_name>/<account>/, one
+    file per kind of object. Files contain zlib-compressed pickles. Accounts
+    (see `nubo.prerequisites.account`) do not necessarily see the same
+    objects, eg: private images.
+
+    Data older than `ttl` seconds is stale: it is still returned for up to
+    `max_stale` more seconds, while being refreshed in the background. Older
+    data is refreshed before being returned.
+
+    eg: CatalogCache('EC2_EU_WEST', account).get('images',
+            driver.list_images) -> list
+    """
+
+    def __init__(self, provider_name, account=None, ttl=DEFAULT_TTL,
+                 max_stale=None, directory=None):
+        self.directory = os.path.join(directory or CACHE_DIR, provider_name,
+            account or '')
+        self.ttl = ttl
+
+        if max_stale is None:
+            max_stale = ttl
+
+        self.max_stale = max_stale
+
+        self.lock = threading.Lock()
+        self.refreshing = set()
+
+    def path(self, kind):
+        return os.path.join(self.directory, kind)
+
+    def timestamp(self, kind):
+        """Return the time entries of the given kind were last stored, or
+        None if nothing is cached. Cheaper than loading them."""
+        try:
+            return os.path.getmtime(self.path(kind))
+        except OSError:
+            return
+
+    def load(self, kind):
+        """Return (timestamp, entries) or None if nothing is cached."""
+        try:
+            with open(self.path(kind), 'rb') as cachefile:
+                return pickle.loads(zlib.decompress(cachefile.read()))
+        except (IOError, EOFError, zlib.error, pickle.UnpicklingError), e:
+            logging.info("Cannot read cached %s: %s" % (kind, e))
+
+    def store(self, kind, entries):
+        """Atomically replace the cached entries of the given kind."""
+        try:
+            os.makedirs(self.directory, 0700)
+        except OSError, e:
+            # Possibly created by another thread in the meantime
+            if e.errno != errno.EEXIST:
+                raise
+
+        now = time.time()
+        data = zlib.compress(pickle.dumps((now, entries),
+            pickle.HIGHEST_PROTOCOL))
+
+        fd, tmppath = tempfile.mkstemp(dir=self.directory)
+        try:
+            os.write(fd, data)
+        finally:
+            os.close(fd)
+
+        # See `timestamp`. Modification times set by the kernel are not
+        # precise enough to tell apart entries stored in a quick succession.
+        os.utime(tmppath, (now, now))
+        os.rename(tmppath, self.path(kind))
+
+    def refresh(self, kind, fetch):
+        """Call `fetch` and cache the entries it returns."""
+        entries = fetch()
+        self.store(kind, entries)
+        return entries
+
+    def __refresh_in_background(self, kind, fetch):
+        with self.lock:
+            if kind in self.refreshing:
+                return
+
+            self.refreshing.add(kind)
+
+        def refresh():
+            try:
+                self.refresh(kind, fetch)
+            except Exception, e:
+                logging.info("Cannot refresh cached %s: %s" % (kind, e))
+            finally:
+                with self.lock:
+                    self.refreshing.discard(kind)
+
+        # Commands served from stale entries do not wait for the refresh
+        # to exit. Entries are replaced atomically, see `store`.
+        thread = threading.Thread(target=refresh, name='refresh-' + kind)
+        thread.daemon = True
+        thread.start()
+
+    def __usable(self, cached):
+        return (cached is not None and
+            time.time() - cached[0] <= self.ttl + self.max_stale)
+
+    def get(self, kind, fetch, refresh=False):
+        """Return the cached entries of the given kind, calling `fetch` to
+        get them if they are missing or too old. With `refresh`, ignore the
+        cache.
+
+        Threads needing missing entries at the same time (eg: concurrent
+        deployments) wait for a single call to `fetch`."""
+        if refresh:
+            return self.refresh(kind, fetch)
+
+        cached = self.load(kind)
+
+        if not self.__usable(cached):
+            with fetching(self.path(kind)):
+                # Possibly fetched by another thread in the meantime
+                cached = self.load(kind)
+                if not self.__usable(cached):
+                    return self.refresh(kind, fetch)
+
+        timestamp, entries = cached
+
+        if time.time() - timestamp > self.ttl:
+            self.__refresh_in_background(kind, fetch)
+
+        return entries
@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+
+"""
+    nubo.clouds
+    ===========
+
+    Supported cloud providers. Provider modules, and libcloud, are only
+    imported when needed: see `nubo.clouds.base.get_cloud`.
+
+    :copyright: (C) 2013 by Emanuele Rocca.
+"""
+
+CLOUDS_MAPPING = {
+    'EC2_US_EAST':        'nubo.clouds.ec2.AmazonEC2', 
+    'EC2_US_WEST':        'nubo.clouds.ec2.AmazonEC2', 
+    'EC2_US_WEST_OREGON': 'nubo.clouds.ec2.AmazonEC2', 
+    'EC2_AP_SOUTHEAST':   'nubo.clouds.ec2.AmazonEC2', 
+    'EC2_AP_SOUTHEAST2':  'nubo.clouds.ec2.AmazonEC2', 
+    'EC2_AP_NORTHEAST':   'nubo.clouds.ec2.AmazonEC2', 
+    'EC2_EU_WEST':        'nubo.clouds.ec2.AmazonEC2',
+    'RACKSPACE':          'nubo.clouds.rackspace.Rackspace',
+    'DIGITAL_OCEAN':      'nubo.clouds.digitalocean.DigitalOcean',
+    'LINODE':             'nubo.clouds.linode.Linode',
+    'OPENNEBULA':         'nubo.clouds.opennebula.OpenNebula',
+}
+
+def supported_clouds():
+    return CLOUDS_MAPPING.keys()
@@ -11,35 +11,38 @@
 
 import sys
 import time
+import Queue
 import socket
 import logging
+import copy
+import fnmatch
 import hashlib
+import threading
 
+from functools import wraps
 from importlib import import_module
+from contextlib import contextmanager
 
-from os import getenv, path
+from os import getenv, path, stat
 
 from libcloud.compute.types import Provider, InvalidCredsError
 from libcloud.compute.providers import get_driver
+from libcloud.compute.base import NodeImage
 
-import paramiko
-
+from nubo import cache
 from nubo.config import read_config
-from nubo.remote import RemoteHost
-
-CLOUDS_MAPPING = {
-    'EC2_US_EAST':        'nubo.clouds.ec2.AmazonEC2', 
-    'EC2_US_WEST':        'nubo.clouds.ec2.AmazonEC2', 
-    'EC2_US_WEST_OREGON': 'nubo.clouds.ec2.AmazonEC2', 
-    'EC2_AP_SOUTHEAST':   'nubo.clouds.ec2.AmazonEC2', 
-    'EC2_AP_SOUTHEAST2':  'nubo.clouds.ec2.AmazonEC2', 
-    'EC2_AP_NORTHEAST':   'nubo.clouds.ec2.AmazonEC2', 
-    'EC2_EU_WEST':        'nubo.clouds.ec2.AmazonEC2',
-    'RACKSPACE':          'nubo.clouds.rackspace.Rackspace',
-    'DIGITAL_OCEAN':      'nubo.clouds.digitalocean.DigitalOcean',
-    'LINODE':             'nubo.clouds.linode.Linode',
-    'OPENNEBULA':         'nubo.clouds.opennebula.OpenNebula',
-}
+from nubo.clouds import CLOUDS_MAPPING, supported_clouds
+from nubo.parallel import parallel_map, MAX_PARALLEL, FOREVER
+from nubo.aio import Executor
+from nubo.poller import NodePoller, Backoff
+from nubo.index import ImageIndex
+from nubo.events import Launch, untimed, monotonic
+from nubo.metrics import InstrumentedDriver
+from nubo.prerequisites import PrerequisiteCache, MissingPrerequisite
+from nubo.prerequisites import account, missing
+from nubo import drivers
+from nubo import poller
+from nubo import history
 
 NODE_STATES = {
     0: 'RUNNING',
@@ -49,39 +52,180 @@ NODE_STATES = {
     4: 'UNKNOWN'
 }
 
-AVAILABLE_CLOUDS = read_config()
+# Configuration overriding the one read by available_clouds(), eg: in tests
+AVAILABLE_CLOUDS = None
+
+# (class, cloud name) -> class of that cloud, see `get_cloud`
+cloud_classes = {}
+
+# Runs the prerequisites of all deployments, see `BaseCloud.prepare`. Its
+# threads are long-lived: their drivers keep their connections open.
+prerequisite_executor = Executor(MAX_PARALLEL)
 
 
 def resolvepath(s):
     return path.abspath(path.expanduser(s))
 
+# Public key file -> (file identity, MD5 sum of its contents)
+KEY_NAMES = {}
 
-def node2dict(node):
-    """Convert a node object into a dict"""
-    fields = ( 'id', 'name', 'state', 'public_ips', 
+def key_name(pubkey):
+    """Return the MD5 sum of the given public key file, used to name the
+    key on cloud providers. Computed again only if the file changed."""
+    identity = None
+    try:
+        info = stat(pubkey)
+        identity = (info.st_ino, info.st_mtime, info.st_size)
+    except OSError:
+        pass
+
+    cached = KEY_NAMES.get(pubkey)
+    if identity is not None and cached is not None and cached[0] == identity:
+        return cached[1]
+
+    key_hash = hashlib.md5()
+    key_hash.update(open(pubkey).read())
+
+    KEY_NAMES[pubkey] = (identity, key_hash.hexdigest())
+    return KEY_NAMES[pubkey][1]
+
+
+# Returned by NodeRecord for fields libcloud sets to None
+MISSING = object()
+
+class NodeRecord(object):
+    """Read-only, dictionary-like view of a libcloud node.
+
+    Fields are converted on first access only: listing thousands of nodes to
+    look at their 'id' and 'state' does not pay for the others. Fields set to
+    None by libcloud are missing, as in `node2dict`.
+
+    eg: NodeRecord(node)['public_ips'] -> ['54.247.8.150']
+    """
+    __slots__ = ( 'node', 'converted' )
+
+    FIELDS = ( 'id', 'name', 'state', 'public_ips', 
                'private_ips', 'image', 'size', 'extra' )
-    values = {}
-    for field in fields:
-        value = getattr(node, field)
-        if value is not None:
-            values[field] = value
 
-    values['state'] = NODE_STATES[values['state']]
+    def __init__(self, node):
+        self.node = node
+        self.converted = {}
 
-    for field in 'image', 'size':
-        if field in values and values[field]:
-            values[field] = values[field].name
+    def __convert(self, field):
+        value = getattr(self.node, field)
+        if value is None:
+            return MISSING
 
-    for field in 'public_ips', 'private_ips':
+        if field == 'state':
+            return NODE_STATES[value]
+
+        if field in ('image', 'size') and value:
+            return value.name
+
+        if field in ('public_ips', 'private_ips'):
+            try:
+                return [ ip_addr.address for ip_addr in value ]
+            except AttributeError:
+                pass
+
+        return value
+
+    def __getitem__(self, field):
         try:
-            values[field] = [ ip_addr.address for ip_addr in values[field] ]
-        except AttributeError:
-            pass
+            value = self.converted[field]
+        except KeyError:
+            if field not in self.FIELDS:
+                raise
+
+            value = self.converted[field] = self.__convert(field)
+
+        if value is MISSING:
+            raise KeyError(field)
+
+        return value
+
+    def get(self, field, default=None):
+        try:
+            return self[field]
+        except KeyError:
+            return default
+
+    def __contains__(self, field):
+        return self.get(field, MISSING) is not MISSING
+
+    def keys(self):
+        return [ field for field in self.FIELDS if field in self ]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def items(self):
+        return [ (field, self[field]) for field in self.keys() ]
 
-    return values
+    def values(self):
+        return [ self[field] for field in self.keys() ]
 
-def supported_clouds():
-    return CLOUDS_MAPPING.keys()
+    def project(self, fields):
+        """Return a dict with the given fields only."""
+        return dict((field, self[field]) for field in fields if field in self)
+
+    def __eq__(self, other):
+        return dict(self.items()) == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+def node2dict(node):
+    """Convert a node object into a dict"""
+    return dict(NodeRecord(node).items())
+
+def node_matches(node_id, name, targets=(), name_glob=None):
+    """Return True if the given node id or name is in `targets`, or if the
+    name matches the shell-style wildcard `name_glob`."""
+    if node_id in targets or name in targets:
+        return True
+
+    return name_glob is not None and fnmatch.fnmatchcase(name or '', 
+                                                         name_glob)
+
+def available_clouds(profile=None):
+    """Return the configuration stored in ~/.nuborc, or in the file of the
+    given or current profile. Changes to the file are seen by long-running
+    processes such as `nubo serve`. AVAILABLE_CLOUDS, if set, is returned
+    instead."""
+    if AVAILABLE_CLOUDS is not None:
+        return AVAILABLE_CLOUDS
+
+    return read_config(profile)
+
+def instrumented(deploy):
+    """Decorator for the `deploy` method of clouds, recording the timings
+    of each deployment. See `BaseCloud.launch`."""
+    @wraps(deploy)
+    def wrapper(self, image_id, size_idx=0, location_idx=0, name='test'):
+        with self.launch() as launch:
+            launch.name, launch.image = name, image_id
+            try:
+                return deploy(self, image_id, size_idx, location_idx, name)
+            except MissingPrerequisite, e:
+                # The missing prerequisite has been forgotten: try once
+                # more, finding or creating it again
+                logging.info("Deploying %s again: %s" % (name, e))
+                try:
+                    return deploy(self, image_id, size_idx, location_idx, 
+                        name)
+                except Exception, retry:
+                    logging.warning("Deploying %s again failed: %s" % (
+                        name, retry))
+                    raise e.error, None, e.traceback
+
+    return wrapper
 
 def get_cloud(cloud_name=None):
     """Return a class representing the given cloud provider.
@@ -110,14 +254,98 @@ def get_cloud(cloud_name=None):
     module = import_module(module_name)
 
     cloudclass = getattr(module, classname)
-    cloudclass.PROVIDER_NAME = cloud_name
+    if cloudclass.PROVIDER_NAME == cloud_name:
+        return cloudclass
+
+    # Classes are shared by multiple clouds (eg: all EC2 regions), possibly
+    # wanted by different threads at once: return a subclass for this one,
+    # the same one every time
+    key = (cloudclass, cloud_name)
+    if key not in cloud_classes:
+        cloud_classes.setdefault(key, type(classname, (cloudclass,), {
+            'PROVIDER_NAME': cloud_name,
+            '__module__': cloudclass.__module__ }))
+
+    return cloud_classes[key]
+
+def configured_clouds():
+    """Return the names of the clouds for which credentials are available,
+    sorted."""
+    return sorted(cloud_name for cloud_name, classpath 
+        in CLOUDS_MAPPING.items() if classpath in available_clouds())
+
+def list_all_nodes(cloud_names=None, timeout=60):
+    """List the nodes running on all configured clouds, or on the given
+    ones, querying all of them concurrently. Clouds which do not answer
+    within `timeout` seconds are not waited for.
+
+    Return a list of dictionaries, one per cloud, with the keys 'cloud',
+    'nodes' (a list of nodes, or None) and 'error' (the exception raised
+    while listing nodes, or None).
+
+    eg: list_all_nodes(['EC2_EU_WEST', 'DIGITAL_OCEAN']) -> list
+    """
+    if cloud_names is None:
+        cloud_names = configured_clouds()
+
+    results = Queue.Queue()
+
+    def list_nodes(cloud_name, cloud):
+        try:
+            results.put((cloud_name, cloud.list_nodes(), None))
+        except Exception, e:
+            results.put((cloud_name, None, e))
+
+    for cloud_name in cloud_names:
+        try:
+            # Instantiate clouds in this thread, whose profile they use (see
+            # `BaseCloud`)
+            cloud = get_cloud(cloud_name)()
+        except Exception, e:
+            results.put((cloud_name, None, e))
+            continue
+
+        thread = threading.Thread(target=list_nodes, args=(cloud_name, cloud))
+        # Do not wait for clouds timing out when exiting
+        thread.daemon = True
+        thread.start()
+
+    outcomes = {}
+    deadline = time.time() + timeout
+
+    while len(outcomes) < len(cloud_names):
+        try:
+            cloud_name, nodes, error = results.get(
+                timeout=max(0, deadline - time.time()))
+        except Queue.Empty:
+            break
+
+        outcomes[cloud_name] = { 'cloud': cloud_name, 'nodes': nodes, 
+                                 'error': error }
+
+    for cloud_name in cloud_names:
+        if cloud_name not in outcomes:
+            outcomes[cloud_name] = { 'cloud': cloud_name, 'nodes': None,
+                'error': Exception("Timed out after %s seconds" % timeout) }
 
-    return cloudclass
+    return [ outcomes[cloud_name] for cloud_name in cloud_names ]
 
 class BaseCloud(object):
 
-    # Wait a maximum of 5 minutes
-    MAX_ATTEMPTS = 5 * 60
+    # Seconds to wait for new nodes to be RUNNING, then to accept SSH
+    # connections
+    BOOT_TIMEOUT = 5 * 60
+    SSH_TIMEOUT = 5 * 60
+
+    # Seconds usually taken by new nodes to be RUNNING, then to accept SSH
+    # connections. Checks are frequent around these times, see
+    # `nubo.poller.Backoff`.
+    EXPECTED_BOOT_TIME = 20
+    EXPECTED_SSH_TIME = 10
+
+    # Minimum and maximum number of seconds between two consecutive checks
+    POLL_INTERVAL = 1
+    MAX_POLL_INTERVAL = 15
    
     # Has to be set by extending classes
     PROVIDER_NAME = None
@@ -125,74 +353,324 @@ class BaseCloud(object):
     # Can be extended
     NEEDED_PARAMS = [ 'key', 'secret' ]
 
+    # Maximum number of VMs deployed concurrently by deploy_many
+    MAX_PARALLEL = 10
+
     @classmethod
     def test_conn(cls, **params):
         provider = getattr(Provider, cls.PROVIDER_NAME)
         DriverClass = get_driver(provider)
-        driver = DriverClass(**params)
+
+        # Reused by clouds configured with these parameters
+        driver = InstrumentedDriver(drivers.registry.get(cls.PROVIDER_NAME,
+            params, lambda: DriverClass(**params)), cls.PROVIDER_NAME)
         try:
             return type(driver.list_nodes()) == list
         except InvalidCredsError:
             return False
 
-    def __init__(self, ssh_private_key=None, login_as='root'):
+    def __init__(self, ssh_private_key=None, login_as='root',
+                 boot_timeout=None, ssh_timeout=None, poll_interval=None):
+        """Timeouts and the poll interval default to the BOOT_TIMEOUT,
+        SSH_TIMEOUT and POLL_INTERVAL of the class.
+
+        The configuration profile and the history file are those of the
+        creating thread, see `nubo.daemon`."""
+        self.profile = getenv('NUBO_PROFILE') or ''
+        self.history_path = history.history_path()
+
         if ssh_private_key is None:
-            ssh_private_key = resolvepath(AVAILABLE_CLOUDS["nubo"]["privkey"])
+            ssh_private_key = resolvepath(
+                available_clouds(self.profile)["nubo"]["privkey"])
 
         self.ssh_private_key = ssh_private_key
         self.ssh_public_key = ssh_private_key + '.pub'
 
         # Use public key's MD5 sum as its name
-        key_hash = hashlib.md5()
-        key_hash.update(open(self.ssh_public_key).read())
-        self.ssh_key_name = key_hash.hexdigest()
+        self.ssh_key_name = key_name(self.ssh_public_key)
         
         self.login_as = login_as
 
+        if boot_timeout is not None:
+            self.BOOT_TIMEOUT = boot_timeout
+
+        if ssh_timeout is not None:
+            self.SSH_TIMEOUT = ssh_timeout
+
+        if poll_interval is not None:
+            self.POLL_INTERVAL = poll_interval
+            self.MAX_POLL_INTERVAL = max(self.MAX_POLL_INTERVAL, 
+                poll_interval)
+
+        # libcloud drivers cannot be shared among threads. Each thread using
+        # this object gets its own driver, see `self.driver`.
+        self.__local = threading.local()
+
+        # Instantiate the driver right away to fail early on unknown clouds
+        self.driver
+
+        # Shared by all the threads waiting for nodes to start
+        self.poller = self.new_poller()
+
+        # Images, sizes and locations seldom change
+        settings = available_clouds(self.profile).get('nubo', {})
+        self.cache = cache.CatalogCache(self.PROVIDER_NAME,
+            account(self.PROVIDER_NAME, self.driver_params()),
+            ttl=settings.get('cache_ttl', cache.DEFAULT_TTL))
+
+    @property
+    def driver(self):
+        """The libcloud driver used by the current thread. Calls to its
+        methods are recorded in `nubo.metrics.registry`."""
+        try:
+            return self.__local.driver
+        except AttributeError:
+            self.__local.driver = InstrumentedDriver(self.new_driver(),
+                self.PROVIDER_NAME)
+            return self.__local.driver
+
+    @property
+    def prerequisites(self):
+        """The `nubo.prerequisites.PrerequisiteCache` of this cloud account
+        and SSH key, eg: to remember the id of the uploaded key."""
+        try:
+            return self.__prerequisites
+        except AttributeError:
+            self.__prerequisites = PrerequisiteCache(self.PROVIDER_NAME,
+                account(self.PROVIDER_NAME, self.driver_params(),
+                    self.ssh_key_name))
+            return self.__prerequisites
+
+    def driver_params(self):
+        """Return the keyword arguments needed to instantiate the libcloud
+        driver of this cloud."""
+        return dict(available_clouds(self.profile)[
+            CLOUDS_MAPPING[self.PROVIDER_NAME]])
+
+    def new_driver(self):
+        """Return a libcloud driver for this cloud, to be used by the
+        current thread only. Drivers are shared with other cloud objects
+        using the same provider and credentials, see `nubo.drivers`."""
         try:
             provider = getattr(Provider, self.PROVIDER_NAME)
         except AttributeError:
             raise Exception, "Unknown cloud %s" % self.PROVIDER_NAME
 
         DriverClass = get_driver(provider)
-        self.driver = DriverClass(
-            **AVAILABLE_CLOUDS[CLOUDS_MAPPING[self.PROVIDER_NAME]])
-
-    def __wait_for_node(self, node_id):
-        attempts = self.MAX_ATTEMPTS
-
-        while attempts:
-            for node in self.list_nodes():
-                if node['id'] != node_id: 
-                    continue
-
-                if node['state'] == "RUNNING":
-                    return node
-                
-                logging.info("%s attempts left on %s: %s != RUNNING" % (
-                    attempts, node_id, node['state']))
-            
-            time.sleep(1)
-            attempts -= 1
-
-    def wait_for_ssh(self, node):
-        attempts = self.MAX_ATTEMPTS
-        remotehost = RemoteHost(node['public_ips'][0], self.ssh_private_key)
-
-        while attempts:
+        params = self.driver_params()
+
+        return drivers.registry.get(self.PROVIDER_NAME, params,
+            lambda: DriverClass(**params))
+
+    @contextmanager
+    def launch(self):
+        """Record the timings of the deployment performed by the current
+        thread within this block, unless they are already being recorded.
+        Yield a `nubo.events.Launch` object.
+
+        Timings are reported to the listeners registered with
+        `nubo.events.subscribe`, for all clouds or for this one, and
+        appended to the history of deployments, see `nubo.history`."""
+        current = getattr(self.__local, 'launch', None)
+        if current is not None:
+            yield current
+            return
+
+        launch = self.__local.launch = Launch(self.PROVIDER_NAME, self)
+        error = None
+        try:
+            yield launch
+        except Exception, e:
+            error = str(e) or e.__class__.__name__
+            raise
+        finally:
+            self.__local.launch = None
+            launch.finish(error)
+            history.record(launch.as_dict(), self.history_path)
+
+    def phase(self, name):
+        """Return a context manager timing the given phase of the current
+        deployment, if any.
+
+        eg: with self.phase('prerequisites'): size = self.get_size(0)
+        """
+        launch = getattr(self.__local, 'launch', None)
+        if launch is None:
+            return untimed()
+
+        return launch.phase(name)
+
+    def describe(self, params):
+        """Take note of the node being started by the current deployment,
+        if any, given the parameters of `driver.create_node`."""
+        launch = getattr(self.__local, 'launch', None)
+        if launch is not None:
+            launch.describe(params)
+
+    def count(self, what):
+        """Count something happening during the current deployment, if
+        any. eg: count('polls')"""
+        launch = getattr(self.__local, 'launch', None)
+        if launch is not None:
+            launch.count(what)
+
+    def prepare(self, prerequisites):
+        """Resolve the prerequisites of a deployment concurrently, and return
+        their values as a dictionary.
+
+        `prerequisites` maps names to functions, or to (function, names)
+        tuples: such functions are called once the prerequisites they depend
+        on are resolved, with their values as keyword arguments. The first
+        exception raised by any function is raised right away, without
+        waiting for the others.
+
+        eg: prepare({ 'size': lambda: self.get_size(0),
+                      'key_id': self.ssh_key_id }) -> dict
+        """
+        pending = {}
+        for name, prerequisite in prerequisites.items():
+            if not isinstance(prerequisite, tuple):
+                prerequisite = (prerequisite, ())
+
+            unknown = set(prerequisite[1]) - set(prerequisites)
+            if unknown:
+                raise ValueError("Unknown prerequisites of %s: %s" % (
+                    name, ', '.join(sorted(unknown))))
+
+            pending[name] = prerequisite
+
+        # Phases are recorded by the threads resolving prerequisites too
+        launch = getattr(self.__local, 'launch', None)
+
+        def resolve(function, values):
+            self.__local.launch = launch
             try:
-                return remotehost.whoami(self.login_as)
-            except socket.error:
-                logging.info("%s SSH attempts left for user %s on %s" 
-                    % (attempts, self.login_as, node['id']))
+                return function(**values)
+            finally:
+                self.__local.launch = None
+
+        values = {}
+        running = {}
+        completed = Queue.Queue()
+
+        with self.phase('prerequisites'):
+            try:
+                while pending or running:
+                    for name, (function, needed) in pending.items():
+                        if any(other not in values for other in needed):
+                            continue
+
+                        del pending[name]
+                        future = prerequisite_executor.submit(resolve, 
+                            function, dict((other, values[other])
+                                for other in needed))
+                        running[future] = name
+                        future.add_done_callback(completed.put)
+
+                    if not running:
+                        raise ValueError("Circular dependencies among "
+                            "prerequisites: %s" % ', '.join(sorted(pending)))
+
+                    # Queue.get() without timeout cannot be interrupted
+                    future = completed.get(timeout=FOREVER)
+                    values[running.pop(future)] = future.result()
+            except:
+                for future in running:
+                    future.cancel()
+                raise
+
+        return values
+
+    def backoff(self, expected):
+        """Return a `nubo.poller.Backoff` scheduling the checks of something
+        expected to be ready in `expected` seconds, using the poll intervals
+        of this cloud."""
+        return Backoff(expected, self.POLL_INTERVAL, self.MAX_POLL_INTERVAL)
+
+    def wait_for_node(self, node_id, timeout=None):
+        """Wait at most `timeout` seconds (default: BOOT_TIMEOUT) for the
+        given node to be RUNNING. Return the node as a dictionary, or None."""
+        if timeout is None:
+            timeout = self.BOOT_TIMEOUT
+
+        return self.poller.wait(node_id, timeout,
+            self.backoff(self.EXPECTED_BOOT_TIME),
+            on_attempt=lambda: self.count('polls'))
+
+    def remote_host(self, node):
+        """Return a RemoteHost object to run commands on the given node.
+        
+        SSH connections are pooled: after `startup` or `wait_for_ssh`, the
+        connection used to check that the node is up is reused."""
+        from nubo.remote import RemoteHost
+
+        return RemoteHost(node['public_ips'][0], self.ssh_private_key)
+
+    def remote_group(self, nodes, parallel=None):
+        """Return a RemoteGroup object to run commands on the given nodes
+        concurrently."""
+        from nubo.remote import RemoteGroup
+
+        return RemoteGroup([ node['public_ips'][0] for node in nodes ],
+            self.ssh_private_key, parallel)
+
+    def wait_for_ssh(self, node, timeout=None):
+        """Wait at most `timeout` seconds (default: SSH_TIMEOUT) for the
+        given node to accept SSH connections. Return the name of the user we
+        can login as, or None."""
+        import paramiko
+
+        if timeout is None:
+            timeout = self.SSH_TIMEOUT
+
+        deadline = monotonic() + timeout
+        backoff = self.backoff(self.EXPECTED_SSH_TIME)
+        remotehost = self.remote_host(node)
+
+        while True:
+            checked = monotonic()
+            if checked >= deadline:
+                logging.info("Timed out waiting for SSH on %s after %s "
+                    "seconds" % (node['id'], timeout))
+                return
+
+            # Do not attempt to login until sshd is sending its banner
+            if not remotehost.ssh_ready(timeout=min(self.POLL_INTERVAL,
+                                                    deadline - checked)):
+                logging.info("%.0f seconds left for SSH on %s: port closed" 
+                    % (deadline - monotonic(), node['id']))
+
+                self.count('ssh_retries')
+                backoff.sleep(deadline, since=checked)
+                continue
 
-                time.sleep(1)
-                attempts -= 1
+            try:
+                return remotehost.whoami(self.login_as)
             except paramiko.PasswordRequiredException:
                 msg = 'Authentication failed for %s@%s. ' % (
                     self.login_as, node['id'])
                 msg += 'Perhaps you should login as a different user?'
                 raise Exception(msg)
+            except (socket.error, paramiko.SSHException):
+                # sshd might still be starting up or waiting for our key
+                logging.info("%.0f seconds left for SSH as %s on %s" 
+                    % (deadline - monotonic(), self.login_as, node['id']))
+
+                self.count('ssh_retries')
+                backoff.sleep(deadline, since=checked)
+
+    @contextmanager
+    def no_wait(self):
+        """Within this block, `startup` returns as soon as the new node is
+        created, without waiting for it to be RUNNING and accepting SSH
+        connections. Only affects the current thread.
+
+        Used by `nubo.aio` to wait for nodes without holding a thread."""
+        self.__local.no_wait = True
+        try:
+            yield
+        finally:
+            self.__local.no_wait = False
 
     def startup(self, params):
         """Start a new instance.
@@ -203,26 +681,42 @@ class BaseCloud(object):
 
         eg: startup(params) -> dict
         """
-        # Start a new VM and keep track of its ID
-        node_id = node2dict(self.driver.create_node(**params))['id']
+        with self.launch() as launch:
+            launch.describe(params)
+
+            # Start a new VM and keep track of its ID
+            with self.phase('create'):
+                try:
+                    node = node2dict(self.driver.create_node(**params))
+                except Exception, e:
+                    name = missing(e)
+                    if name is None:
+                        raise
+
+                    # eg: our SSH key has been deleted from the account
+                    self.prerequisites.invalidate(name)
+                    raise MissingPrerequisite(name, e, sys.exc_info()[2])
+
+            if getattr(self.__local, 'no_wait', False):
+                return node
 
-        # Wait for the VM to be RUNNING
-        node = self.__wait_for_node(node_id)
-        assert node is not None
+            node_id = launch.node_id = node['id']
 
-        # Wait for SSH connections to be accepted
-        user = self.wait_for_ssh(node)
-        assert user == self.login_as
+            # Wait for the VM to be RUNNING
+            with self.phase('running'):
+                node = self.wait_for_node(node_id)
+                assert node is not None
 
-        return node
+            # Wait for SSH connections to be accepted
+            with self.phase('ssh'):
+                user = self.wait_for_ssh(node)
+                assert user == self.login_as
+
+            return dict(node.items())
 
     def is_running(self, node_id):
         """Return True if the given node is running."""
-        running_ids = [
-            node2dict(node)['id'] for node in self.driver.list_nodes() 
-        ]
-
-        return node_id in running_ids
+        return node_id in [ node.id for node in self.driver.list_nodes() ]
 
     def __call_if_running(self, function, node_id):
         if not self.is_running(node_id):
@@ -247,20 +741,169 @@ class BaseCloud(object):
         """
         return self.__call_if_running(self.driver.reboot_node, node_id)
 
-    def list_nodes(self):
-        """Return a list of dictionaries representing currently running
-        nodes."""
-        return [ node2dict(node) for node in self.driver.list_nodes() ]
+    def __call_on_nodes(self, method, node_ids, name_glob, parallel):
+        if not (node_ids or name_glob):
+            raise ValueError("No instance ids or name pattern given")
+
+        # A single snapshot of the nodes is enough to find all targets
+        targets = set(node_ids)
+        nodes = [ node for node in self.driver.list_nodes() 
+            if node_matches(node.id, node.name, targets, name_glob) ]
+
+        def call(node):
+            try:
+                ok = getattr(self.driver, method)(node)
+                return { 'id': node.id, 'name': node.name, 'ok': bool(ok),
+                         'error': None }
+            except Exception, e:
+                return { 'id': node.id, 'name': node.name, 'ok': False, 
+                         'error': e }
+
+        results = parallel_map(call, nodes, parallel or self.MAX_PARALLEL)
+
+        found = set([ node.id for node in nodes ] + 
+                    [ node.name for node in nodes ])
+
+        return results + [ { 'id': node_id, 'name': None, 'ok': False, 
+                             'error': None } 
+            for node_id in node_ids if node_id not in found ]
+
+    def shutdown_many(self, node_ids=(), name_glob=None, parallel=None):
+        """Shutdown the given instance ids or names, as well as the instances
+        whose name matches the shell-style wildcard `name_glob`. Run at most
+        `parallel` calls at the same time. Raise ValueError if neither ids
+        nor `name_glob` are given.
+
+        Return a list of dictionaries, one per instance, with the keys 'id',
+        'name', 'ok' (True if the instance has been shut down) and 'error'
+        (the exception raised by the cloud provider, if any). Given instances
+        which are not running are returned with 'ok' set to False and 'name'
+        set to None.
+
+        eg: shutdown_many(name_glob='loadtest-*') -> list
+        """
+        return self.__call_on_nodes('destroy_node', node_ids, name_glob, 
+            parallel)
+
+    def reboot_many(self, node_ids=(), name_glob=None, parallel=None):
+        """Reboot the given instance ids or names, as well as the instances
+        whose name matches the shell-style wildcard `name_glob`. See
+        `shutdown_many` for the return value.
+
+        eg: reboot_many(['i-bb6c3b88', 'i-bb6c3b89']) -> list
+        """
+        return self.__call_on_nodes('reboot_node', node_ids, name_glob, 
+            parallel)
+
+    def new_poller(self):
+        """Return the `nubo.poller.NodePoller` keeping track of the nodes of
+        this cloud. Cloud objects using the same provider, credentials and
+        poll interval share it, eg: the commands run by `nubo serve`, unless
+        they list nodes in their own way."""
+        key = (drivers.registry.key(self.PROVIDER_NAME, self.driver_params()),
+               self.POLL_INTERVAL, self.list_nodes.im_func)
+
+        return poller.registry.get(key,
+            lambda: NodePoller(self.list_nodes, self.POLL_INTERVAL))
+
+    def list_nodes(self, fields=None):
+        """Return a list of NodeRecords representing currently running
+        nodes. NodeRecords can be used as read-only dictionaries.
 
-    def list_sizes(self):
+        If `fields` is given, return dictionaries with those fields only.
+
+        eg: list_nodes(fields=('id', 'state')) -> list
+        """
+        records = [ NodeRecord(node) for node in self.driver.list_nodes() ]
+
+        if fields is None:
+            return records
+
+        return [ record.project(fields) for record in records ]
+
+    def find_nodes(self, targets=(), name_glob=None):
+        """Return the nodes whose id or name is in `targets`, or whose name
+        matches the shell-style wildcard `name_glob`, fetching the list of
+        nodes only once.
+
+        eg: find_nodes(['i-bb6c3b88', 'web-1']) -> list
+        """
+        targets = set(targets)
+        return [ node for node in self.list_nodes() if node_matches(
+            node['id'], node.get('name'), targets, name_glob) ]
+
+    def catalog(self, kind, refresh=False):
+        """Return the list of 'images', 'sizes' or 'locations' available on
+        this cloud, as libcloud objects. The list is read from the on-disk
+        cache if possible. With `refresh`, fetch it from the cloud provider.
+
+        eg: catalog('sizes') -> [ <NodeSize: id=1, ...>, ... ]
+        """
+        def fetch():
+            # Drivers cannot be serialized, and are per-thread anyway
+            entries = []
+            for entry in getattr(self.driver, 'list_' + kind)():
+                entry = copy.copy(entry)
+                entry.driver = None
+                entries.append(entry)
+
+            return entries
+
+        entries = self.cache.get(kind, fetch, refresh)
+
+        for entry in entries:
+            entry.driver = self.driver
+
+        return entries
+
+    def get_size(self, size_idx):
+        """Return the libcloud object representing the given size."""
+        return self.catalog('sizes')[size_idx]
+
+    def get_location(self, location_idx):
+        """Return the libcloud object representing the given location."""
+        return self.catalog('locations')[location_idx]
+
+    def list_sizes(self, refresh=False):
         """Return a list of strings representing the available instance
         size names."""
-        return [ size.name for size in self.driver.list_sizes() ]
+        return [ size.name for size in self.catalog('sizes', refresh) ]
+
+    def image_index(self, refresh=False):
+        """Return an ImageIndex of the images available on this cloud.
+
+        The index is cached on disk next to the list of images, and updated
+        incrementally when the list of images changes. Images are expired
+        and refreshed as usual, see `catalog`."""
+        images = self.catalog('images', refresh)
+        version = self.cache.timestamp('images')
+
+        index = self.cache.load('image-index')
+        index = index and index[1] or ImageIndex()
 
-    def list_images(self, limit=None, keyword=''):
+        if index.version != version:
+            index.update((image.id, image.name) for image in images)
+            index.version = version
+            self.cache.store('image-index', index)
+
+        return index
+
+    def search_images(self, keyword, refresh=False):
+        """Return the images matching all words in `keyword`, most relevant
+        and newest first. Words also match images whose id or name contains
+        a word starting with them.
+
+        eg: search_images('ubuntu 12.04') -> [ <NodeImage: id=2676, ...> ]
+        """
+        return [ NodeImage(image_id, name, self.driver) for image_id, name in
+            self.image_index(refresh).search(keyword) ]
+
+    def list_images(self, limit=None, keyword='', refresh=False):
         """Return a list of VM images available on this cloud."""
-        images = [ image for image in self.driver.list_images() 
-            if (keyword.lower() in image.name.lower()) or not keyword ]
+        if keyword:
+            images = self.search_images(keyword, refresh)
+        else:
+            images = self.catalog('images', refresh)
 
         if limit:
             return images[:limit]
@@ -272,3 +915,31 @@ class BaseCloud(object):
         here, it has to be specialized by the classes implementing specific 
         cloud providers."""
         raise NotImplementedError()
+
+    def deploy_many(self, image_id, count, name_template='node-%d', size_idx=0,
+                    location_idx=0, parallel=None):
+        """Deploy `count` VM instances concurrently, using at most
+        `parallel` threads. Each VM is named after `name_template`, which is
+        formatted with the VM's number (starting from 1).
+
+        A node failing to start does not affect the others. Return a list of
+        dictionaries, one per requested VM, with the keys 'name', 'node' (as
+        returned by `self.deploy`, or None) and 'error' (the exception raised
+        while deploying the VM, or None).
+
+        eg: deploy_many('ami-27013f53', 2, 'web-%d') -> list
+        """
+        if '%' not in name_template:
+            name_template += '-%d'
+
+        def deploy_one(name):
+            try:
+                node = self.deploy(image_id, size_idx=size_idx,
+                    location_idx=location_idx, name=name)
+                return { 'name': name, 'node': node, 'error': None }
+            except Exception, e:
+                logging.info("Deployment of %s failed: %s" % (name, e))
+                return { 'name': name, 'node': None, 'error': e }
+
+        names = [ name_template % (idx + 1) for idx in range(count) ]
+        return parallel_map(deploy_one, names, parallel or self.MAX_PARALLEL)
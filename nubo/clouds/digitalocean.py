@@ -9,12 +9,16 @@
     :copyright: (C) 2013 by Emanuele Rocca.
 """
 
-from nubo.clouds.base import BaseCloud
+from nubo.clouds.base import BaseCloud, instrumented
 
 class DigitalOcean(BaseCloud):
 
     PROVIDER_NAME = 'DIGITAL_OCEAN' 
 
+    # Droplets take about a minute to be active, sshd is up right after
+    EXPECTED_BOOT_TIME = 55
+    EXPECTED_SSH_TIME = 5
+
     def get_ssh_key_id(self):
         """Return uploaded key id if this SSH public key has been already
         submitted to Digital Ocean. We use libcloud's 
@@ -26,29 +30,44 @@ class DigitalOcean(BaseCloud):
 
         if uploaded_key:
             return str(uploaded_key[0])
+
+    def ssh_key_id(self):
+        """Return the id of our SSH key on Digital Ocean, uploading it with
+        libcloud's `driver.ex_create_ssh_key` if needed. The id is cached,
+        see `self.prerequisites`."""
+        def resolve():
+            key_id = self.get_ssh_key_id()
+            if not key_id:
+                with self.phase('key_upload'):
+                    uploaded_key = self.driver.ex_create_ssh_key(
+                        self.ssh_key_name, open(self.ssh_public_key).read())
+
+                key_id = str(uploaded_key.id)
+
+            return key_id
+
+        return self.prerequisites.get('ssh_key', resolve)
         
+    @instrumented
     def deploy(self, image_id, size_idx=0, location_idx=0, name='test'):
         """Digital Ocean needs the following information: VM size, image, name,
         location and SSH key id.
         
-        First, we check if our SSH key is already uploaded on Digital Ocean's
-        cloud. If not, we upload it using libcloud's `driver.ex_create_ssh_key`. 
-        Then, we call `self.startup` with the required arguments."""
-        key_id = self.get_ssh_key_id()
-
-        if not key_id:
-            uploaded_key = self.driver.ex_create_ssh_key(self.ssh_key_name, 
-                open(self.ssh_public_key).read())
-
-            key_id = str(uploaded_key.id)
+        First, we make sure our SSH key is uploaded on Digital Ocean's
+        cloud (see `self.ssh_key_id`), while looking up the size and the
+        location. Then, we call `self.startup` with the required
+        arguments."""
+        prerequisites = self.prepare({
+            'key_id': self.ssh_key_id,
+            'size': lambda: self.get_size(size_idx),
+            'location': lambda: self.get_location(location_idx),
+        })
 
         class Image:
             id = image_id
 
-        size = self.driver.list_sizes()[size_idx]
-        location = self.driver.list_locations()[location_idx]
-        
         return self.startup({ 
-            'size': size, 'image': Image, 'name': name,
-            'location': location, 'ex_ssh_key_ids': [ key_id ]
+            'size': prerequisites['size'], 'image': Image, 'name': name,
+            'location': prerequisites['location'],
+            'ex_ssh_key_ids': [ prerequisites['key_id'] ]
         })
@@ -9,12 +9,18 @@
     :copyright: (C) 2013 by Emanuele Rocca.
 """
 
-from nubo.clouds.base import BaseCloud
+from nubo.clouds.base import BaseCloud, instrumented
 
 class AmazonEC2(BaseCloud):
 
     PROVIDER_NAME = 'EC2_US_EAST'
 
+    # Instances are RUNNING well before sshd is up. DescribeInstances calls
+    # are rate limited per account.
+    EXPECTED_BOOT_TIME = 30
+    EXPECTED_SSH_TIME = 30
+    POLL_INTERVAL = 2
+
     def get_ssh_key_id(self):
         """Return uploaded key id if this SSH public key has been already
         submitted to Amazon EC2. We use libcloud's `driver.ex_describe_keypairs` 
@@ -28,58 +34,82 @@ class AmazonEC2(BaseCloud):
             # This key has not been uploaded yet
             return 
 
-    def list_images(self, limit=20, keyword=''):
+    def keypair(self):
+        """Return the name of our key pair on Amazon EC2, importing it with
+        libcloud's `driver.ex_import_keypair` if needed. The name is cached,
+        see `self.prerequisites`."""
+        def resolve():
+            key_id = self.get_ssh_key_id()
+            if not key_id:
+                with self.phase('key_upload'):
+                    key = self.driver.ex_import_keypair(self.ssh_key_name,
+                        self.ssh_public_key)
+
+                key_id = key['keyName']
+
+            return key_id
+
+        return self.prerequisites.get('keypair', resolve)
+
+    def security_group(self):
+        """Return the name of nubo's permissive Security Group, creating it
+        with `driver.ex_create_security_group` and
+        `driver.ex_authorize_security_group_permissive` if needed. The name
+        is cached, see `self.prerequisites`."""
+        def resolve():
+            if __name__ not in self.driver.ex_list_security_groups():
+                with self.phase('security_group'):
+                    self.driver.ex_create_security_group(__name__, 
+                        "nubolib's SG")
+                    self.driver.ex_authorize_security_group_permissive(
+                        __name__)
+
+            return __name__
+
+        return self.prerequisites.get('security_group', resolve)
+
+    def list_images(self, limit=20, keyword='', refresh=False):
         """Amazon also returns kernel-related info in `driver.list_images`. We
         do not care about kernels here, only about bootable VM images (AMIs).
 
-        First, we get the list of available AMIs. Then, we search for the
-        user-specified keyword (if any). 
+        First, we search for the user-specified keyword (if any). Then, we
+        only keep AMIs.
 
         Only 20 results are returned by default to avoid flooding users with
         too much output."""
-        ami_images = [ image for image in self.driver.list_images() 
-            if 'ami-' in image.id ]
+        if keyword:
+            images = self.search_images(keyword, refresh)
+        else:
+            images = self.catalog('images', refresh)
 
         if not limit:
             limit = 20
 
-        return [ image for image in ami_images 
-            if (keyword.lower() in image.name.lower()) or not keyword ][:limit]
+        return [ image for image in images if 'ami-' in image.id ][:limit]
 
+    @instrumented
     def deploy(self, image_id, size_idx=0, location_idx=0, name='test'):
         """Amazon EC2 needs the following information: VM size, image, name,
         location, SSH key name and security group name.
         
-        First, we check if our SSH key is already uploaded on Amazon's cloud.
-        If not, we upload it using libcloud's `driver.ex_import_keypair`. 
-
-        Then, we create a permissive Security Group with
-        `driver.ex_create_security_group` and
-        `driver.ex_authorize_security_group_permissive`.
+        First, we make sure our SSH key is uploaded on Amazon's cloud (see
+        `self.keypair`) and that our Security Group exists (see
+        `self.security_group`), while looking up the size and the location.
 
         Finally, we call `self.startup` with the required arguments."""
-        # Uploading SSH key if necessary
-        key_id = self.get_ssh_key_id()
-
-        if not key_id:
-            key = self.driver.ex_import_keypair(self.ssh_key_name,
-                self.ssh_public_key)
-
-            key_id = key['keyName']
-
-        # Creating security group if necessary
-        if __name__ not in self.driver.ex_list_security_groups():
-            self.driver.ex_create_security_group(__name__, "nubolib's SG")
-            self.driver.ex_authorize_security_group_permissive(__name__)
+        prerequisites = self.prepare({
+            'key_id': self.keypair,
+            'group': self.security_group,
+            'size': lambda: self.get_size(size_idx),
+            'location': lambda: self.get_location(location_idx),
+        })
 
         class Image:
             id = image_id
 
-        size = self.driver.list_sizes()[size_idx]
-        location = self.driver.list_locations()[location_idx]
-        
         return self.startup({ 
-            'size': size, 'image': Image, 'name': name,
-            'location': location, 'ex_keyname': key_id,
-            'ex_securitygroup': __name__
+            'size': prerequisites['size'], 'image': Image, 'name': name,
+            'location': prerequisites['location'],
+            'ex_keyname': prerequisites['key_id'],
+            'ex_securitygroup': prerequisites['group']
         })
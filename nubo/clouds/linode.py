@@ -13,13 +13,14 @@ from libcloud.compute.deployment import MultiStepDeployment
 from libcloud.compute.deployment import ScriptDeployment
 from libcloud.compute.deployment import SSHKeyDeployment
 
-from nubo.clouds.base import BaseCloud, node2dict
+from nubo.clouds.base import BaseCloud, node2dict, instrumented
 
 class Linode(BaseCloud):
 
     PROVIDER_NAME = 'LINODE' 
     NEEDED_PARAMS = ['key']
 
+    @instrumented
     def deploy(self, image_id, size_idx=0, location_idx=0, name='test'):
         """Linode supports libcloud's `libcloud.compute.deployment`.
 
@@ -31,8 +32,18 @@ class Linode(BaseCloud):
         class Image:
             id = image_id
 
-        size = self.driver.list_sizes()[size_idx]
-        location = self.driver.list_locations()[location_idx]
-
-        return node2dict(self.driver.deploy_node(name=name, image=Image, 
-            size=size, location=location, deploy=msd))
+        prerequisites = self.prepare({
+            'size': lambda: self.get_size(size_idx),
+            'location': lambda: self.get_location(location_idx),
+        })
+
+        params = { 'name': name, 'image': Image,
+                   'size': prerequisites['size'],
+                   'location': prerequisites['location'] }
+        self.describe(params)
+
+        # libcloud creates the node, waits for it and deploys our key. It
+        # has its own boot timeout, only the SSH one can be given.
+        with self.phase('deploy_node'):
+            return node2dict(self.driver.deploy_node(deploy=msd,
+                timeout=self.SSH_TIMEOUT, **params))
@@ -9,19 +9,26 @@
     :copyright: (C) 2013 by Emanuele Rocca.
 """
 
-from nubo.clouds.base import BaseCloud
-from nubo.clouds.base import AVAILABLE_CLOUDS, CLOUDS_MAPPING
+from nubo.clouds.base import BaseCloud, instrumented
+from nubo.clouds.base import available_clouds, CLOUDS_MAPPING
 
 class OpenNebula(BaseCloud):
     
     PROVIDER_NAME = 'OPENNEBULA'
     NEEDED_PARAMS = [ 'key', 'secret', 'host', 'port', 'network_id', 'api_version' ]
 
-    def __init__(self, ssh_private_key=None, login_as='root'):
-        self.network_id = AVAILABLE_CLOUDS[
-            CLOUDS_MAPPING['OPENNEBULA']].pop('network_id')
-        BaseCloud.__init__(self, ssh_private_key)
+    def __init__(self, ssh_private_key=None, login_as='root', **kwargs):
+        self.network_id = available_clouds()[
+            CLOUDS_MAPPING['OPENNEBULA']]['network_id']
+        BaseCloud.__init__(self, ssh_private_key, login_as, **kwargs)
 
+    def driver_params(self):
+        """network_id is used by nubo only, libcloud does not need it."""
+        params = BaseCloud.driver_params(self)
+        params.pop('network_id', None)
+        return params
+
+    @instrumented
     def deploy(self, image_id, size_idx=0, location_idx=0, name='test'):
         script = """#!/bin/bash
 dhclient eth0
@@ -40,7 +47,9 @@ cat <<EOF >~%s/.ssh/authorized_keys
 EOF
 """ % (self.login_as, self.login_as, open(self.ssh_public_key).read())
 
-        size = self.driver.list_sizes()[size_idx]
+        prerequisites = self.prepare({
+            'size': lambda: self.get_size(size_idx),
+        })
 
         class Image:
             id = image_id
@@ -53,6 +62,6 @@ EOF
             'USERDATA': script.encode('hex'),
             'IP_PUBLIC': '$NIC[IP]'
         }
-        return self.startup({ 'size': size, 'image': Image, 
+        return self.startup({ 'size': prerequisites['size'], 'image': Image, 
                               'networks': Network, 'name': name,
                               'context': context })
@@ -13,12 +13,13 @@ from libcloud.compute.deployment import MultiStepDeployment
 from libcloud.compute.deployment import ScriptDeployment
 from libcloud.compute.deployment import SSHKeyDeployment
 
-from nubo.clouds.base import BaseCloud, node2dict
+from nubo.clouds.base import BaseCloud, node2dict, instrumented
 
 class Rackspace(BaseCloud):
 
     PROVIDER_NAME = 'RACKSPACE' 
 
+    @instrumented
     def deploy(self, image_id, size_idx=0, location_idx=0, name='test'):
         """Rackspace supports libcloud's `libcloud.compute.deployment`.
 
@@ -30,8 +31,18 @@ class Rackspace(BaseCloud):
         class Image:
             id = image_id
 
-        size = self.driver.list_sizes()[size_idx]
-        location = self.driver.list_locations()[location_idx]
-
-        return node2dict(self.driver.deploy_node(name=name, image=Image, 
-            size=size, location=location, deploy=msd))
+        prerequisites = self.prepare({
+            'size': lambda: self.get_size(size_idx),
+            'location': lambda: self.get_location(location_idx),
+        })
+
+        params = { 'name': name, 'image': Image,
+                   'size': prerequisites['size'],
+                   'location': prerequisites['location'] }
+        self.describe(params)
+
+        # libcloud creates the node, waits for it and deploys our key. It
+        # has its own boot timeout, only the SSH one can be given.
+        with self.phase('deploy_node'):
+            return node2dict(self.driver.deploy_node(deploy=msd,
+                timeout=self.SSH_TIMEOUT, **params))
@@ -1,19 +1,92 @@
 import os
+import copy
 import json
+import fcntl
+import tempfile
+
+from contextlib import contextmanager
 
 CONFFILE = os.path.join(os.getenv('HOME'), '.nuborc')
 
-def read_config():
+# Parsed configuration files: path -> (file identity, values)
+PARSED = {}
+
+def conffile(profile=None):
+    """Return the path of the configuration file of the given profile.
+    Profiles allow using different credentials at the same time, eg: in
+    parallel jobs. Without a profile name, use the NUBO_PROFILE environment
+    variable, or the default configuration file if it is not set.
+
+    eg: conffile('ci') -> '/home/ema/.nuborc.ci'
+    """
+    if profile is None:
+        profile = os.getenv('NUBO_PROFILE')
+
+    if not profile:
+        return CONFFILE
+
+    return '%s.%s' % (CONFFILE, profile)
+
+def read_config(profile=None):
+    """Return the configuration of the given profile as a dictionary.
+    The file is parsed again only if it changed since the last call."""
+    path = conffile(profile)
+
     try:
-        return json.loads(open(CONFFILE).read())
-    except IOError:
+        stat = os.stat(path)
+    except OSError:
         return {}
 
-def write_config(values):
-    old_values = read_config()
+    # Files are replaced atomically when written, hence a new inode
+    identity = (stat.st_ino, stat.st_mtime, stat.st_size)
+
+    parsed = PARSED.get(path)
+    if parsed is None or parsed[0] != identity:
+        try:
+            parsed = PARSED[path] = (identity, json.loads(open(path).read()))
+        except IOError:
+            return {}
+
+    return copy.deepcopy(parsed[1])
+
+@contextmanager
+def locked(path):
+    """Hold an exclusive advisory lock on `path` (using a separate lock
+    file, as `path` itself gets replaced)."""
+    with open(path + '.lock', 'a') as lockfile:
+        fcntl.flock(lockfile, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lockfile, fcntl.LOCK_UN)
+
+def replace(path, data):
+    """Replace the contents of `path` with `data` atomically: readers see
+    either the old contents or the new ones. The file is only readable by
+    its owner."""
+    # mkstemp creates files with mode 0600
+    fd, tmppath = tempfile.mkstemp(dir=os.path.dirname(path),
+        prefix=os.path.basename(path) + '.')
+    try:
+        os.write(fd, data)
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+    os.rename(tmppath, path)
+
+def write_config(values, profile=None):
+    """Merge `values` into the configuration of the given profile.
+
+    Concurrent writers are serialized with a file lock, and the file is
+    replaced atomically: readers never see a partially written file. The
+    file is only readable by its owner."""
+    path = conffile(profile)
+
+    with locked(path):
+        updated = read_config(profile)
+        updated.update(values)
 
-    updated = dict(old_values.items() + values.items())
-    open(CONFFILE, 'w').write(json.dumps(updated, indent=4))
+        replace(path, json.dumps(updated, indent=4))
 
-    os.chmod(CONFFILE, 0600)
     return updated
@@ -0,0 +1,326 @@
+# -*- coding: utf-8 -*-
+
+"""
+    nubo.daemon
+    ===========
+
+    Run nubo commands in a long-running process, keeping drivers, HTTP and
+    SSH connections, node states and cached catalogs warm between them.
+    Commands are sent over a Unix domain socket, only accessible by its
+    owner, and run concurrently, each by its own thread.
+
+    The protocol is line-based. The client sends one JSON object with the
+    command line arguments, working directory and environment. The server
+    replies with one JSON array per line: [ 'out', text ], [ 'err', text ]
+    and finally [ 'exit', status ].
+
+    eg: daemon.forward([ 'list' ]) -> 0
+
+    :copyright: (C) 2013 by Emanuele Rocca.
+"""
+
+import os
+import sys
+import json
+import socket
+import logging
+import threading
+import traceback
+
+from UserDict import DictMixin
+
+# Environment variables affecting nubo commands, sent along with them
+ENVIRONMENT = ( 'NUBO_CLOUD', 'NUBO_PROFILE', 'NUBO_HISTORY' )
+
+# Commands run at once. Further clients wait for one of them to complete.
+MAX_REQUESTS = 16
+
+# Output streams and environment of the command run by the current thread,
+# see `handle`
+request = threading.local()
+
+def socket_path():
+    """Return the path of the socket, $NUBO_SOCKET or ~/.nubo.sock."""
+    return os.getenv('NUBO_SOCKET') or os.path.join(
+        os.getenv('HOME'), '.nubo.sock')
+
+def exit_status(code):
+    """Return the exit status of a process calling sys.exit(code)."""
+    if code is None:
+        return 0
+
+    if isinstance(code, (int, long)):
+        return code
+
+    print >> sys.stderr, code
+    return 1
+
+class Output(object):
+    """File-like object sending what is written to it to a client. Once the
+    client is gone, output is discarded: the command keeps running."""
+
+    def __init__(self, connection, name, lock):
+        self.connection = connection
+        self.name = name
+        self.lock = lock
+
+    def send(self, kind, data):
+        line = json.dumps([ kind, data ]) + '\n'
+
+        with self.lock:
+            if self.connection is None:
+                return
+
+            try:
+                self.connection.sendall(line)
+            except socket.error:
+                self.connection = None
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.decode('utf-8', 'replace')
+
+        self.send(self.name, data)
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return False
+
+class Stream(object):
+    """Replacement of sys.stdout or sys.stderr writing to the client of the
+    command run by the current thread, if any, and to the original stream
+    otherwise."""
+
+    def __init__(self, name, stream):
+        self.name = name
+        self.stream = stream
+
+    def target(self):
+        return getattr(request, self.name, None) or self.stream
+
+    def write(self, data):
+        self.target().write(data)
+
+    def writelines(self, lines):
+        self.target().writelines(lines)
+
+    def flush(self):
+        self.target().flush()
+
+    def isatty(self):
+        return self.target().isatty()
+
+    # Used by the print statement
+    softspace = property(lambda self: getattr(self.target(), 'softspace', 0),
+        lambda self, value: setattr(self.target(), 'softspace', value))
+
+    def __getattr__(self, name):
+        return getattr(self.target(), name)
+
+class Environment(DictMixin):
+    """Replacement of os.environ giving the command run by the current
+    thread its own values of the variables in ENVIRONMENT. Other variables,
+    and other threads, use the original environment.
+
+    Threads started by commands do not inherit their environment: cloud
+    objects remember what they need of it, see
+    `nubo.clouds.base.BaseCloud`."""
+
+    def __init__(self, environ):
+        self.environ = environ
+
+    def overrides(self, name):
+        env = getattr(request, 'env', None)
+        if env is not None and name in ENVIRONMENT:
+            return env
+
+    def __getitem__(self, name):
+        env = self.overrides(name)
+        if env is None:
+            return self.environ[name]
+
+        if env[name] is None:
+            raise KeyError(name)
+
+        return env[name]
+
+    def __setitem__(self, name, value):
+        env = self.overrides(name)
+        if env is None:
+            self.environ[name] = value
+        else:
+            env[name] = value
+
+    def __delitem__(self, name):
+        env = self.overrides(name)
+        if env is None:
+            del self.environ[name]
+        elif env[name] is None:
+            raise KeyError(name)
+        else:
+            env[name] = None
+
+    def keys(self):
+        env = getattr(request, 'env', None)
+        if env is None:
+            return self.environ.keys()
+
+        return [ name for name in self.environ.keys() 
+            if name not in ENVIRONMENT ] + [ name for name, value 
+                in env.items() if value is not None ]
+
+    def copy(self):
+        return dict(self)
+
+def install():
+    """Give each thread running a command its own output streams and
+    environment. Threads not running commands are not affected."""
+    if not isinstance(sys.stdout, Stream):
+        sys.stdout = Stream('stdout', sys.stdout)
+        sys.stderr = Stream('stderr', sys.stderr)
+
+    if not isinstance(os.environ, Environment):
+        # Seen by os.getenv too
+        os.environ = Environment(os.environ)
+
+def handle(run, connection):
+    """Run the command received on `connection` and send its output.
+    Commands run by other threads at the same time are not affected, see
+    `install`."""
+    line = connection.makefile('rb').readline()
+    if not line:
+        # See `running`
+        return
+
+    received = json.loads(line)
+
+    lock = threading.Lock()
+    stdout = Output(connection, 'out', lock)
+
+    request.env = dict((name, received['env'].get(name)) 
+        for name in ENVIRONMENT)
+    request.stdout = stdout
+    request.stderr = Output(connection, 'err', lock)
+
+    try:
+        run(received['argv'], received['cwd'])
+        status = 0
+    except SystemExit, e:
+        status = exit_status(e.code)
+    except Exception, e:
+        traceback.print_exc()
+        status = 1
+    finally:
+        request.__dict__.clear()
+
+    stdout.send('exit', status)
+
+def serve_connection(run, connection, slots):
+    try:
+        handle(run, connection)
+    except Exception, e:
+        logging.exception("Cannot handle request: %s" % e)
+    finally:
+        connection.close()
+        slots.release()
+
+def serve(run, path=None, max_requests=MAX_REQUESTS):
+    """Call `run(argv, cwd)` with the command line arguments and working
+    directory received on the Unix socket `path`, until interrupted. At
+    most `max_requests` commands are run at once, each by its own thread.
+
+    Commands must not change the working directory: relative paths have to
+    be resolved against `cwd`."""
+    path = path or socket_path()
+
+    if running(path):
+        raise Exception, "nubo is already serving on %s" % path
+
+    # Left behind by a daemon which did not exit cleanly
+    if os.path.exists(path):
+        os.unlink(path)
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+    # The socket gives access to our cloud credentials
+    umask = os.umask(0077)
+    try:
+        server.bind(path)
+    finally:
+        os.umask(umask)
+
+    server.listen(socket.SOMAXCONN)
+
+    install()
+    slots = threading.BoundedSemaphore(max_requests)
+
+    try:
+        while True:
+            slots.acquire()
+            connection, _ = server.accept()
+
+            thread = threading.Thread(target=serve_connection,
+                args=(run, connection, slots))
+            # Commands in progress do not keep the daemon from exiting
+            thread.daemon = True
+            thread.start()
+    finally:
+        server.close()
+        os.unlink(path)
+
+def connect(path):
+    """Return a connection to the daemon listening on `path`, or None."""
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.connect(path)
+        return connection
+    except socket.error:
+        connection.close()
+
+def running(path=None):
+    """Return True if a daemon is listening on `path`."""
+    connection = connect(path or socket_path())
+    if connection is None:
+        return False
+
+    connection.close()
+    return True
+
+def forward(argv, path=None, stdout=None, stderr=None):
+    """Run a nubo command in the daemon listening on `path`, printing its
+    output on `stdout` and `stderr`. Return its exit status, or None if no
+    daemon is running."""
+    stdout = stdout or sys.stdout
+    stderr = stderr or sys.stderr
+
+    connection = connect(path or socket_path())
+    if connection is None:
+        return None
+
+    try:
+        connection.sendall(json.dumps({
+            'argv': argv,
+            'cwd': os.getcwd(),
+            'env': dict((name, os.getenv(name)) for name in ENVIRONMENT),
+        }) + '\n')
+
+        for line in connection.makefile('rb'):
+            kind, data = json.loads(line)
+            if kind == 'exit':
+                return data
+
+            out = kind == 'out' and stdout or stderr
+            out.write(data.encode('utf-8'))
+            out.flush()
+    finally:
+        connection.close()
+
+    # The command might have been partially executed, do not run it again
+    print >> stderr, "E: nubo serve exited before completing the command"
+    return 1
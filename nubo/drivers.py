@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+
+"""
+    nubo.drivers
+    ============
+
+    Reuse libcloud drivers, and their HTTP connections, across cloud objects
+    and threads.
+
+    :copyright: (C) 2013 by Emanuele Rocca.
+"""
+
+import time
+import socket
+import httplib
+import threading
+
+# Idle HTTP connections are not reused after this many seconds, as servers
+# might have closed them in the meantime
+KEEPALIVE_TIMEOUT = 10
+
+def keep_alive(driver, timeout=KEEPALIVE_TIMEOUT):
+    """Make `driver` reuse its HTTP connection across requests: libcloud
+    opens a new one, going through a new TLS handshake, for each request.
+    httplib does not notice connections closed by the server until they are
+    used: requests failing on a reused connection are retried once on a new
+    one."""
+    connection = getattr(driver, 'connection', None)
+    connect = getattr(connection, 'connect', None)
+    request = getattr(connection, 'request', None)
+    if connect is None:
+        return driver
+
+    last_used = [ 0 ]
+    reused = [ False ]
+
+    def reuse(host=None, port=None, base_url=None):
+        now = time.time()
+        idle, last_used[0] = now - last_used[0], now
+
+        if (host or port or base_url or connection.connection is None
+                or idle > timeout):
+            reused[0] = False
+            return connect(host, port, base_url)
+
+        reused[0] = True
+
+    def retry(*args, **kwargs):
+        try:
+            return request(*args, **kwargs)
+        except (httplib.BadStatusLine, socket.error):
+            if not reused[0]:
+                raise
+
+        # The server closed the connection while idle: open a new one
+        last_used[0] = 0
+        return request(*args, **kwargs)
+
+    connection.connect = reuse
+    if request is not None:
+        connection.request = retry
+    return driver
+
+class Lease(object):
+    """A driver used by a thread. When the thread terminates, its leases are
+    garbage collected and the driver goes back to the registry."""
+
+    def __init__(self, registry, key, driver, generation):
+        self.registry = registry
+        self.key = key
+        self.driver = driver
+        self.generation = generation
+
+    def __del__(self):
+        self.registry.release(self.key, self.driver, self.generation)
+
+class DriverRegistry(object):
+    """Process-wide registry of libcloud drivers, keyed by provider name and
+    driver parameters (ie: credentials).
+
+    libcloud drivers are not thread-safe: each driver is used by one thread
+    at a time. A thread asking twice for the same driver gets the same
+    instance. Drivers of terminated threads are handed to the next threads
+    asking for them.
+
+    eg: registry.get('EC2_EU_WEST', { 'key': ..., 'secret': ... }, factory)
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+        # key -> list of drivers not used by any thread
+        self.idle = {}
+
+        # Drivers leased before the last `clear` are not reused
+        self.generation = 0
+
+    def key(self, provider, params):
+        return (provider, tuple(sorted((name, repr(value))
+            for name, value in params.iteritems())))
+
+    def get(self, provider, params, factory):
+        """Return the driver of the current thread for the given provider
+        and parameters, calling `factory()` to get a new one if no idle
+        driver is available."""
+        key = self.key(provider, params)
+
+        leases = self.local.__dict__.setdefault('leases', {})
+        lease = leases.get(key)
+        if lease is not None and lease.generation == self.generation:
+            return lease.driver
+
+        with self.lock:
+            generation = self.generation
+            drivers = self.idle.get(key)
+            driver = drivers and drivers.pop() or None
+
+        if driver is None:
+            driver = keep_alive(factory())
+
+        leases[key] = Lease(self, key, driver, generation)
+        return driver
+
+    def release(self, key, driver, generation):
+        with self.lock:
+            if generation == self.generation:
+                self.idle.setdefault(key, []).append(driver)
+
+    def clear(self):
+        """Forget all drivers."""
+        with self.lock:
+            self.generation += 1
+            self.idle.clear()
+
+# Shared by all BaseCloud objects
+registry = DriverRegistry()
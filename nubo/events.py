@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+
+"""
+    nubo.events
+    ===========
+
+    Timings of each phase of deployments, reported to registered listeners.
+
+    eg: events.subscribe(events.JSONLinesLog('/tmp/nubo-events.log'))
+
+    :copyright: (C) 2013 by Emanuele Rocca.
+"""
+
+import sys
+import time
+import json
+import logging
+import threading
+
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+
+# time.monotonic is not available on Python 2. Use clock_gettime where
+# possible, or fall back to the system clock.
+monotonic = time.time
+
+if sys.platform.startswith('linux'):
+    try:
+        import ctypes
+
+        CLOCK_MONOTONIC = 1
+
+        class timespec(ctypes.Structure):
+            _fields_ = [ ('tv_sec', ctypes.c_long),
+                         ('tv_nsec', ctypes.c_long) ]
+
+        clock_gettime = ctypes.CDLL(None, use_errno=True).clock_gettime
+        clock_gettime.argtypes = [ ctypes.c_int, ctypes.POINTER(timespec) ]
+
+        def monotonic():
+            """Seconds elapsed since an arbitrary point in time, not
+            affected by changes of the system clock."""
+            now = timespec()
+            if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(now)):
+                return time.time()
+
+            return now.tv_sec + now.tv_nsec / 1e9
+    except (ImportError, OSError, AttributeError):
+        pass
+
+# (listener, source) pairs, see `subscribe`
+listeners = []
+
+def subscribe(listener, source=None):
+    """Call `listener(event)` with each event or, if `source` is given, with
+    the events of the deployments performed by `source` only (eg: a cloud
+    object, see `nubo.clouds.base.BaseCloud.launch`).
+
+    Events are dictionaries with at least the keys 'event' (eg: 'phase')
+    and 'time'. Listeners are called by the threads performing deployments,
+    hence they must be thread-safe."""
+    listeners.append((listener, source))
+
+def unsubscribe(listener, source=None):
+    listeners.remove((listener, source))
+
+def emit(event, source=None, **fields):
+    fields['event'] = event
+    fields['time'] = time.time()
+
+    for listener, wanted in list(listeners):
+        if wanted is not None and wanted is not source:
+            continue
+
+        try:
+            listener(fields)
+        except Exception, e:
+            logging.exception("Event listener failed: %s" % e)
+
+class JSONLinesLog(object):
+    """Listener appending events to a file, one JSON object per line."""
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.logfile = open(path, 'a')
+
+    def __call__(self, event):
+        line = json.dumps(event, default=str) + '\n'
+
+        with self.lock:
+            self.logfile.write(line)
+            self.logfile.flush()
+
+    def close(self):
+        self.logfile.close()
+
+@contextmanager
+def untimed():
+    yield
+
+class Launch(object):
+    """Timings of a deployment, from its first API call to the new node
+    accepting SSH connections.
+
+    The time spent in each phase (eg: 'create', 'running', 'ssh') and the
+    number of times something happened (eg: 'polls') are recorded, and
+    reported in 'phase' and 'launch_finished' events.
+
+    Events are emitted on behalf of `source`, see `subscribe`.
+
+    eg: Launch('DIGITAL_OCEAN').as_dict() -> dict
+    """
+
+    def __init__(self, provider, source=None):
+        self.provider = provider
+        self.source = source
+
+        self.name = None
+        self.node_id = None
+        self.image = None
+        self.size = None
+        self.location = None
+
+        # Phases might be performed by multiple threads at once
+        self.lock = threading.Lock()
+
+        self.phases = OrderedDict()
+        self.counters = Counter()
+
+        # Wall clock time, for humans. Durations use the monotonic clock.
+        self.started_at = time.time()
+        self.started = monotonic()
+        self.seconds = None
+        self.error = None
+
+    def describe(self, params):
+        """Take note of the node being started, given the parameters of
+        `driver.create_node`."""
+        self.name = params.get('name')
+
+        for what in 'image', 'size', 'location':
+            value = params.get(what)
+            setattr(self, what, getattr(value, 'id', value))
+
+    @contextmanager
+    def phase(self, name):
+        """Time the phase performed within this block. Phases with the same
+        name add up."""
+        start = monotonic()
+        error = None
+        try:
+            yield
+        except Exception, e:
+            error = str(e) or e.__class__.__name__
+            raise
+        finally:
+            seconds = monotonic() - start
+            with self.lock:
+                self.phases[name] = self.phases.get(name, 0) + seconds
+
+            emit('phase', self.source, provider=self.provider,
+                name=self.name, node_id=self.node_id, phase=name,
+                seconds=seconds, error=error)
+
+    def count(self, what, amount=1):
+        with self.lock:
+            self.counters[what] += amount
+
+    def finish(self, error=None):
+        self.seconds = monotonic() - self.started
+        self.error = error
+
+        emit('launch_finished', self.source, **self.as_dict())
+
+    def as_dict(self):
+        with self.lock:
+            return {
+                'provider': self.provider,
+                'name': self.name,
+                'node_id': self.node_id,
+                'image': self.image,
+                'size': self.size,
+                'location': self.location,
+                'phases': OrderedDict(self.phases),
+                'counters': dict(self.counters),
+                'started_at': self.started_at,
+                'seconds': self.seconds,
+                'error': self.error,
+            }
@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+
+"""
+    nubo.history
+    ============
+
+    Remember how long each deployment took to reach the RUNNING state and
+    to accept SSH connections, to compare providers, regions, images and
+    sizes and to choose sensible timeouts.
+
+    Deployments are appended to ~/.nubo-history, one JSON object per line,
+    by all nubo processes of the same user, along with the time they
+    started. Times are counted from the request to create the node, cached
+    prerequisites aside.
+
+    eg: summarize(read(since=time.time() - 86400)) -> list
+
+    :copyright: (C) 2013 by Emanuele Rocca.
+"""
+
+import os
+import re
+import json
+import math
+import time
+import logging
+
+from collections import OrderedDict
+
+HISTORYFILE = os.path.join(os.getenv('HOME'), '.nubo-history')
+
+# Phases until the node is RUNNING. libcloud's deploy_node waits for the
+# node and for SSH on its own, see `entry`.
+RUNNING_PHASES = ( 'create', 'running' )
+SSH_PHASES = ( 'ssh', 'deploy_node' )
+
+# Fields of the deployments grouped together by `summarize`
+GROUP_BY = ( 'provider', 'image', 'size' )
+
+PERCENTILES = ( 50, 90, 99 )
+
+# eg: 90s, 30m, 12h, 7d, 2w
+DURATION_RE = re.compile(r'^(\d+(?:\.\d+)?)([smhdw]?)$')
+UNITS = { '': 1, 's': 1, 'm': 60, 'h': 60 * 60, 'd': 24 * 60 * 60,
+          'w': 7 * 24 * 60 * 60 }
+
+def history_path():
+    """Return the path of the history file, $NUBO_HISTORY or
+    ~/.nubo-history. Setting NUBO_HISTORY to an empty string disables the
+    history."""
+    return os.getenv('NUBO_HISTORY', HISTORYFILE)
+
+def parse_duration(text):
+    """Return the number of seconds in a duration such as '12h'.
+
+    eg: parse_duration('7d') -> 604800.0"""
+    match = DURATION_RE.match(text.strip().lower())
+    if match is None:
+        raise ValueError("Invalid duration: %s" % text)
+
+    return float(match.group(1)) * UNITS[match.group(2)]
+
+def entry(launch):
+    """Return the history entry of the given 'launch_finished' event (see
+    `nubo.events.Launch.as_dict`), or None if the node was started without
+    being waited for (eg: deployments by `nubo.aio`). Failures are always
+    recorded, with no times if the node never got to be RUNNING."""
+    phases = launch['phases']
+
+    waited = any(phase in phases for phase in SSH_PHASES + ( 'running', ))
+    if not waited and not launch['error']:
+        return None
+
+    def total(names):
+        return round(sum(phases.get(name, 0) for name in names), 3)
+
+    # deploy_node does not tell us when the node was RUNNING
+    running = ssh = None
+    if 'running' in phases:
+        running = total(RUNNING_PHASES)
+
+    if any(phase in phases for phase in SSH_PHASES):
+        ssh = total(RUNNING_PHASES + SSH_PHASES)
+
+    return OrderedDict([
+        ('time', round(launch.get('started_at') or time.time(), 3)),
+        ('provider', launch['provider']),
+        ('location', launch.get('location')),
+        ('image', launch['image']),
+        ('size', launch['size']),
+        ('running', running),
+        ('ssh', ssh),
+        ('error', launch['error']),
+    ])
+
+def record(launch, path=None):
+    """Append the given deployment to the history, see `entry`. Failures
+    to do so are logged, not raised: deployments go on."""
+    path = path if path is not None else history_path()
+    if not path:
+        return
+
+    line = entry(launch)
+    if line is None:
+        return
+
+    try:
+        # Short lines written at once in append mode: lines written by
+        # concurrent processes are not mixed up
+        with open(path, 'a') as history:
+            history.write(json.dumps(line, default=str) + '\n')
+    except IOError, e:
+        logging.warning("Cannot record deployment in %s: %s" % (path, e))
+
+def read(path=None, since=None, until=None):
+    """Return the deployments recorded between the given times, as
+    returned by `time.time()`. Damaged lines are skipped."""
+    entries = []
+
+    try:
+        history = open(path or history_path())
+    except IOError:
+        return entries
+
+    with history:
+        for line in history:
+            try:
+                launch = json.loads(line)
+                when = launch['time']
+            except (ValueError, TypeError, KeyError):
+                continue
+
+            if since is not None and when < since:
+                continue
+
+            if until is not None and when > until:
+                continue
+
+            entries.append(launch)
+
+    return entries
+
+def percentile(values, p):
+    """Return the `p`-th percentile of `values`, nearest-rank method."""
+    values = sorted(values)
+    if not values:
+        return None
+
+    rank = int(math.ceil(p / 100.0 * len(values)))
+    return values[max(rank, 1) - 1]
+
+def summarize(entries, group_by=GROUP_BY, percentiles=PERCENTILES):
+    """Group the given deployments and return one dictionary per group,
+    sorted by the values of the `group_by` fields. Each dictionary has these
+    fields, plus 'launches', 'failed', and 'running' and 'ssh': the given
+    percentiles of the times of successful deployments.
+
+    eg: summarize(entries)[0]['ssh'][90] -> 52.3"""
+    groups = {}
+    for launch in entries:
+        key = tuple(launch.get(field) for field in group_by)
+        groups.setdefault(key, []).append(launch)
+
+    summary = []
+    for key in sorted(groups, key=lambda key: [ str(value) for value in key ]):
+        group = groups[key]
+        succeeded = [ launch for launch in group if not launch.get('error') ]
+
+        row = OrderedDict(zip(group_by, key))
+        row['launches'] = len(group)
+        row['failed'] = len(group) - len(succeeded)
+
+        for what in 'running', 'ssh':
+            values = [ launch[what] for launch in succeeded
+                if launch.get(what) is not None ]
+            row[what] = OrderedDict((p, percentile(values, p))
+                for p in percentiles)
+
+        summary.append(row)
+
+    return summary
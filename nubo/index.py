@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+
+"""
+    nubo.index
+    ==========
+
+    Search VM images by keyword without scanning the whole list of images.
+
+    :copyright: (C) 2013 by Emanuele Rocca.
+"""
+
+import re
+
+from bisect import bisect_left, insort
+
+TOKEN_RE = re.compile(r'[a-z0-9]+')
+
+# Something like 20130411
+DATE_RE = re.compile(r'(?:19|20)\d{6}')
+
+# Score of a query term matching a whole token or only its beginning
+EXACT_MATCH = 2
+PREFIX_MATCH = 1
+
+def tokenize(text):
+    """Split `text` into lowercase alphanumeric tokens.
+
+    eg: tokenize('ubuntu-precise-12.04') -> ['ubuntu', 'precise', '12', '04']
+    """
+    if not isinstance(text, basestring):
+        text = str(text or '')
+
+    return TOKEN_RE.findall(text.lower())
+
+def recency(name):
+    """Return a key sorting newer images first when sorted in descending
+    order. Images do not come with a creation date, hence we use dates and
+    version numbers found in their names.
+
+    eg: recency('Ubuntu 12.04 x64') > recency('Ubuntu 10.04 x64')
+    """
+    dates = DATE_RE.findall(name or '')
+    numbers = tuple(int(token) for token in tokenize(name) if token.isdigit())
+    return max(dates or [ '' ]), numbers
+
+class ImageIndex(object):
+    """Inverted index mapping tokens found in image ids and names to images.
+
+    Queries are made of one or more terms, all of which have to match.
+    A term matches a token if it is equal to the token or a prefix of it.
+    Results are ranked by relevance first, then by recency.
+
+    eg: index.search('ubuntu 12.04') -> [ ('2676', 'Ubuntu 12.04 x64'), ... ]
+    """
+
+    def __init__(self):
+        # image id -> (name, tokens, recency)
+        self.images = {}
+
+        # token -> set of image ids
+        self.postings = {}
+
+        # All tokens, sorted, for prefix queries
+        self.tokens = []
+
+        # Opaque value identifying the list of images the index is built
+        # from, see `BaseCloud.image_index`
+        self.version = None
+
+    def add(self, image_id, name):
+        tokens = set(tokenize(image_id) + tokenize(name))
+        self.images[image_id] = (name, tokens, recency(name))
+
+        for token in tokens:
+            if token not in self.postings:
+                self.postings[token] = set()
+                insort(self.tokens, token)
+
+            self.postings[token].add(image_id)
+
+    def remove(self, image_id):
+        _, tokens, _ = self.images.pop(image_id)
+
+        for token in tokens:
+            self.postings[token].discard(image_id)
+
+            if not self.postings[token]:
+                del self.postings[token]
+                del self.tokens[bisect_left(self.tokens, token)]
+
+    def update(self, images):
+        """Make the index reflect the given list of (id, name) tuples,
+        indexing only what changed. Return True if anything changed."""
+        current = dict(images)
+        changed = False
+
+        for image_id, (name, _, _) in self.images.items():
+            if image_id not in current or current[image_id] != name:
+                self.remove(image_id)
+                changed = True
+
+        for image_id, name in current.iteritems():
+            if image_id not in self.images:
+                self.add(image_id, name)
+                changed = True
+
+        return changed
+
+    def __matches(self, term):
+        """Return a dictionary mapping the ids of the images matching `term`
+        to their score."""
+        matches = {}
+
+        idx = bisect_left(self.tokens, term)
+        while idx < len(self.tokens) and self.tokens[idx].startswith(term):
+            token = self.tokens[idx]
+            score = token == term and EXACT_MATCH or PREFIX_MATCH
+
+            for image_id in self.postings[token]:
+                matches[image_id] = max(score, matches.get(image_id, 0))
+
+            idx += 1
+
+        return matches
+
+    def search(self, query, limit=None):
+        """Return a ranked list of (id, name) tuples of the images matching
+        all terms in `query`."""
+        scores = None
+
+        for term in tokenize(query):
+            matches = self.__matches(term)
+
+            if scores is None:
+                scores = matches
+            else:
+                scores = dict((image_id, score + matches[image_id])
+                    for image_id, score in scores.iteritems()
+                    if image_id in matches)
+
+            if not scores:
+                return []
+
+        if scores is None:
+            return []
+
+        ranked = sorted(scores, key=lambda image_id:
+            (scores[image_id], self.images[image_id][2]), reverse=True)
+
+        return [ (image_id, self.images[image_id][0])
+            for image_id in ranked[:limit] ]
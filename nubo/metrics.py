@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+
+"""
+    nubo.metrics
+    ============
+
+    Count the calls made to libcloud drivers and how long they take, per
+    provider and per method.
+
+    eg: metrics.export_at_exit('/tmp/nubo.prom')
+
+    :copyright: (C) 2013 by Emanuele Rocca.
+"""
+
+import re
+import json
+import atexit
+import threading
+
+from bisect import bisect_left
+
+from nubo.events import monotonic
+
+# Upper bounds of the latency histogram buckets, in seconds
+BUCKETS = ( 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60 )
+
+# libcloud has no exception for rate limiting: providers say it in their
+# own words (eg: EC2 RequestLimitExceeded, Rackspace OverLimit, HTTP 429)
+THROTTLE_RE = re.compile(r'throttl|rate.?limit|limit.?exceeded|overlimit|'
+                         r'too many requests|\b429\b', re.IGNORECASE)
+
+OK = 'ok'
+ERROR = 'error'
+THROTTLED = 'throttled'
+
+def is_throttled(exception):
+    """Return True if `exception` tells us to slow down."""
+    return bool(THROTTLE_RE.search('%s %s' % (
+        exception.__class__.__name__, exception)))
+
+class Histogram(object):
+    """Distribution of durations, Prometheus style: the number of durations
+    lower than or equal to each bucket bound, their sum and count."""
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [ 0 ] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        self.counts[bisect_left(self.buckets, seconds)] += 1
+        self.sum += seconds
+        self.count += 1
+
+    def cumulative(self):
+        """Return a list of (bound, count) tuples, the last bound being
+        '+Inf'."""
+        total, result = 0, []
+        for bound, count in zip(self.buckets + ( '+Inf', ), self.counts):
+            total += count
+            result.append((bound, total))
+
+        return result
+
+class DriverMetrics(object):
+    """Thread-safe registry of driver calls, keyed by provider and method.
+
+    eg: DriverMetrics().record('EC2_EU_WEST', 'list_nodes', 0.8, 'ok')
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+
+        # (provider, method) -> Histogram
+        self.latencies = {}
+
+        # (provider, method, outcome) -> count
+        self.calls = {}
+
+    def record(self, provider, method, seconds, outcome=OK):
+        with self.lock:
+            histogram = self.latencies.get((provider, method))
+            if histogram is None:
+                histogram = self.latencies[provider, method] = Histogram()
+
+            histogram.observe(seconds)
+
+            key = (provider, method, outcome)
+            self.calls[key] = self.calls.get(key, 0) + 1
+
+    def clear(self):
+        with self.lock:
+            self.latencies.clear()
+            self.calls.clear()
+
+    def count(self, provider=None, method=None, outcome=None):
+        """Return the number of calls matching the given criteria, None
+        matching anything."""
+        wanted = (provider, method, outcome)
+
+        with self.lock:
+            return sum(count for key, count in self.calls.iteritems()
+                if all(value is None or value == actual
+                    for value, actual in zip(wanted, key)))
+
+    def as_dict(self):
+        """Return all metrics as a dictionary, suitable for JSON."""
+        result = {}
+
+        with self.lock:
+            for (provider, method), histogram in self.latencies.items():
+                result.setdefault(provider, {})[method] = {
+                    'calls': dict((outcome, count) for (p, m, outcome), count
+                        in self.calls.iteritems()
+                        if (p, m) == (provider, method)),
+                    'seconds': histogram.sum,
+                    'buckets': [ [ str(bound), count ] for bound, count
+                        in histogram.cumulative() ],
+                }
+
+        return result
+
+    def prometheus(self):
+        """Return all metrics in the Prometheus text exposition format."""
+        lines = [
+            '# HELP nubo_driver_calls_total Calls to libcloud drivers.',
+            '# TYPE nubo_driver_calls_total counter',
+        ]
+
+        with self.lock:
+            for (provider, method, outcome), count in sorted(
+                    self.calls.items()):
+                lines.append('nubo_driver_calls_total{provider="%s",'
+                    'method="%s",outcome="%s"} %d' % (provider, method,
+                    outcome, count))
+
+            lines += [
+                '# HELP nubo_driver_call_seconds Latency of libcloud driver '
+                'calls.',
+                '# TYPE nubo_driver_call_seconds histogram',
+            ]
+
+            for (provider, method), histogram in sorted(
+                    self.latencies.items()):
+                labels = 'provider="%s",method="%s"' % (provider, method)
+
+                for bound, count in histogram.cumulative():
+                    lines.append('nubo_driver_call_seconds_bucket{%s,'
+                        'le="%s"} %d' % (labels, bound, count))
+
+                lines.append('nubo_driver_call_seconds_sum{%s} %f' % (
+                    labels, histogram.sum))
+                lines.append('nubo_driver_call_seconds_count{%s} %d' % (
+                    labels, histogram.count))
+
+        return '\n'.join(lines) + '\n'
+
+    def export(self, path):
+        """Write all metrics to `path`: in the Prometheus text format if its
+        name ends with '.prom', as JSON otherwise."""
+        if path.endswith('.prom'):
+            data = self.prometheus()
+        else:
+            data = json.dumps(self.as_dict(), indent=4, sort_keys=True)
+
+        with open(path, 'w') as output:
+            output.write(data)
+
+    def export_at_exit(self, path):
+        atexit.register(self.export, path)
+
+# Shared by all the drivers instantiated by nubo
+registry = DriverMetrics()
+
+export_at_exit = registry.export_at_exit
+
+class InstrumentedDriver(object):
+    """Proxy to a libcloud driver, recording the outcome and duration of
+    each method call in a DriverMetrics registry.
+
+    eg: InstrumentedDriver(driver, 'EC2_EU_WEST').list_nodes() -> list
+    """
+
+    def __init__(self, driver, provider, metrics=None):
+        self.wrapped = driver
+        self.provider = provider
+        self.metrics = metrics or registry
+
+    def __getattr__(self, name):
+        attribute = getattr(self.wrapped, name)
+        if name.startswith('_') or not callable(attribute):
+            return attribute
+
+        def call(*args, **kwargs):
+            start = monotonic()
+            outcome = OK
+            try:
+                return attribute(*args, **kwargs)
+            except Exception, e:
+                outcome = is_throttled(e) and THROTTLED or ERROR
+                raise
+            finally:
+                self.metrics.record(self.provider, name,
+                    monotonic() - start, outcome)
+
+        call.__name__ = name
+        return call
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+
+"""
+    nubo.parallel
+    =============
+
+    Run blocking calls (cloud API requests, SSH commands) concurrently on a
+    bounded pool of threads.
+
+    :copyright: (C) 2013 by Emanuele Rocca.
+"""
+
+from multiprocessing.pool import ThreadPool
+
+# Default maximum number of concurrent calls
+MAX_PARALLEL = 10
+
+# AsyncResult.get() without a timeout cannot be interrupted with CTRL-C on
+# Python 2. Waiting with a (very long) timeout can.
+FOREVER = 60 * 60 * 24 * 365
+
+def parallel_map(function, items, parallel=None):
+    """Call `function` on each item using at most `parallel` threads.
+
+    Results are returned in the same order as `items`. Exceptions raised by
+    `function` are propagated, hence functions which should not stop the
+    whole batch have to catch their own errors.
+
+    eg: parallel_map(cloud.reboot, ['1', '2'], parallel=2) -> [True, True]
+    """
+    items = list(items)
+    if not items:
+        return []
+
+    pool = ThreadPool(min(parallel or MAX_PARALLEL, len(items)))
+    try:
+        return pool.map_async(function, items, chunksize=1).get(FOREVER)
+    finally:
+        pool.close()
+        pool.join()
+
+def parallel_imap(function, items, parallel=None):
+    """Like `parallel_map`, but yield results as soon as they are available
+    instead of waiting for the whole batch. Results are yielded in completion
+    order.
+
+    Closing the generator (eg: breaking out of a for loop) prevents pending
+    items from being started."""
+    items = list(items)
+    if not items:
+        return
+
+    pool = ThreadPool(min(parallel or MAX_PARALLEL, len(items)))
+    try:
+        results = pool.imap_unordered(function, items)
+        for _ in items:
+            yield results.next(FOREVER)
+    finally:
+        pool.terminate()
+        pool.join()
@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+
+"""
+    nubo.poller
+    ===========
+
+    Wait for many nodes to reach a given state sharing the same API calls.
+
+    Waits are bounded by a deadline. Checks are frequent around the time a
+    node is expected to be ready and exponentially sparser otherwise, with
+    random jitter so that processes started together do not poll together.
+
+    :copyright: (C) 2013 by Emanuele Rocca.
+"""
+
+import time
+import random
+import logging
+import threading
+
+from nubo.events import monotonic
+from nubo.metrics import is_throttled
+
+# Nodes in one of these states are not going to become RUNNING
+TERMINAL_STATES = ( 'TERMINATED', )
+
+# Upper bound of the delay between two polls while being rate limited
+MAX_THROTTLED_INTERVAL = 60
+
+class Backoff(object):
+    """Delays between the checks of something expected to be ready
+    `expected` seconds from now.
+
+    Before the expected time, each delay is half the time left until then.
+    Afterwards, delays start at `interval` and grow by `factor` after each
+    check. They never exceed `max_interval`, and are randomly shortened by
+    up to `jitter` (a fraction of the delay).
+
+    eg: Backoff(expected=30, interval=1, max_interval=15).delay() -> float
+    """
+
+    def __init__(self, expected=0, interval=1, max_interval=None, factor=1.5,
+                 jitter=0.25):
+        self.expected = expected
+        self.interval = interval
+        self.max_interval = max_interval or interval * 10
+        self.factor = factor
+        self.jitter = jitter
+
+        self.start = monotonic()
+
+        # Checks performed since the expected time
+        self.late = 0
+
+    def delay(self):
+        """Return the number of seconds to wait before the next check."""
+        early = self.expected - (monotonic() - self.start)
+
+        if early > self.interval:
+            delay = early / 2
+        else:
+            delay = self.interval * self.factor ** self.late
+            self.late += 1
+
+        delay = max(min(delay, self.max_interval), self.interval)
+        return delay * (1 - self.jitter * random.random())
+
+    def sleep(self, deadline, since=None):
+        """Sleep until the next check, counting the time elapsed `since` the
+        previous one, without going past `deadline` (see
+        `nubo.events.monotonic`)."""
+        now = monotonic()
+        if since is None:
+            since = now
+
+        delay = self.delay() - (now - since)
+        time.sleep(max(min(delay, deadline - now), 0))
+
+class NodePoller(object):
+    """Keep track of node states on behalf of any number of waiters.
+
+    Node states are fetched with `list_nodes` at most once every `interval`
+    seconds, no matter how many nodes are being waited on. There is no
+    background thread: one of the waiting threads performs the API call and
+    shares its result with all the others.
+
+    When the provider says we are calling it too often, polls are delayed
+    twice as long after each such response, until a poll succeeds.
+
+    eg: NodePoller(cloud.list_nodes).wait('i-bb6c3b88', 300) -> dict
+    """
+
+    def __init__(self, list_nodes, interval=1):
+        self.list_nodes = list_nodes
+        self.interval = interval
+
+        self.cond = threading.Condition()
+
+        # Node states as returned by the last list_nodes call
+        self.snapshot = {}
+
+        # Incremented each time a new snapshot is available
+        self.tick = 0
+
+        self.polling = False
+        self.last_poll = None
+
+        # Seconds between polls imposed by rate limiting, if any
+        self.throttled = 0
+
+    def gap(self):
+        """Return the minimum number of seconds between two polls."""
+        return max(self.interval, self.throttled)
+
+    def due(self):
+        """Return True if nobody is polling and enough time elapsed since
+        the last poll to poll again."""
+        with self.cond:
+            return not self.polling and (self.last_poll is None or
+                monotonic() >= self.last_poll + self.gap())
+
+    def poll(self):
+        """Fetch the state of all nodes and wake up the waiters. Errors due
+        to rate limiting are not raised: they delay the next polls."""
+        nodes = None
+        throttled = False
+        try:
+            nodes = self.list_nodes()
+        except Exception, e:
+            if not is_throttled(e):
+                raise
+
+            logging.info("Rate limited while listing nodes: %s" % e)
+            throttled = True
+        finally:
+            with self.cond:
+                self.polling = False
+                self.last_poll = monotonic()
+
+                if throttled:
+                    self.throttled = min(max(self.throttled * 2,
+                        self.interval * 2), MAX_THROTTLED_INTERVAL)
+                elif nodes is not None:
+                    self.snapshot = dict((node['id'], node) for node in nodes)
+                    self.tick += 1
+                    self.throttled = 0
+
+                self.cond.notify_all()
+
+    def __next_snapshot(self, seen, deadline):
+        """Block until a snapshot newer than `seen` is available. Poll the
+        cloud if it is our turn to do so. Return (tick, snapshot), or (seen,
+        None) if there is no new snapshot by `deadline`."""
+        with self.cond:
+            while self.tick <= seen:
+                if self.polling:
+                    # Somebody else is calling list_nodes
+                    delay = self.gap()
+                elif self.last_poll is not None:
+                    delay = self.last_poll + self.gap() - monotonic()
+                else:
+                    delay = 0
+
+                if delay <= 0 and not self.polling:
+                    self.polling = True
+                    break
+
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    return seen, None
+
+                self.cond.wait(min(delay, remaining))
+            else:
+                return self.tick, self.snapshot
+
+        # Our turn to poll
+        self.poll()
+        return self.__next_snapshot(seen, deadline)
+
+    def wait(self, node_id, timeout, backoff=None, on_attempt=None):
+        """Wait at most `timeout` seconds for the given node to be RUNNING,
+        checking its state as scheduled by `backoff` (see `Backoff`) and
+        calling `on_attempt()` after each check.
+
+        Return the node as a dictionary, or None if the node reached a
+        terminal state or if we ran out of time."""
+        deadline = monotonic() + timeout
+        backoff = backoff or Backoff(interval=self.interval)
+
+        with self.cond:
+            seen = self.tick
+
+        while True:
+            checked = monotonic()
+            seen, snapshot = self.__next_snapshot(seen, deadline)
+            if snapshot is None:
+                break
+
+            node = snapshot.get(node_id)
+
+            if on_attempt is not None:
+                on_attempt()
+
+            if node is not None:
+                if node['state'] == "RUNNING":
+                    return node
+
+                if node['state'] in TERMINAL_STATES:
+                    logging.info("%s is %s, giving up" % (
+                        node_id, node['state']))
+                    return
+
+                logging.info("%.0f seconds left on %s: %s != RUNNING" % (
+                    deadline - monotonic(), node_id, node['state']))
+
+            if monotonic() >= deadline:
+                break
+
+            backoff.sleep(deadline, since=checked)
+
+        logging.info("Timed out waiting for %s after %s seconds" % (
+            node_id, timeout))
+
+class PollerRegistry(object):
+    """Process-wide registry of NodePollers, so that the cloud objects of the
+    same account share the states of its nodes and the calls fetching them,
+    eg: concurrent `nubo start` commands run by `nubo serve`.
+
+    eg: registry.get(key, lambda: NodePoller(cloud.list_nodes))
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pollers = {}
+
+    def get(self, key, factory):
+        """Return the poller known as `key`, calling `factory()` to create
+        it if needed."""
+        with self.lock:
+            poller = self.pollers.get(key)
+            if poller is None:
+                poller = self.pollers[key] = factory()
+
+            return poller
+
+    def clear(self):
+        """Forget all pollers."""
+        with self.lock:
+            self.pollers.clear()
+
+# Shared by all BaseCloud objects
+registry = PollerRegistry()
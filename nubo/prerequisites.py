@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+
+"""
+    nubo.prerequisites
+    ==================
+
+    Remember the resources which have to exist on a cloud account before
+    deploying nodes, such as uploaded SSH keys and security groups. They
+    seldom change once created, while looking them up takes one or more API
+    calls per deployment.
+
+    eg: PrerequisiteCache('EC2_EU_WEST', account).get('keypair', resolve)
+
+    :copyright: (C) 2013 by Emanuele Rocca.
+"""
+
+import os
+import re
+import errno
+import hashlib
+
+from nubo import cache
+from nubo.config import locked
+
+# Errors returned by providers when a prerequisite given to create_node
+# does not exist, and the name it is cached as
+MISSING_ERRORS = (
+    ('keypair', re.compile(r'\bInvalidKeyPair\.NotFound\b')),
+    ('security_group', re.compile(r'\bInvalidGroup\.NotFound\b')),
+    ('ssh_key', re.compile(r'\bssh[ _]?key\b.*\b(not found|does not exist)\b'
+                           r'|\bunknown ssh[ _]?key\b', re.IGNORECASE)),
+)
+
+def missing(exception):
+    """Return the name of the prerequisite which `exception` says does not
+    exist (eg: 'keypair'), or None.
+
+    eg: missing(Exception('InvalidGroup.NotFound: ...')) -> 'security_group'
+    """
+    message = '%s %s' % (exception.__class__.__name__, exception)
+    for name, regex in MISSING_ERRORS:
+        if regex.search(message):
+            return name
+
+def account(provider_name, params, ssh_key_name=None):
+    """Return a string identifying a cloud account, and SSH key if given,
+    from the parameters of its driver (ie: credentials). Credentials are
+    hashed: the result is used in file names."""
+    key = hashlib.md5(provider_name)
+    for name, value in sorted(params.items()):
+        key.update('\0%s=%r' % (name, value))
+
+    if ssh_key_name is not None:
+        key.update('\0' + ssh_key_name)
+
+    return key.hexdigest()
+
+class MissingPrerequisite(Exception):
+    """Raised by `BaseCloud.startup` when the provider does not know a
+    resource given to create_node, which might have been deleted after
+    being cached. `error` and `traceback` are those of the provider's
+    exception."""
+
+    def __init__(self, name, error, traceback=None):
+        Exception.__init__(self, "Missing %s: %s" % (name, error))
+        self.name = name
+        self.error = error
+        self.traceback = traceback
+
+class PrerequisiteCache(object):
+    """Identifiers of the prerequisites of a cloud account, stored on disk
+    next to its catalogs (see `nubo.cache.CatalogCache`). They do not expire:
+    they are resolved again when invalidated.
+
+    Only one caller at a time, in any process, resolves a given missing
+    prerequisite. Others wait for it and use its result: when launches
+    race, resources are created once.
+
+    eg: PrerequisiteCache('DIGITAL_OCEAN', account).get('ssh_key', upload)
+    """
+
+    def __init__(self, provider_name, account, directory=None):
+        self.catalog = cache.CatalogCache(provider_name, directory=directory)
+        self.account = account
+
+    def kind(self, name):
+        return 'prerequisite-%s-%s' % (self.account, name)
+
+    def load(self, name):
+        cached = self.catalog.load(self.kind(name))
+        if cached is not None:
+            return cached[1]
+
+    def get(self, name, resolve):
+        """Return the identifier of the prerequisite `name`, calling
+        `resolve()` to find or create it if unknown. None is not cached."""
+        value = self.load(name)
+        if value is not None:
+            return value
+
+        try:
+            os.makedirs(self.catalog.directory, 0700)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        with locked(self.catalog.path(self.kind(name))):
+            # Resolved by someone else while we were waiting
+            value = self.load(name)
+            if value is not None:
+                return value
+
+            value = resolve()
+            if value is not None:
+                self.catalog.store(self.kind(name), value)
+
+            return value
+
+    def invalidate(self, name=None):
+        """Forget the given prerequisite, or all of them."""
+        names = [ name ]
+        if name is None:
+            prefix = self.kind('')
+            try:
+                names = [ filename[len(prefix):] for filename
+                    in os.listdir(self.catalog.directory)
+                    if filename.startswith(prefix)
+                        and not filename.endswith('.lock') ]
+            except OSError:
+                names = []
+
+        for name in names:
+            try:
+                os.unlink(self.catalog.path(self.kind(name)))
+            except OSError:
+                pass
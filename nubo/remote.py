@@ -9,28 +9,726 @@
     :copyright: (C) 2013 by Emanuele Rocca.
 """
 
+import os
+import math
+import mmap
+import time
+import errno
+import atexit
+import select
+import socket
+import threading
+
+from collections import OrderedDict, namedtuple
+from contextlib import contextmanager
+
 import paramiko
 
-ssh = paramiko.SSHClient()
-ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+from nubo.parallel import parallel_imap
+
+SSH_PORT = 22
+
+# Give up on hosts sending garbage instead of an SSH banner
+MAX_BANNER_SIZE = 4096
+
+# Maximum amount of command output read at once
+CHUNK_SIZE = 32 * 1024
+
+# Lines longer than this are split when streaming command output line by line
+MAX_LINE_SIZE = 64 * 1024
+
+# SSH channel window. Paramiko's default (64K) limits throughput on links
+# with high latency, in particular for file transfers.
+WINDOW_SIZE = 4 * 1024 * 1024
+
+# Size of the SFTP writes and reads
+SFTP_CHUNK_SIZE = 32 * 1024
+
+# Timers closing idle connections, see `SSHConnectionPool.evict`. They are
+# stopped on exit: threads still sleeping while Python shuts down fail.
+idle_timers = set()
+
+def cancel_idle_timers():
+    for timer in list(idle_timers):
+        timer.cancel()
+        timer.join()
+
+atexit.register(cancel_idle_timers)
+
+def wait_for_io(readers, writers, timeout=None):
+    """Like select.select, without the FD_SETSIZE limit (usually 1024) on
+    file descriptor numbers where poll(2) is available: processes handling
+    many nodes easily have that many files open.
+
+    Return the lists of readable and writable objects."""
+    if not hasattr(select, 'poll'):
+        return select.select(readers, writers, [], timeout)[:2]
+
+    poller = select.poll()
+    masks, reading, writing = {}, {}, {}
+
+    for obj in readers:
+        reading[obj.fileno()] = obj
+        masks[obj.fileno()] = masks.get(obj.fileno(), 0) | select.POLLIN
+
+    for obj in writers:
+        writing[obj.fileno()] = obj
+        masks[obj.fileno()] = masks.get(obj.fileno(), 0) | select.POLLOUT
+
+    for fd, mask in masks.iteritems():
+        poller.register(fd, mask)
+
+    if timeout is None:
+        timeout = -1
+    else:
+        timeout = int(math.ceil(timeout * 1000))
+
+    readable, writable = [], []
+
+    for fd, event in poller.poll(timeout):
+        # Errors and hangups are reported by select as readiness
+        failed = event & (select.POLLERR | select.POLLHUP)
+
+        if fd in reading and (event & select.POLLIN or failed):
+            readable.append(reading[fd])
+
+        if fd in writing and (event & select.POLLOUT or failed):
+            writable.append(writing[fd])
+
+    return readable, writable
+
+class SSHProber(object):
+    """Check whether SSH servers are accepting connections, without going
+    through the SSH handshake. A host is considered ready as soon as it sends
+    its SSH protocol banner (eg: 'SSH-2.0-OpenSSH_6.0p1').
+
+    Any number of hosts is checked at the same time using non-blocking sockets
+    and a single thread.
+
+    eg: SSHProber(['198.199.72.211', '198.199.72.212']).probe() -> set
+    """
+
+    def __init__(self, hosts, port=SSH_PORT):
+        self.port = port
+        self.pending = set(hosts)
+        self.ready = set()
+
+    def __connect(self, host):
+        """Start a non-blocking connection to `host`. Return the socket, or
+        None if the connection failed right away."""
+        try:
+            family, socktype, proto, _, address = socket.getaddrinfo(
+                host, self.port, 0, socket.SOCK_STREAM)[0]
+        except socket.error:
+            return
+
+        sock = socket.socket(family, socktype, proto)
+        sock.setblocking(0)
+
+        if sock.connect_ex(address) in (0, errno.EINPROGRESS, 
+                                        errno.EWOULDBLOCK):
+            return sock
+
+        sock.close()
+
+    def probe(self, timeout=1):
+        """Connect once to each host which is not ready yet and wait at most
+        `timeout` seconds for their SSH banners.
+
+        Return the set of hosts found ready so far."""
+        deadline = time.time() + timeout
+
+        # socket -> host
+        connecting, reading = {}, {}
+        # socket -> data received so far
+        banners = {}
+
+        for host in self.pending:
+            sock = self.__connect(host)
+            if sock is not None:
+                connecting[sock] = host
+
+        try:
+            while connecting or reading:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+
+                readable, writable = wait_for_io(
+                    reading.keys(), connecting.keys(), remaining)
+
+                for sock in writable:
+                    host = connecting.pop(sock)
+                    if sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR):
+                        # Connection refused, host unreachable, ...
+                        sock.close()
+                        continue
+
+                    reading[sock] = host
+                    banners[sock] = ''
+
+                for sock in readable:
+                    try:
+                        data = sock.recv(MAX_BANNER_SIZE)
+                    except socket.error:
+                        data = ''
+
+                    banners[sock] += data
+
+                    if 'SSH-' in banners[sock]:
+                        self.pending.discard(reading[sock])
+                        self.ready.add(reading[sock])
+                    elif data and len(banners[sock]) < MAX_BANNER_SIZE:
+                        # Keep on reading
+                        continue
+
+                    del reading[sock]
+                    sock.close()
+        finally:
+            for sock in connecting.keys() + reading.keys():
+                sock.close()
+
+        # Do not let callers retry connecting faster than once per `timeout`
+        remaining = deadline - time.time()
+        if self.pending and remaining > 0:
+            time.sleep(remaining)
+
+        return set(self.ready)
+
+def wait_for_banners(hosts, timeout, port=SSH_PORT):
+    """Wait up to `timeout` seconds for the given hosts to send their SSH
+    banners. Return the set of hosts which did."""
+    prober = SSHProber(hosts, port)
+    deadline = time.time() + timeout
+
+    while prober.pending:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            break
+
+        prober.probe(min(remaining, 1))
+
+    return prober.ready
+
+class SSHConnectionPool(object):
+    """Thread-safe pool of authenticated SSH connections, keyed by host, user,
+    private key and whether compression is enabled.
+
+    Connections are kept alive with SSH keepalives and reused across
+    commands. When more than `max_size` connections are open, or when a
+    connection has not been used for `idle_timeout` seconds, it is closed.
+    Connections in use are never closed by the pool. Idle connections are
+    closed by a timer even if the pool is not used anymore (eg: by nubo
+    serve).
+
+    eg: with pool.connection('198.199.72.211', 'root', key) as ssh: ...
+    """
+
+    def __init__(self, max_size=64, idle_timeout=300, keepalive=30,
+                 connect_timeout=30, port=SSH_PORT):
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.keepalive = keepalive
+        self.connect_timeout = connect_timeout
+        self.port = port
+
+        self.lock = threading.Lock()
+
+        # (host, user, private_key, compress) -> [ client, last used, users ]
+        # Least recently used connections first.
+        self.connections = OrderedDict()
+
+        # Closes idle connections once they expire, see `evict`
+        self.timer = None
+
+    def connect(self, host, user, private_key, compress=False):
+        """Return a new SSHClient connected to the given host."""
+        client = paramiko.SSHClient()
+        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        client.connect(host, port=self.port, username=user,
+            key_filename=private_key, timeout=self.connect_timeout,
+            compress=compress)
+
+        transport = client.get_transport()
+        transport.set_keepalive(self.keepalive)
+        transport.window_size = WINDOW_SIZE
+        return client
+
+    def is_healthy(self, client):
+        transport = client.get_transport()
+        return transport is not None and transport.is_active()
+
+    def acquire(self, host, user, private_key, compress=False):
+        """Return a connected SSHClient, opening a new connection only if
+        there is no healthy one in the pool. Paramiko multiplexes commands
+        over the same connection, hence connections can be used by multiple
+        threads at once. Each call must be followed by a call to `release`."""
+        key = (host, user, private_key, compress)
+
+        with self.lock:
+            entry = self.connections.pop(key, None)
+            if entry is not None and self.is_healthy(entry[0]):
+                entry[2] += 1
+                self.connections[key] = entry
+                return entry[0]
+
+        if entry is not None:
+            entry[0].close()
+
+        client = self.connect(host, user, private_key, compress)
+
+        with self.lock:
+            other = self.connections.pop(key, None)
+            if other is not None and self.is_healthy(other[0]):
+                # Another thread connected in the meantime, use its client
+                other[2] += 1
+                self.connections[key] = other
+                client, surplus = other[0], client
+            else:
+                self.connections[key] = [ client, time.time(), 1 ]
+                surplus = other and other[0]
+
+        if surplus:
+            surplus.close()
+
+        self.evict()
+        return client
+
+    def release(self, host, user, private_key, compress=False):
+        """Signal that a client obtained with `acquire` is not in use
+        anymore."""
+        with self.lock:
+            entry = self.connections.get((host, user, private_key, compress))
+            if entry is not None:
+                entry[1] = time.time()
+                entry[2] = max(0, entry[2] - 1)
+
+        self.evict()
+
+    @contextmanager
+    def connection(self, host, user, private_key, compress=False):
+        client = self.acquire(host, user, private_key, compress)
+        try:
+            yield client
+        finally:
+            self.release(host, user, private_key, compress)
+
+    def evict(self):
+        """Close idle connections, as well as the least recently used ones
+        if the pool is full."""
+        expired = []
+        now = time.time()
+
+        with self.lock:
+            idle = [ key for key, (client, last_used, users) 
+                in self.connections.items() if not users ]
+
+            for key in idle:
+                too_many = len(self.connections) > self.max_size
+                if too_many or now - self.connections[key][1] > \
+                        self.idle_timeout:
+                    expired.append(self.connections.pop(key)[0])
+
+            self.__schedule(now)
+
+        for client in expired:
+            client.close()
+
+    def __schedule(self, now):
+        """Make sure `evict` is called when the next idle connection
+        expires. Call holding self.lock"""
+        if self.timer is not None:
+            return
+
+        expiries = [ last_used + self.idle_timeout for client, last_used, 
+            users in self.connections.values() if not users ]
+        if not expiries:
+            return
+
+        def expire():
+            with self.lock:
+                self.timer = None
+
+            idle_timers.discard(timer)
+            self.evict()
+
+        # A little late: connections idle for exactly idle_timeout are kept
+        timer = self.timer = threading.Timer(
+            max(min(expiries) - now, 0) + 0.01, expire)
+        timer.daemon = True
+        idle_timers.add(timer)
+        timer.start()
+
+    def discard(self, host, user, private_key):
+        """Close the connections to the given host."""
+        with self.lock:
+            entries = [ self.connections.pop((host, user, private_key, 
+                compress), None) for compress in False, True ]
+
+        for entry in entries:
+            if entry is not None:
+                entry[0].close()
+
+    def close(self):
+        """Close all connections."""
+        with self.lock:
+            clients = [ entry[0] for entry in self.connections.values() ]
+            self.connections.clear()
+
+            timer, self.timer = self.timer, None
+
+        if timer is not None:
+            idle_timers.discard(timer)
+            timer.cancel()
+
+        for client in clients:
+            client.close()
+
+# Default pool, shared by all RemoteHost objects
+connections = SSHConnectionPool()
+atexit.register(connections.close)
+
+class CommandResult(namedtuple('CommandResult', 
+                               'host stdout stderr status error')):
+    """Outcome of a command executed on a remote host. `status` is the exit
+    status of the command, `error` the exception raised while trying to run
+    it (if any)."""
+
+    @property
+    def ok(self):
+        return self.error is None and self.status == 0
+
+class TransferResult(namedtuple('TransferResult', 
+                                'host size seconds error')):
+    """Outcome of a file transfer from or to a remote host. `size` is the
+    number of bytes transferred."""
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    @property
+    def rate(self):
+        """Throughput in bytes per second"""
+        if self.seconds:
+            return self.size / self.seconds
+
+        return 0
+
+def map_file(localpath):
+    """Map the given local file in memory, read-only. The same mapping can be
+    shared by uploads to different hosts."""
+    with open(localpath, 'rb') as local:
+        size = os.fstat(local.fileno()).st_size
+
+        if not size:
+            # Empty files cannot be mapped
+            return ''
+
+        return mmap.mmap(local.fileno(), size, access=mmap.ACCESS_READ)
+
+class CommandStream(object):
+    """Output of a command running on a remote host, made available as soon
+    as it is produced.
+
+    Iterating over a CommandStream yields ('stdout', data) and ('stderr',
+    data) tuples, reading from both channels at the same time. Once the
+    iteration is over, `status` holds the exit status of the command.
+
+    `timeout` bounds the time spent waiting for output, `deadline` the
+    running time of the whole command: commands producing output forever
+    never hit the former.
+
+    eg: for name, data in host.stream_command('apt-get update'): ...
+    """
+
+    def __init__(self, channel, timeout=None, on_close=None, deadline=None):
+        self.channel = channel
+        self.timeout = timeout
+        self.on_close = on_close
+        self.deadline = deadline
+        self.status = None
+
+    def __iter__(self):
+        channel = self.channel
+
+        end = None
+        if self.deadline is not None:
+            end = time.time() + self.deadline
+
+        try:
+            while True:
+                wait = self.timeout
+                if end is not None:
+                    remaining = end - time.time()
+                    if remaining <= 0:
+                        raise socket.timeout("Still running after %s seconds"
+                            % self.deadline)
+
+                    wait = min(remaining, wait or remaining)
+
+                if channel.recv_ready():
+                    yield 'stdout', channel.recv(CHUNK_SIZE)
+                    continue
+
+                if channel.recv_stderr_ready():
+                    yield 'stderr', channel.recv_stderr(CHUNK_SIZE)
+                    continue
+
+                if channel.exit_status_ready():
+                    # Output might have arrived along with the exit status,
+                    # after the checks above
+                    if channel.recv_ready() or channel.recv_stderr_ready():
+                        continue
+
+                    break
+
+                # Wait for output on either stdout or stderr
+                readable, _ = wait_for_io([ channel ], [], wait)
+
+                if not readable and wait == self.timeout:
+                    raise socket.timeout("No output for %s seconds" % 
+                        self.timeout)
+
+            self.status = channel.recv_exit_status()
+        finally:
+            self.close()
+
+    def lines(self):
+        """Like iterating over the stream, but yield whole lines."""
+        pending = { 'stdout': '', 'stderr': '' }
+
+        for name, data in self:
+            lines = (pending[name] + data).split('\n')
+            pending[name] = lines.pop()
+
+            for line in lines:
+                yield name, line + '\n'
+
+            if len(pending[name]) > MAX_LINE_SIZE:
+                yield name, pending[name]
+                pending[name] = ''
+
+        for name in 'stdout', 'stderr':
+            if pending[name]:
+                yield name, pending[name]
+
+    def close(self):
+        """Close the channel. Only needed if the stream is not consumed."""
+        self.channel.close()
+
+        if self.on_close is not None:
+            self.on_close()
+            self.on_close = None
 
 class RemoteHost(object):
-    def __init__(self, host, private_key):
+    def __init__(self, host, private_key, pool=None):
         self.host = host
         self.private_key = private_key
+        self.pool = pool or connections
+
+    def stream_command(self, command, user='root', timeout=None,
+                       deadline=None):
+        """Execute the given command as 'user' on the given host. If
+        `timeout` is given, give up after `timeout` seconds without output
+        raising socket.timeout. If `deadline` is given, give up after
+        `deadline` seconds in any case.
+
+        Return a CommandStream, which must be either consumed or closed.
+        """
+        ssh = self.pool.acquire(self.host, user, self.private_key)
+        release = lambda: self.pool.release(self.host, user, self.private_key)
+
+        try:
+            channel = ssh.get_transport().open_session()
+            channel.exec_command(command)
+        except:
+            release()
+            raise
+
+        return CommandStream(channel, timeout, on_close=release,
+            deadline=deadline)
+
+    def __execute(self, command, user, timeout, on_output=None,
+                  deadline=None):
+        output = { 'stdout': [], 'stderr': [] }
+
+        stream = self.stream_command(command, user, timeout, deadline)
+        if on_output is None:
+            for name, data in stream:
+                output[name].append(data)
+        else:
+            for name, line in stream.lines():
+                on_output(self.host, name, line)
+
+        return ''.join(output['stdout']), ''.join(output['stderr']), \
+            stream.status
 
-    def run_command(self, command, user='root'):
-        """Execute the given command as 'user' on the given host. 
+    def run_command(self, command, user='root', timeout=None):
+        """Execute the given command as 'user' on the given host. If
+        `timeout` is given, give up after `timeout` seconds without output
+        raising socket.timeout.
 
         Return stdout, stderr
         """
-        ssh.connect(self.host, username=user, key_filename=self.private_key)
-        _, stdout, stderr = ssh.exec_command(command)
-        return stdout.read(), stderr.read()
+        return self.__execute(command, user, timeout)[:2]
+
+    def run(self, command, user='root', timeout=None, on_output=None,
+            deadline=None):
+        """Like `run_command`, but return a CommandResult also carrying the
+        exit status. Errors are returned instead of being raised. Commands
+        running for more than `deadline` seconds fail with socket.timeout.
+
+        If `on_output` is given, it is called with the host, the stream name
+        ('stdout' or 'stderr') and the line for each line of output as soon as
+        it is available. The output is not kept in the CommandResult."""
+        try:
+            stdout, stderr, status = self.__execute(command, user, timeout,
+                on_output, deadline)
+            return CommandResult(self.host, stdout, stderr, status, None)
+        except Exception, e:
+            return CommandResult(self.host, '', '', None, e)
+
+    @contextmanager
+    def sftp(self, user='root', compress=False):
+        """SFTP session on a pooled connection to this host."""
+        with self.pool.connection(self.host, user, self.private_key, 
+                                  compress) as ssh:
+            sftp = paramiko.SFTPClient.from_transport(ssh.get_transport())
+            try:
+                yield sftp
+            finally:
+                sftp.close()
+
+    def upload(self, data, remotepath, user='root', compress=False):
+        """Write `data` (a string or a memory-mapped file) to `remotepath`.
+        Writes are pipelined: we do not wait for the server to acknowledge a
+        chunk before sending the next one.
+
+        Return a TransferResult."""
+        start = time.time()
+
+        with self.sftp(user, compress) as sftp:
+            remote = sftp.open(remotepath, 'wb')
+            try:
+                remote.set_pipelined(True)
+
+                for offset in xrange(0, len(data), SFTP_CHUNK_SIZE):
+                    remote.write(data[offset:offset + SFTP_CHUNK_SIZE])
+            finally:
+                remote.close()
+
+        return TransferResult(self.host, len(data), time.time() - start, None)
+
+    def put(self, localpath, remotepath, user='root', compress=False):
+        """Copy a local file to this host. Return a TransferResult."""
+        data = map_file(localpath)
+        try:
+            return self.upload(data, remotepath, user, compress)
+        finally:
+            if data:
+                data.close()
+
+    def get(self, remotepath, localpath, user='root', compress=False):
+        """Copy a file from this host to `localpath`. Reads are pipelined
+        using Paramiko's prefetching. Return a TransferResult."""
+        start = time.time()
+        size = 0
+
+        with self.sftp(user, compress) as sftp:
+            remote = sftp.open(remotepath, 'rb')
+            try:
+                remote.prefetch()
+
+                with open(localpath, 'wb') as local:
+                    while True:
+                        data = remote.read(SFTP_CHUNK_SIZE)
+                        if not data:
+                            break
+
+                        local.write(data)
+                        size += len(data)
+            finally:
+                remote.close()
+
+        return TransferResult(self.host, size, time.time() - start, None)
+
+    def close(self, user='root'):
+        """Close the pooled SSH connections to this host."""
+        self.pool.discard(self.host, user, self.private_key)
+
+    def ssh_ready(self, timeout=1):
+        """Return True if the host is accepting SSH connections. This is much
+        cheaper than trying to login, but does not guarantee that logging in
+        will work."""
+        return self.host in SSHProber([ self.host ], self.pool.port).probe(
+            timeout)
 
     def whoami(self, user='root'):
         return self.run_command("whoami", user)[0].rstrip('\n')
 
+class RemoteGroup(object):
+    """Execute commands on multiple hosts concurrently.
+
+    eg: RemoteGroup(['198.199.72.211', '198.199.72.212'], key).run('uptime')
+    """
+
+    def __init__(self, hosts, private_key, parallel=None, pool=None):
+        self.hosts = [ RemoteHost(host, private_key, pool) for host in hosts ]
+        self.parallel = parallel
+
+    def run(self, command, user='root', timeout=None, fail_fast=False,
+            on_output=None, deadline=None):
+        """Execute the given command as 'user' on all hosts, running at most
+        `self.parallel` commands at the same time. `on_output` and `deadline`
+        are passed to `RemoteHost.run`, the former is called by multiple
+        threads.
+
+        Yield a CommandResult per host as soon as the command terminates on
+        that host. With `fail_fast`, stop after the first failure: commands
+        already running are left to complete, the remaining ones are not
+        started."""
+        results = parallel_imap(
+            lambda host: host.run(command, user, timeout, on_output,
+                                  deadline),
+            self.hosts, self.parallel)
+
+        try:
+            for result in results:
+                yield result
+
+                if fail_fast and not result.ok:
+                    return
+        finally:
+            results.close()
+
+    def put(self, localpath, remotepath, user='root', compress=False):
+        """Copy a local file to all hosts, running at most `self.parallel`
+        uploads at the same time. The local file is read only once: all
+        uploads share the same memory mapping.
+
+        Yield a TransferResult per host as soon as the upload to that host is
+        over."""
+        data = map_file(localpath)
+
+        def upload(host):
+            start = time.time()
+            try:
+                return host.upload(data, remotepath, user, compress)
+            except Exception, e:
+                return TransferResult(host.host, 0, time.time() - start, e)
+
+        results = parallel_imap(upload, self.hosts, self.parallel)
+
+        try:
+            for result in results:
+                yield result
+        finally:
+            # Wait for running uploads before unmapping their data
+            results.close()
+            if data:
+                data.close()
+
 if __name__ == "__main__":
     host1 = RemoteHost('192.168.122.6', '/home/ema/.ssh/id_rsa')
     print host1.run_command('uptime')[0]
@@ -0,0 +1,285 @@
+# -*- coding: utf-8 -*-
+
+"""
+    nubo.standby
+    ============
+
+    Pools of pre-booted nodes, ready to accept SSH connections, handed out
+    in seconds instead of waiting for a new node to boot.
+
+    Pools are identified by provider, image and size. Their state is stored
+    in ~/.nubo-standby, shared by all nubo processes of the same user.
+    Standby nodes are named after their pool, so that nodes missing from
+    the state file (eg: after a crash) are found again.
+
+    eg: StandbyPool(cloud, 'ami-27013f53').take() -> dict
+
+    :copyright: (C) 2013 by Emanuele Rocca.
+"""
+
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+
+from contextlib import contextmanager
+
+from nubo.config import locked, replace
+
+STATEFILE = os.path.join(os.getenv('HOME'), '.nubo-standby')
+
+# Standby nodes older than this are destroyed instead of handed out
+DEFAULT_MAX_AGE = 12 * 60 * 60
+
+# Nodes being deployed for longer than this are assumed to have failed
+BOOT_TIMEOUT = 30 * 60
+
+# Fields of the nodes stored in the state file
+FIELDS = ( 'id', 'name', 'state', 'public_ips', 'private_ips' )
+
+def statefile(profile=None):
+    """Return the path of the file storing the pools of the given profile,
+    or of the current one. See `nubo.config.conffile`."""
+    if profile is None:
+        profile = os.getenv('NUBO_PROFILE')
+
+    if not profile:
+        return STATEFILE
+
+    return '%s.%s' % (STATEFILE, profile)
+
+def read_state(path):
+    try:
+        return json.loads(open(path).read())
+    except (IOError, ValueError):
+        return {}
+
+def pools(path=None):
+    """Return the state of all pools, see `StandbyPool.state`."""
+    return sorted(read_state(path or statefile()).values(),
+        key=lambda pool: (pool['provider'], pool['image'], pool['size']))
+
+class StandbyPool(object):
+    """Nodes of `cloud` started from the given image and size, booted in
+    advance for its SSH key and login user. The pool is kept at `target` nodes by `fill`, nodes older
+    than `max_age` seconds being replaced.
+
+    Nodes are handed out by `take`, atomically: even when many processes
+    ask for a node at the same time, each node is handed out once.
+    """
+
+    def __init__(self, cloud, image_id, size_idx=0, path=None):
+        self.cloud = cloud
+        self.image_id = image_id
+        self.size_idx = size_idx
+        self.path = path or statefile()
+
+        # Indexes change along with the list of sizes: identify them by id
+        self.size_id = cloud.get_size(size_idx).id
+
+        # Nodes started for other keys or users cannot be logged into
+        self.key = '%s:%s:%s:%s:%s' % (cloud.PROVIDER_NAME, image_id,
+            self.size_id, cloud.ssh_key_name, cloud.login_as)
+
+        # eg: nubo-standby-1c8e9a3f-0f1e2d-1
+        self.prefix = 'nubo-standby-%s-' % (
+            hashlib.md5(self.key).hexdigest()[:8])
+
+    @contextmanager
+    def state(self):
+        """Yield the state of this pool as a dictionary, saved when the
+        block is over. Other processes wait for the block to be over before
+        reading the state."""
+        with locked(self.path):
+            state = read_state(self.path)
+            pool = state.setdefault(self.key, self.__empty())
+
+            yield pool
+
+            # eg: drained pools
+            if not (pool['target'] or pool['ready'] or pool['booting'] or
+                    pool['taken']):
+                del state[self.key]
+
+            replace(self.path, json.dumps(state, indent=4))
+
+    def configure(self, target=None, max_age=None):
+        """Set the number of nodes to keep ready and their maximum age."""
+        with self.state() as pool:
+            if target is not None:
+                pool['target'] = target
+
+            if max_age is not None:
+                pool['max_age'] = max_age
+
+    def status(self):
+        """Return the state of this pool, without waiting for other
+        processes to be done with it."""
+        return read_state(self.path).get(self.key) or self.__empty()
+
+    def __empty(self):
+        return {
+            'provider': self.cloud.PROVIDER_NAME,
+            'image': self.image_id,
+            'size': self.size_id,
+            'target': 0,
+            'max_age': DEFAULT_MAX_AGE,
+            # Nodes accepting SSH connections, oldest first
+            'ready': [],
+            # Names and start times of the nodes being deployed
+            'booting': [],
+            # Ids of the nodes handed out, see `reconcile`
+            'taken': [],
+        }
+
+    def __expired(self, pool):
+        """Remove and return the ready nodes older than max_age."""
+        deadline = time.time() - pool['max_age']
+
+        expired = [ node for node in pool['ready']
+            if node['created'] < deadline ]
+
+        pool['ready'] = [ node for node in pool['ready']
+            if node['created'] >= deadline ]
+
+        return expired
+
+    def __retire(self, nodes):
+        if not nodes:
+            return
+
+        for result in self.cloud.shutdown_many([ node['id']
+                for node in nodes ]):
+            if result['error'] is not None:
+                logging.warning("Cannot retire standby node %s: %s" % (
+                    result['id'], result['error']))
+
+    def take(self):
+        """Hand out a node accepting SSH connections, or return None if the
+        pool is empty. The pool is not refilled, see `fill`."""
+        while True:
+            node = None
+
+            with self.state() as pool:
+                expired = self.__expired(pool)
+
+                if pool['ready']:
+                    node = pool['ready'].pop(0)
+                    pool['taken'].append(node['id'])
+
+            self.__retire(expired)
+
+            if node is None:
+                return None
+
+            # The node was verified when deployed: just check it is still up
+            if self.cloud.remote_host(node).ssh_ready(timeout=5):
+                return node
+
+            logging.warning("Standby node %s is not reachable, retiring it"
+                % node['id'])
+            self.__retire([ node ])
+
+    def reconcile(self):
+        """Synchronize the state with the nodes actually running: forget
+        nodes which are gone, and adopt standby nodes of this pool missing
+        from the state, such as those deployed by a process which crashed
+        before saving them."""
+        nodes = self.cloud.find_nodes(name_glob=self.prefix + '*')
+        running = set(node['id'] for node in nodes)
+
+        with self.state() as pool:
+            pool['ready'] = [ node for node in pool['ready']
+                if node['id'] in running ]
+            pool['taken'] = [ node_id for node_id in pool['taken']
+                if node_id in running ]
+
+            known = set(pool['taken'] +
+                        [ node['id'] for node in pool['ready'] ])
+            booting = set(entry['name'] for entry in pool['booting'])
+
+            for node in nodes:
+                if node['id'] in known or node.get('name') in booting:
+                    continue
+
+                if not node.get('public_ips'):
+                    continue
+
+                # Their age is unknown. Nodes are checked by `take` anyway.
+                adopted = node.project(FIELDS)
+                adopted['created'] = time.time()
+                pool['ready'].append(adopted)
+
+    def fill(self, parallel=None):
+        """Deploy nodes until `target` nodes are ready or being deployed,
+        and retire nodes older than `max_age`. Block until the new nodes
+        accept SSH connections.
+
+        Return the results of `BaseCloud.deploy_many`."""
+        self.reconcile()
+
+        with self.state() as pool:
+            expired = self.__expired(pool)
+
+            now = time.time()
+            pool['booting'] = [ entry for entry in pool['booting']
+                if now - entry['started'] < BOOT_TIMEOUT ]
+
+            missing = pool['target'] - len(pool['ready']) - len(
+                pool['booting'])
+
+            template = self.prefix + os.urandom(3).encode('hex') + '-%d'
+            names = [ template % (idx + 1) for idx in range(missing) ]
+
+            # Concurrent calls to fill do not deploy these nodes again
+            pool['booting'] += [ { 'name': name, 'started': now }
+                for name in names ]
+
+        self.__retire(expired)
+
+        if not names:
+            return []
+
+        results = self.cloud.deploy_many(self.image_id, len(names),
+            template, size_idx=self.size_idx, parallel=parallel)
+
+        with self.state() as pool:
+            pool['booting'] = [ entry for entry in pool['booting']
+                if entry['name'] not in names ]
+
+            for result in results:
+                if result['node'] is None:
+                    continue
+
+                node = dict((field, result['node'][field])
+                    for field in FIELDS if field in result['node'])
+                node['created'] = time.time()
+                pool['ready'].append(node)
+
+        return results
+
+    def fill_in_background(self, parallel=None):
+        """Call `fill` in a new thread, and return the thread."""
+        def fill():
+            try:
+                self.fill(parallel)
+            except Exception, e:
+                logging.exception("Cannot fill standby pool %s: %s" % (
+                    self.key, e))
+
+        thread = threading.Thread(target=fill, name='standby-' + self.key)
+        thread.start()
+        return thread
+
+    def drain(self):
+        """Destroy all standby nodes and stop keeping nodes ready."""
+        self.reconcile()
+
+        with self.state() as pool:
+            nodes, pool['ready'] = pool['ready'], []
+            pool['target'] = 0
+
+        self.__retire(nodes)
+        return nodes
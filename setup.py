@@ -41,6 +41,7 @@ setup(
         'Environment :: Console',
         'License :: OSI Approved :: BSD License',
         'Programming Language :: Python',
+        'Programming Language :: Python :: 2.7',
         'Intended Audience :: Developers',
         'Intended Audience :: System Administrators',
         'Topic :: Internet',
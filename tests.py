@@ -2,24 +2,61 @@
 
 from nubo import config
 from nubo import remote
+from nubo import parallel
+from nubo import poller
+from nubo import cache
+from nubo import index
+from nubo import aio
+from nubo import events
+from nubo import metrics
+from nubo import drivers
+from nubo import daemon
+from nubo import standby
+from nubo import prerequisites
+from nubo import history
 
 from nubo.clouds import base
 
+from benchmarks import startup
+from benchmarks import hotpaths
+
 from nubo.clouds.ec2 import AmazonEC2
 from nubo.clouds.rackspace import Rackspace
 from nubo.clouds.opennebula import OpenNebula
 from nubo.clouds.digitalocean import DigitalOcean
 from nubo.clouds.linode import Linode
 
+import os
+import sys
+import json
+import time
+import httplib
+import shutil
+import socket
 import unittest
 import tempfile
+import threading
+
+from libcloud.compute.base import Node, NodeImage
+from libcloud.compute.drivers.dummy import DummyNodeDriver
 
 from os import getenv, unlink
 from os.path import join
+from StringIO import StringIO
 
 class DummyCloud(base.BaseCloud):
     """Dummy cloud using the DUMMY libcloud provider"""
     PROVIDER_NAME = 'DUMMY'
+
+class SlowDummyCloud(DummyCloud):
+    """Dummy cloud taking forever to list its nodes"""
+
+    def new_driver(self):
+        return DummyNodeDriver(creds='')
+
+    def list_nodes(self, fields=None):
+        time.sleep(5)
+        return []
     
 class BaseTest(unittest.TestCase):
 
@@ -35,11 +72,19 @@ class BaseTest(unittest.TestCase):
         self.assertEquals(provider_name, cloud.PROVIDER_NAME)
         
     def test_get_cloud(self):
-        self.__test_get_cloud('EC2_AP_SOUTHEAST2', AmazonEC2)
+        self.__test_get_cloud('EC2_US_EAST', AmazonEC2)
         self.__test_get_cloud('OPENNEBULA', OpenNebula)
         self.__test_get_cloud('DIGITAL_OCEAN', DigitalOcean)
         self.__test_get_cloud('RACKSPACE', Rackspace)
 
+        # Clouds sharing the same class do not affect each other
+        for provider_name in 'EC2_AP_SOUTHEAST2', 'EC2_EU_WEST':
+            cloud = base.get_cloud(provider_name)
+            self.failUnless(issubclass(cloud, AmazonEC2))
+            self.__test_get_cloud(provider_name, cloud)
+
+        self.assertEquals('EC2_US_EAST', AmazonEC2.PROVIDER_NAME)
+
     def test_read_config(self):
         self.assertEquals(dict, type(config.read_config()))
 
@@ -61,6 +106,61 @@ class BaseTest(unittest.TestCase):
         self.assertEquals(host.host, '127.0.0.1')
         self.assertEquals(host.private_key, 'dummy')
 
+class ConfigTest(unittest.TestCase):
+
+    def setUp(self):
+        self.oldfile = config.CONFFILE
+        self.directory = tempfile.mkdtemp()
+        config.CONFFILE = join(self.directory, 'nuborc')
+
+    def tearDown(self):
+        config.CONFFILE = self.oldfile
+        shutil.rmtree(self.directory)
+
+    def test_write_permissions(self):
+        config.write_config({ 'nubo': { 'privkey': '~/.ssh/id_rsa' } })
+        self.assertEquals(0600, os.stat(config.CONFFILE).st_mode & 0777)
+
+    def test_read_cached(self):
+        config.write_config({ 'a': 1 })
+        self.assertEquals({ 'a': 1 }, config.read_config())
+
+        # Changes to the returned values do not affect the cache
+        config.read_config()['b'] = 2
+        self.assertEquals({ 'a': 1 }, config.read_config())
+
+        # Files written by somebody else are noticed
+        tmppath = config.CONFFILE + '.tmp'
+        open(tmppath, 'w').write('{ "a": 3 }')
+        os.rename(tmppath, config.CONFFILE)
+        self.assertEquals({ 'a': 3 }, config.read_config())
+
+    def test_profiles(self):
+        config.write_config({ 'a': 1 })
+        config.write_config({ 'a': 2 }, profile='ci')
+
+        self.assertEquals({ 'a': 1 }, config.read_config())
+        self.assertEquals({ 'a': 2 }, config.read_config('ci'))
+
+        os.environ['NUBO_PROFILE'] = 'ci'
+        try:
+            self.assertEquals({ 'a': 2 }, config.read_config())
+        finally:
+            del os.environ['NUBO_PROFILE']
+
+    def test_concurrent_writes(self):
+        threads = [ threading.Thread(target=config.write_config,
+            args=({ str(idx): idx },)) for idx in range(20) ]
+
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+        self.assertEquals(dict((str(idx), idx) for idx in range(20)),
+            config.read_config())
+
 class BaseCloudTest(unittest.TestCase):
 
     def setUp(self):
@@ -69,6 +169,19 @@ class BaseCloudTest(unittest.TestCase):
             'tests.DummyCloud': { 'creds': '', }
         }
 
+        cache.CACHE_DIR = tempfile.mkdtemp()
+
+        self.historyfile = history.HISTORYFILE
+        history.HISTORYFILE = os.path.join(cache.CACHE_DIR, 'history')
+
+        # Each test starts with new DUMMY drivers, hence with the same nodes
+        drivers.registry.clear()
+        poller.registry.clear()
+
+        # Patched by tests not wanting to actually ssh into fake servers
+        self.remotehost = dict((name, remote.RemoteHost.__dict__[name])
+            for name in ('run_command', 'ssh_ready'))
+
         # Write dummy private key file
         self.privkey = tempfile.mkstemp()[1]
 
@@ -80,8 +193,14 @@ class BaseCloudTest(unittest.TestCase):
         self.cloud = self.CloudClass(ssh_private_key=self.privkey)
 
     def tearDown(self):
+        for name, method in self.remotehost.items():
+            setattr(remote.RemoteHost, name, method)
+
+        history.HISTORYFILE = self.historyfile
+
         unlink(self.privkey)
         unlink(self.pubkey)
+        shutil.rmtree(cache.CACHE_DIR)
 
     def test_test_conn(self):
         self.failUnless(self.CloudClass.test_conn(creds=''))
@@ -92,6 +211,48 @@ class BaseCloudTest(unittest.TestCase):
 
         self.assertEquals('root', self.cloud.login_as)
 
+    def test_init_timeouts(self):
+        cloud = self.CloudClass(ssh_private_key=self.privkey, 
+            boot_timeout=60, poll_interval=0.5)
+
+        self.assertEquals(60, cloud.BOOT_TIMEOUT)
+        self.assertEquals(base.BaseCloud.SSH_TIMEOUT, cloud.SSH_TIMEOUT)
+        self.assertEquals(0.5, cloud.poller.interval)
+
+        # Class defaults are not affected
+        self.assertEquals(base.BaseCloud.BOOT_TIMEOUT, 
+            self.CloudClass.BOOT_TIMEOUT)
+
+    def test_wait_for_ssh_timeout(self):
+        remote.RemoteHost.ssh_ready = lambda x, timeout: False
+
+        cloud = self.CloudClass(ssh_private_key=self.privkey, 
+            poll_interval=0.01)
+        node = { 'id': '1', 'public_ips': [ '127.0.0.1' ] }
+
+        start = time.time()
+        self.assertEquals(None, cloud.wait_for_ssh(node, timeout=0.2))
+        self.failUnless(0.2 <= time.time() - start < 1)
+
+    def test_shared_poller(self):
+        # Nodes are polled once for all the cloud objects of an account
+        cloud = self.CloudClass(ssh_private_key=self.privkey)
+        self.failUnless(cloud.poller is self.cloud.poller)
+
+        cloud = self.CloudClass(ssh_private_key=self.privkey, 
+            poll_interval=0.5)
+        self.failIf(cloud.poller is self.cloud.poller)
+
+    def test_init_profile(self):
+        os.environ['NUBO_PROFILE'] = 'ci'
+        try:
+            cloud = self.CloudClass(ssh_private_key=self.privkey)
+        finally:
+            del os.environ['NUBO_PROFILE']
+
+        # Used by other threads too
+        self.assertEquals('ci', cloud.profile)
+
     def test_init_wrong_provider_name(self):
         self.CloudClass.PROVIDER_NAME = 'WRONG_PROVIDER'
         self.assertRaises(Exception, self.CloudClass)
@@ -100,12 +261,321 @@ class BaseCloudTest(unittest.TestCase):
         # Patching RemoteHost.run_command: we do not want to actually ssh into
         # the fake server
         remote.RemoteHost.run_command = lambda x, y, z: ('root', '')
+        remote.RemoteHost.ssh_ready = lambda x, timeout: True
 
         new_node = self.cloud.startup({})
 
         self.assertEquals(dict, type(new_node))
         self.assertEquals('RUNNING', new_node['state'])
 
+    def test_startup_events(self):
+        remote.RemoteHost.run_command = lambda x, y, z: ('root', '')
+        remote.RemoteHost.ssh_ready = lambda x, timeout: True
+
+        received = []
+        events.subscribe(received.append)
+        try:
+            node = self.cloud.startup({ 'name': 'web-1' })
+        finally:
+            events.unsubscribe(received.append)
+
+        self.assertEquals([ 'phase', 'phase', 'phase', 'launch_finished' ],
+            [ event['event'] for event in received ])
+
+        launch = received[-1]
+        self.assertEquals('web-1', launch['name'])
+        self.assertEquals(node['id'], launch['node_id'])
+        self.assertEquals(set([ 'create', 'running', 'ssh' ]), 
+            set(launch['phases']))
+        self.assertEquals(1, launch['counters']['polls'])
+        self.assertEquals(None, launch['error'])
+
+    def test_startup_events_per_cloud(self):
+        remote.RemoteHost.run_command = lambda x, y, z: ('root', '')
+        remote.RemoteHost.ssh_ready = lambda x, timeout: True
+
+        # eg: two nubo start commands run by nubo serve
+        clouds = [ self.CloudClass(ssh_private_key=self.privkey)
+            for _ in range(2) ]
+        received = dict((cloud, []) for cloud in clouds)
+
+        everything = []
+        events.subscribe(everything.append)
+        for cloud in clouds:
+            events.subscribe(received[cloud].append, cloud)
+
+        try:
+            threads = [ threading.Thread(target=cloud.startup, 
+                args=({ 'name': 'web-%d' % idx },)) 
+                for idx, cloud in enumerate(clouds) ]
+
+            for thread in threads:
+                thread.start()
+
+            for thread in threads:
+                thread.join(5)
+        finally:
+            events.unsubscribe(everything.append)
+            for cloud in clouds:
+                events.unsubscribe(received[cloud].append, cloud)
+
+        for idx, cloud in enumerate(clouds):
+            self.assertEquals(set([ 'web-%d' % idx ]), 
+                set(event['name'] for event in received[cloud]))
+
+        self.assertEquals(8, len(everything))
+
+    def test_startup_history(self):
+        remote.RemoteHost.run_command = lambda x, y, z: ('root', '')
+        remote.RemoteHost.ssh_ready = lambda x, timeout: True
+
+        class Size:
+            id = 'small'
+
+        start = time.time()
+        self.cloud.startup({ 'name': 'web-1', 'image': 'debian',
+                             'size': Size })
+
+        # Nodes not waited for are not recorded
+        with self.cloud.no_wait():
+            self.cloud.startup({ 'name': 'web-2' })
+
+        # Failures are, even before the node is RUNNING
+        def create_node(**params):
+            raise Exception('boom')
+
+        self.cloud.driver.create_node = create_node
+        self.assertRaises(Exception, self.cloud.startup, { 'name': 'web-3' })
+
+        entries = history.read()
+        self.assertEquals(2, len(entries))
+        self.assertEquals(('DUMMY', 'debian', 'small', None), 
+            tuple(entries[0][field] for field in 
+                ('provider', 'image', 'size', 'error')))
+        self.failUnless(0 <= entries[0]['running'] <= entries[0]['ssh'])
+
+        # Deployments are recorded with the time they started
+        self.failUnless(round(start, 3) <= entries[0]['time'] 
+            <= entries[1]['time'])
+
+        self.assertEquals(('boom', None, None), 
+            tuple(entries[1][field] for field in ('error', 'running', 'ssh')))
+
+    def test_deploy_events(self):
+        def deploy(cloud, image_id, size_idx=0, location_idx=0, name='test'):
+            with cloud.phase('prerequisites'):
+                cloud.get_size(size_idx)
+
+            raise Exception('boom')
+
+        log = join(cache.CACHE_DIR, 'events.log')
+        listener = events.JSONLinesLog(log)
+
+        events.subscribe(listener)
+        try:
+            self.assertRaises(Exception, base.instrumented(deploy), 
+                self.cloud, '1', name='web-1')
+        finally:
+            events.unsubscribe(listener)
+            listener.close()
+
+        logged = [ json.loads(line) for line in open(log) ]
+        self.assertEquals([ 'phase', 'launch_finished' ], 
+            [ event['event'] for event in logged ])
+        self.assertEquals('prerequisites', logged[0]['phase'])
+        self.assertEquals('1', logged[1]['image'])
+        self.assertEquals('boom', logged[1]['error'])
+
+    def test_driver_registry(self):
+        other = self.CloudClass(ssh_private_key=self.privkey)
+        self.failUnless(self.cloud.driver.wrapped is other.driver.wrapped)
+
+        # Drivers are not shared among running threads, but they are reused
+        # once their thread is over
+        def drivers_of_threads():
+            ids = []
+
+            def driver():
+                cloud = self.CloudClass(ssh_private_key=self.privkey)
+                ids.append(id(cloud.driver.wrapped))
+
+                # Keep running until the other thread got its driver
+                while len(ids) < 2:
+                    time.sleep(0.01)
+
+            threads = [ threading.Thread(target=driver) for _ in range(2) ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            return set(ids)
+
+        first = drivers_of_threads()
+        self.failIf(id(self.cloud.driver.wrapped) in first)
+        self.assertEquals(2, len(first))
+        self.assertEquals(first, drivers_of_threads())
+
+    def test_key_name(self):
+        open(self.pubkey, 'w').write('ssh-rsa AAAA')
+        name = base.key_name(self.pubkey)
+        self.assertEquals('870e774cb97e2df7620ea0ad19efc964', name)
+
+        # Changes are noticed
+        open(self.pubkey, 'w').write('ssh-rsa BBBBBB')
+        self.failIf(name == base.key_name(self.pubkey))
+
+    def test_missing_prerequisite(self):
+        remote.RemoteHost.run_command = lambda x, y, z: ('root', '')
+        remote.RemoteHost.ssh_ready = lambda x, timeout: True
+
+        resolved = []
+
+        class Cloud(DummyCloud):
+            @base.instrumented
+            def deploy(self, image_id, size_idx=0, location_idx=0,
+                       name='test'):
+                key = self.prerequisites.get('keypair',
+                    lambda: resolved.append(name) or 'key-%d' % len(resolved))
+                group = self.prerequisites.get('security_group', 
+                    lambda: 'nubo')
+                return self.startup({ 'name': name, 'key': key, 
+                                      'group': group })
+
+        cloud = Cloud(ssh_private_key=self.privkey)
+
+        # The cached key has been deleted from the account
+        missing = Exception("InvalidKeyPair.NotFound: The key pair 'key-1' "
+                            "does not exist")
+        errors = [ missing ]
+        create_node = cloud.driver.wrapped.create_node
+
+        def flaky_create_node(**params):
+            if errors:
+                raise errors.pop()
+
+            return create_node(**params)
+
+        cloud.driver.wrapped.create_node = flaky_create_node
+
+        # Deployed at the second attempt, after resolving the key again.
+        # Other prerequisites are not resolved again.
+        self.assertEquals('RUNNING', cloud.deploy('image', name='a')['state'])
+        self.assertEquals([ 'a', 'a' ], resolved)
+        self.assertEquals('key-2', cloud.prerequisites.load('keypair'))
+        self.assertEquals('nubo', cloud.prerequisites.load('security_group'))
+
+        cloud.deploy('image', name='b')
+        self.assertEquals([ 'a', 'a' ], resolved)
+
+        # When the second attempt fails too, the first error is raised
+        errors[:] = [ Exception('Request limit exceeded'), missing ]
+        try:
+            cloud.deploy('image', name='c')
+        except Exception, e:
+            self.failUnless(e is missing)
+        else:
+            self.fail("deploy should have failed")
+
+        # Other errors are not retried
+        errors[:] = [ Exception('The image ami-1 was not found') ]
+        self.assertRaises(Exception, cloud.deploy, 'image', name='d')
+        self.assertEquals('key-3', cloud.prerequisites.load('keypair'))
+        self.assertEquals([ 'a', 'a', 'c' ], resolved)
+
+    def test_prepare(self):
+        def slow(value):
+            time.sleep(0.2)
+            return value
+
+        start = time.time()
+        values = self.cloud.prepare({
+            'key': lambda: slow('key'),
+            'size': lambda: slow(1),
+            'location': lambda: slow('here'),
+            'params': (lambda key, size: (key, size), [ 'key', 'size' ]),
+        })
+
+        # Independent prerequisites are resolved at the same time
+        self.failUnless(time.time() - start < 0.6)
+        self.assertEquals({ 'key': 'key', 'size': 1, 'location': 'here',
+                            'params': ('key', 1) }, values)
+
+    def test_prepare_errors(self):
+        def fail():
+            raise Exception, 'no such key'
+
+        # The first error is raised without waiting for slower lookups
+        start = time.time()
+        self.assertRaises(Exception, self.cloud.prepare, {
+            'key': fail, 'size': lambda: time.sleep(1) })
+        self.failUnless(time.time() - start < 0.5)
+
+        self.assertRaises(ValueError, self.cloud.prepare, {
+            'size': (lambda key: key, [ 'key' ]) })
+
+        self.assertRaises(ValueError, self.cloud.prepare, {
+            'a': (lambda b: b, [ 'b' ]), 'b': (lambda a: a, [ 'a' ]) })
+
+    def test_driver_metrics(self):
+        metrics.registry.clear()
+
+        self.cloud.list_nodes()
+        self.cloud.list_nodes()
+        self.assertRaises(Exception, self.cloud.driver.reboot_node, None)
+
+        self.assertEquals(2, metrics.registry.count('DUMMY', 'list_nodes'))
+        self.assertEquals(1, metrics.registry.count(method='reboot_node',
+            outcome=metrics.ERROR))
+
+        exported = metrics.registry.prometheus()
+        self.failUnless('nubo_driver_calls_total{provider="DUMMY",'
+            'method="list_nodes",outcome="ok"} 2' in exported)
+        self.failUnless('nubo_driver_call_seconds_bucket{provider="DUMMY",'
+            'method="list_nodes",le="+Inf"} 2' in exported)
+
+        path = join(cache.CACHE_DIR, 'metrics.json')
+        metrics.registry.export(path)
+        self.assertEquals({ 'ok': 2 }, 
+            json.load(open(path))['DUMMY']['list_nodes']['calls'])
+
+    def test_async_startup(self):
+        self.share_driver()
+
+        acloud = aio.AsyncCloud(self.cloud, watcher=aio.Watcher(0.01))
+        acloud.wait_for_ssh = lambda node: aio.then(
+            acloud.watcher.sleep(0), lambda _: 'root')
+
+        futures = [ acloud.startup({}) for _ in range(3) ]
+        nodes = [ future.result(timeout=10) 
+            for future in aio.as_completed(futures, timeout=10) ]
+
+        self.assertEquals([ 'RUNNING' ] * 3, 
+            [ node['state'] for node in nodes ])
+        self.assertEquals(3, len(set(node['id'] for node in nodes)))
+        acloud.close()
+
+    def test_deploy_many(self):
+        def deploy(image_id, size_idx=0, location_idx=0, name='test'):
+            if name == 'web-2':
+                raise Exception('boom')
+            return { 'id': name }
+
+        self.cloud.deploy = deploy
+
+        results = self.cloud.deploy_many('1', 3, 'web-%d', parallel=2)
+        self.assertEquals([ 'web-1', 'web-2', 'web-3' ], 
+            [ result['name'] for result in results ])
+
+        self.assertEquals({ 'id': 'web-1' }, results[0]['node'])
+        self.assertEquals(None, results[1]['node'])
+        self.assertEquals('boom', str(results[1]['error']))
+        self.assertEquals(None, results[2]['error'])
+
+    def test_driver_per_thread(self):
+        drivers = parallel.parallel_map(lambda _: self.cloud.driver, [1, 2], 2)
+        self.failIf(self.cloud.driver in drivers)
+
     def test_node2dict(self):
         node = self.cloud.driver.list_nodes()[0]
         expected = {
@@ -118,6 +588,24 @@ class BaseCloudTest(unittest.TestCase):
         }
         self.assertEquals(expected, base.node2dict(node))
         
+    def test_node_record(self):
+        node = self.cloud.driver.list_nodes()[0]
+        record = base.NodeRecord(node)
+
+        self.assertEquals('RUNNING', record['state'])
+        self.assertEquals([ 'state' ], record.converted.keys())
+
+        self.assertEquals(base.node2dict(node), record)
+        self.failIf('image' in record)
+        self.assertEquals(None, record.get('image'))
+        self.assertRaises(KeyError, lambda: record['image'])
+        self.assertRaises(KeyError, lambda: record['wrong'])
+        self.failIf(hasattr(record, '__dict__'))
+
+    def test_list_nodes_fields(self):
+        nodes = self.cloud.list_nodes(fields=('id', 'state', 'image'))
+        self.assertEquals({ 'id': '1', 'state': 'RUNNING' }, nodes[0])
+
     def test_is_running(self):
         self.failUnless(self.cloud.is_running(node_id='1'))
         self.failIf(self.cloud.is_running(node_id='42'))
@@ -136,6 +624,61 @@ class BaseCloudTest(unittest.TestCase):
         # node 1 is running. reboot should return True
         self.failUnless(self.cloud.reboot(node_id='1'))
 
+    def share_driver(self):
+        """Use the same DUMMY driver in all threads, otherwise each thread
+        sees a different set of nodes"""
+        driver = self.cloud.driver.wrapped
+        self.cloud.new_driver = lambda: driver
+
+    def test_reboot_many(self):
+        self.share_driver()
+
+        results = self.cloud.reboot_many([ '1', '42' ], name_glob='dummy-*')
+        self.assertEquals([ '1', '2', '42' ], 
+            [ result['id'] for result in results ])
+        self.assertEquals([ True, True, False ], 
+            [ result['ok'] for result in results ])
+
+    def test_many_without_targets(self):
+        self.assertRaises(ValueError, self.cloud.reboot_many)
+        self.assertRaises(ValueError, self.cloud.shutdown_many, [])
+
+    def test_shutdown_many(self):
+        self.share_driver()
+
+        results = self.cloud.shutdown_many(name_glob='*-2')
+        self.assertEquals(1, len(results))
+        self.failUnless(results[0]['ok'])
+        self.assertEquals([ '1' ], 
+            [ node['id'] for node in self.cloud.list_nodes() ])
+
+    def test_find_nodes_glob(self):
+        nodes = self.cloud.find_nodes(name_glob='dummy-?')
+        self.assertEquals(2, len(nodes))
+
+    def test_list_all_nodes(self):
+        base.CLOUDS_MAPPING['SLOW_DUMMY'] = 'tests.SlowDummyCloud'
+        base.AVAILABLE_CLOUDS['tests.SlowDummyCloud'] = { 'creds': '' }
+        base.AVAILABLE_CLOUDS['nubo'] = { 'privkey': self.privkey }
+
+        try:
+            self.assertEquals([ 'DUMMY', 'SLOW_DUMMY' ], 
+                base.configured_clouds())
+
+            dummy, slow, unknown = base.list_all_nodes(
+                [ 'DUMMY', 'SLOW_DUMMY', 'OPENNEBULA' ], timeout=0.5)
+        finally:
+            del base.CLOUDS_MAPPING['SLOW_DUMMY']
+
+        self.assertEquals(2, len(dummy['nodes']))
+        self.assertEquals(None, dummy['error'])
+
+        self.assertEquals(None, slow['nodes'])
+        self.failUnless('Timed out' in str(slow['error']))
+
+        self.assertEquals('OPENNEBULA', unknown['cloud'])
+        self.assertEquals(KeyError, type(unknown['error']))
+
     def test_list_nodes(self):
         nodes = self.cloud.list_nodes()
         self.assertEquals(2, len(nodes))
@@ -163,15 +706,1230 @@ class BaseCloudTest(unittest.TestCase):
         self.assertEquals(1, len(images))
         self.assertEquals('Slackware 4', images[0].name)
 
+    def test_find_nodes(self):
+        nodes = self.cloud.find_nodes([ '1', 'dummy-2', 'missing' ])
+        self.assertEquals([ '1', '2' ], [ node['id'] for node in nodes ])
+
+    def test_list_images_index_updated(self):
+        self.cloud.list_images(keyword='ubuntu')
+
+        self.cloud.driver.list_images = lambda: [ 
+            NodeImage(id=4, name="Ubuntu 12.04", driver=None) ]
+
+        images = self.cloud.list_images(keyword='ubuntu', refresh=True)
+        self.assertEquals([ 'Ubuntu 12.04' ], 
+            [ image.name for image in images ])
+
+    def test_list_images_index_expired(self):
+        self.cloud.list_images(keyword='ubuntu')
+
+        fetched = []
+
+        def list_images():
+            fetched.append(True)
+            return [ NodeImage(id=4, name="Ubuntu 12.04", driver=None) ]
+
+        self.cloud.driver.list_images = list_images
+
+        # Searches go through the expiry of the list of images too
+        self.cloud.cache.ttl = self.cloud.cache.max_stale = -1
+        images = self.cloud.list_images(keyword='ubuntu')
+        self.assertEquals([ True ], fetched)
+        self.assertEquals([ 'Ubuntu 12.04' ], 
+            [ image.name for image in images ])
+
     def test_list_sizes(self):
         sizes = self.cloud.list_sizes()
         expected = [ 'Small', 'Medium', 'Big', 'XXL Big']
         self.assertEquals(expected, sizes)
 
+    def test_catalog_cached(self):
+        self.cloud.catalog('sizes')
+
+        # The driver is not used anymore once sizes are cached
+        self.cloud.driver.list_sizes = lambda: []
+
+        size = self.cloud.get_size(1)
+        self.assertEquals('Medium', size.name)
+        self.failUnless(size.driver is self.cloud.driver)
+
+        self.assertEquals([], self.cloud.list_sizes(refresh=True))
+
     def test_deploy_on_base_class(self):
         base.BaseCloud.PROVIDER_NAME = 'DUMMY'
         cloud = base.BaseCloud(ssh_private_key=self.privkey)
         self.assertRaises(NotImplementedError, cloud.deploy, [''])
 
+class FakeSSHClient(object):
+    """SSHClient stand-in, used to test connection pooling"""
+
+    def __init__(self):
+        self.active = True
+
+    def get_transport(self):
+        return self
+
+    def is_active(self):
+        return self.active
+
+    def close(self):
+        self.active = False
+
+class FakeConnectionPool(remote.SSHConnectionPool):
+
+    def connect(self, host, user, private_key, compress=False):
+        return FakeSSHClient()
+
+class SSHConnectionPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = FakeConnectionPool(max_size=2)
+
+    def test_reuse(self):
+        with self.pool.connection('host1', 'root', 'key') as client:
+            pass
+
+        with self.pool.connection('host1', 'root', 'key') as again:
+            self.failUnless(client is again)
+
+        with self.pool.connection('host1', 'admin', 'key') as other:
+            self.failIf(client is other)
+
+        with self.pool.connection('host1', 'root', 'key', True) as other:
+            self.failIf(client is other)
+
+    def test_reconnect_unhealthy(self):
+        with self.pool.connection('host1', 'root', 'key') as client:
+            client.close()
+
+        with self.pool.connection('host1', 'root', 'key') as again:
+            self.failIf(client is again)
+            self.failUnless(again.is_active())
+
+    def test_lru_eviction(self):
+        clients = []
+        for host in 'host1', 'host2', 'host3':
+            with self.pool.connection(host, 'root', 'key') as client:
+                clients.append(client)
+
+        self.assertEquals(2, len(self.pool.connections))
+        self.failIf(clients[0].is_active())
+        self.failUnless(clients[2].is_active())
+
+    def test_idle_timeout(self):
+        pool = FakeConnectionPool(idle_timeout=0.05)
+        with pool.connection('host1', 'root', 'key') as client:
+            pass
+
+        # Closed without using the pool again
+        time.sleep(0.3)
+        self.failIf(client.is_active())
+        self.assertEquals(0, len(pool.connections))
+
+    def test_no_eviction_in_use(self):
+        first = self.pool.acquire('host1', 'root', 'key')
+        self.pool.acquire('host2', 'root', 'key')
+        self.pool.acquire('host3', 'root', 'key')
+        self.failUnless(first.is_active())
+
+    def test_close(self):
+        with self.pool.connection('host1', 'root', 'key') as client:
+            pass
+
+        self.pool.close()
+        self.failIf(client.is_active())
+        self.assertEquals(0, len(self.pool.connections))
+
+class FakeRemoteHost(object):
+
+    def __init__(self, host, status):
+        self.host = host
+        self.status = status
+
+    def run(self, command, user='root', timeout=None, on_output=None,
+            deadline=None):
+        return remote.CommandResult(self.host, command, '', self.status, None)
+
+    def upload(self, data, remotepath, user='root', compress=False):
+        if self.status:
+            raise IOError('Permission denied')
+
+        return remote.TransferResult(self.host, len(data[:]), 2.0, None)
+
+class RemoteGroupTest(unittest.TestCase):
+
+    def setUp(self):
+        self.group = remote.RemoteGroup([], 'key', parallel=1)
+        self.group.hosts = [ FakeRemoteHost('host1', 0), 
+                             FakeRemoteHost('host2', 1),
+                             FakeRemoteHost('host3', 0) ]
+
+    def test_run(self):
+        results = list(self.group.run('uptime'))
+        self.assertEquals([ 'host1', 'host2', 'host3' ], 
+            sorted(result.host for result in results))
+        self.assertEquals('uptime', results[0].stdout)
+        self.assertEquals(2, len([ result for result in results 
+            if result.ok ]))
+
+    def test_run_fail_fast(self):
+        results = list(self.group.run('uptime', fail_fast=True))
+        self.failIf(results[-1].ok)
+        self.failUnless(len(results) < 3)
+
+    def test_put(self):
+        localpath = tempfile.mkstemp()[1]
+        open(localpath, 'w').write('0123456789')
+
+        results = dict((result.host, result) 
+            for result in self.group.put(localpath, '/tmp/file'))
+        unlink(localpath)
+
+        self.assertEquals(10, results['host1'].size)
+        self.assertEquals(5, results['host3'].rate)
+        self.failIf(results['host2'].ok)
+
+    def test_put_closed(self):
+        sizes = []
+
+        class SlowHost(FakeRemoteHost):
+            def upload(self, data, remotepath, user='root', compress=False):
+                time.sleep(self.status)
+                sizes.append(len(data[:]))
+                return remote.TransferResult(self.host, 10, 1.0, None)
+
+        self.group.parallel = 2
+        self.group.hosts = [ SlowHost('host1', 0), SlowHost('host2', 0.2) ]
+
+        localpath = tempfile.mkstemp()[1]
+        open(localpath, 'w').write('0123456789')
+
+        # Uploads still running when the caller stops iterating complete
+        # before the file is unmapped
+        results = self.group.put(localpath, '/tmp/file')
+        results.next()
+        results.close()
+        unlink(localpath)
+
+        self.assertEquals([ 10, 10 ], sizes)
+
+    def test_map_file(self):
+        localpath = tempfile.mkstemp()[1]
+        self.assertEquals('', remote.map_file(localpath))
+
+        open(localpath, 'w').write('0123456789')
+        data = remote.map_file(localpath)
+        unlink(localpath)
+
+        self.assertEquals('234', data[2:5])
+        data.close()
+
+    def test_put_unmaps(self):
+        uploaded = []
+
+        class Host(remote.RemoteHost):
+            def upload(self, data, remotepath, user='root', compress=False):
+                uploaded.append(data)
+                return remote.TransferResult(self.host, len(data), 1.0, None)
+
+        localpath = tempfile.mkstemp()[1]
+        open(localpath, 'w').write('0123456789')
+
+        result = Host('host1', 'key').put(localpath, '/tmp/file')
+        unlink(localpath)
+
+        self.assertEquals(10, result.size)
+        self.assertRaises(ValueError, uploaded[0].__getitem__, 0)
+
+    def test_run_error(self):
+        host = remote.RemoteHost('127.0.0.1', 'key', FakeConnectionPool())
+        result = host.run('uptime')
+        self.failIf(result.ok)
+        self.failUnless(result.error is not None)
+
+class FakeChannel(object):
+    """Paramiko channel stand-in, with all output already available"""
+
+    def __init__(self, stdout, stderr, status):
+        self.stdout = list(stdout)
+        self.stderr = list(stderr)
+        self.status = status
+        self.closed = False
+
+    def recv_ready(self):
+        return bool(self.stdout)
+
+    def recv(self, size):
+        return self.stdout.pop(0)
+
+    def recv_stderr_ready(self):
+        return bool(self.stderr)
+
+    def recv_stderr(self, size):
+        return self.stderr.pop(0)
+
+    def exit_status_ready(self):
+        return True
+
+    def recv_exit_status(self):
+        return self.status
+
+    def close(self):
+        self.closed = True
+
+class CommandStreamTest(unittest.TestCase):
+
+    def test_iter(self):
+        channel = FakeChannel([ 'a', 'b' ], [ 'err' ], 3)
+        stream = remote.CommandStream(channel)
+
+        self.assertEquals([ ('stdout', 'a'), ('stdout', 'b'), 
+                            ('stderr', 'err') ], list(stream))
+        self.assertEquals(3, stream.status)
+        self.failUnless(channel.closed)
+
+    def test_output_with_exit_status(self):
+        class LateChannel(FakeChannel):
+            """Output and exit status arriving at the same time, after
+            the command stream checked for output."""
+
+            def __init__(self):
+                FakeChannel.__init__(self, [], [], 0)
+                self.pending = True
+
+            def exit_status_ready(self):
+                if self.pending:
+                    self.stdout, self.stderr = [ 'root\n' ], [ 'err' ]
+                    self.pending = False
+
+                return True
+
+        stream = remote.CommandStream(LateChannel())
+        self.assertEquals([ ('stdout', 'root\n'), ('stderr', 'err') ], 
+            list(stream))
+        self.assertEquals(0, stream.status)
+
+    def test_lines(self):
+        closed = []
+        channel = FakeChannel([ 'one\ntw', 'o\nthree' ], [ 'err\n' ], 0)
+        stream = remote.CommandStream(channel, 
+            on_close=lambda: closed.append(True))
+
+        self.assertEquals([ ('stdout', 'one\n'), ('stdout', 'two\n'),
+                            ('stderr', 'err\n'), ('stdout', 'three') ],
+                          list(stream.lines()))
+        self.assertEquals([ True ], closed)
+
+    def test_deadline(self):
+        class EndlessChannel(FakeChannel):
+            def recv_ready(self):
+                return True
+
+            def recv(self, size):
+                return 'y\n'
+
+        channel = EndlessChannel([], [], None)
+        stream = remote.CommandStream(channel, timeout=1, deadline=0.1)
+
+        # Output keeps coming: only the deadline stops the command
+        self.assertRaises(socket.timeout, list, stream)
+        self.failUnless(channel.closed)
+
+class SSHProberTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = socket.socket()
+        self.server.bind(('127.0.0.1', 0))
+        self.server.listen(1)
+        self.port = self.server.getsockname()[1]
+
+    def tearDown(self):
+        self.server.close()
+
+    def test_probe_banner(self):
+        def accept():
+            conn, _ = self.server.accept()
+            conn.sendall('SSH-2.0-OpenSSH_6.0p1\r\n')
+            conn.close()
+
+        thread = threading.Thread(target=accept)
+        thread.start()
+
+        prober = remote.SSHProber([ '127.0.0.1' ], self.port)
+        self.assertEquals(set([ '127.0.0.1' ]), prober.probe(timeout=5))
+        self.assertEquals(set(), prober.pending)
+        thread.join()
+
+    def test_probe_no_banner(self):
+        # The connection is accepted by the kernel, but no banner is sent
+        prober = remote.SSHProber([ '127.0.0.1' ], self.port)
+        self.assertEquals(set(), prober.probe(timeout=0.1))
+
+    def test_probe_closed_port(self):
+        self.server.close()
+
+        ready = remote.wait_for_banners([ '127.0.0.1' ], 0.1, self.port)
+        self.assertEquals(set(), ready)
+
+class DaemonTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = join(self.tmpdir, 'nubo.sock')
+
+        self.started = threading.Event()
+        self.proceed = threading.Event()
+
+        def run(argv, cwd):
+            if argv[0] == 'fail':
+                raise Exception, 'boom'
+
+            if argv[0] == 'pwd':
+                print cwd
+                return
+
+            if argv[0] == 'wait':
+                self.started.set()
+                if not self.proceed.wait(5):
+                    raise Exception, 'commands are not run concurrently'
+            elif argv[0] == 'go':
+                self.proceed.set()
+
+            print getenv('NUBO_CLOUD'), ' '.join(argv)
+            sys.exit(len(argv))
+
+        thread = threading.Thread(target=daemon.serve, args=(run, self.path))
+        thread.daemon = True
+        thread.start()
+
+        while not daemon.running(self.path):
+            time.sleep(0.01)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def forward(self, argv):
+        stdout, stderr = StringIO(), StringIO()
+        status = daemon.forward(argv, self.path, stdout, stderr)
+        return status, stdout.getvalue(), stderr.getvalue()
+
+    def test_forward(self):
+        os.environ['NUBO_CLOUD'] = 'DUMMY'
+        try:
+            self.assertEquals((2, 'DUMMY list --all\n', ''),
+                self.forward([ 'list', '--all' ]))
+        finally:
+            del os.environ['NUBO_CLOUD']
+
+        self.assertEquals((1, 'None sizes\n', ''), self.forward([ 'sizes' ]))
+
+        status, stdout, stderr = self.forward([ 'fail' ])
+        self.assertEquals(1, status)
+        self.failUnless('Exception: boom' in stderr)
+
+        self.assertEquals((0, os.getcwd() + '\n', ''), self.forward([ 'pwd' ]))
+
+    def test_concurrent(self):
+        results = []
+
+        def forward():
+            results.append(self.forward([ 'wait' ]))
+
+        os.environ['NUBO_CLOUD'] = 'EC2_EU_WEST'
+        try:
+            waiting = threading.Thread(target=forward)
+            waiting.start()
+            self.failUnless(self.started.wait(5))
+
+            # Run while the first command is still running, with its own
+            # environment
+            os.environ['NUBO_CLOUD'] = 'DUMMY'
+            self.assertEquals((1, 'DUMMY go\n', ''), self.forward([ 'go' ]))
+        finally:
+            del os.environ['NUBO_CLOUD']
+
+        waiting.join(5)
+        self.assertEquals([ (1, 'EC2_EU_WEST wait\n', '') ], results)
+
+    def test_not_running(self):
+        missing = join(self.tmpdir, 'missing.sock')
+        self.failIf(daemon.running(missing))
+        self.assertEquals(None, daemon.forward([ 'list' ], missing))
+
+        self.assertRaises(Exception, daemon.serve, None, self.path)
+
+class CatalogCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache = cache.CatalogCache('DUMMY', ttl=60, 
+            directory=self.directory)
+        self.calls = 0
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def fetch(self):
+        self.calls += 1
+        return [ self.calls ]
+
+    def test_get(self):
+        self.assertEquals([ 1 ], self.cache.get('images', self.fetch))
+        self.assertEquals([ 1 ], self.cache.get('images', self.fetch))
+        self.assertEquals(1, self.calls)
+
+    def test_get_refresh(self):
+        self.cache.get('images', self.fetch)
+        self.assertEquals([ 2 ], self.cache.get('images', self.fetch, True))
+
+    def test_get_account(self):
+        accounts = [ prerequisites.account('DUMMY', { 'key': key })
+            for key in 'first', 'second' ]
+
+        first, second = [ cache.CatalogCache('DUMMY', account,
+            directory=self.directory) for account in accounts ]
+
+        # Accounts of the same cloud do not share their catalogs
+        self.assertEquals([ 1 ], first.get('images', self.fetch))
+        self.assertEquals([ 2 ], second.get('images', self.fetch))
+        self.assertEquals([ 1 ], first.get('images', self.fetch))
+
+    def test_get_stale(self):
+        self.cache.store('images', [ 'stale' ])
+        self.cache.ttl = -1
+
+        self.assertEquals([ 'stale' ], self.cache.get('images', self.fetch))
+
+        # Refreshed in the background
+        for _ in range(100):
+            if self.cache.load('images')[1] != [ 'stale' ]:
+                break
+            time.sleep(0.01)
+
+        self.assertEquals([ 1 ], self.cache.load('images')[1])
+
+    def test_get_stale_does_not_block_exit(self):
+        self.cache.store('images', [ 'stale' ])
+        self.cache.ttl = -1
+
+        done = threading.Event()
+        self.cache.get('images', lambda: done.wait(5) or [])
+
+        refresh = [ thread for thread in threading.enumerate()
+            if thread.name == 'refresh-images' ]
+        done.set()
+        refresh[0].join()
+
+        self.failUnless(refresh[0].daemon)
+
+    def test_get_expired(self):
+        self.cache.store('images', [ 'expired' ])
+        self.cache.ttl = self.cache.max_stale = -1
+
+        self.assertEquals([ 1 ], self.cache.get('images', self.fetch))
+
+    def test_get_concurrently(self):
+        def fetch():
+            time.sleep(0.1)
+            return self.fetch()
+
+        # Concurrent deployments wait for the first one fetching sizes
+        results = parallel.parallel_map(lambda _: 
+            self.cache.get('sizes', fetch), range(5))
+
+        self.assertEquals([ [ 1 ] ] * 5, results)
+        self.assertEquals(1, self.calls)
+
+    def test_load_corrupted(self):
+        self.cache.store('images', [])
+        open(self.cache.path('images'), 'w').write('garbage')
+        self.assertEquals(None, self.cache.load('images'))
+
+class PrerequisiteCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.prerequisites = prerequisites.PrerequisiteCache('DUMMY',
+            prerequisites.account('DUMMY', { 'key': 'secret' }, 'abcd'),
+            self.tmpdir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_account(self):
+        self.failIf('secret' in self.prerequisites.account)
+        self.failIf(self.prerequisites.account == prerequisites.account(
+            'DUMMY', { 'key': 'secret' }, 'efgh'))
+
+    def test_get_once(self):
+        resolved = []
+
+        def resolve():
+            # Racing callers wait for this one
+            time.sleep(0.1)
+            resolved.append(True)
+            return 'key-id'
+
+        results = parallel.parallel_map(lambda _: 
+            self.prerequisites.get('ssh_key', resolve), range(5))
+
+        self.assertEquals([ 'key-id' ] * 5, results)
+        self.assertEquals(1, len(resolved))
+
+        # Results are stored on disk, available to other processes too
+        other = prerequisites.PrerequisiteCache('DUMMY',
+            self.prerequisites.account, self.tmpdir)
+        self.assertEquals('key-id', other.get('ssh_key', None))
+
+    def test_invalidate(self):
+        self.assertEquals(None, self.prerequisites.get('ssh_key',
+            lambda: None))
+
+        self.prerequisites.get('ssh_key', lambda: 'key-1')
+        self.prerequisites.get('security_group', lambda: 'nubo')
+
+        self.prerequisites.invalidate('ssh_key')
+        self.assertEquals(None, self.prerequisites.load('ssh_key'))
+        self.assertEquals('nubo', self.prerequisites.load('security_group'))
+
+        self.prerequisites.invalidate()
+        self.assertEquals(None, self.prerequisites.load('security_group'))
+
+    def test_missing(self):
+        self.assertEquals('security_group', prerequisites.missing(Exception(
+            "InvalidGroup.NotFound: The security group 'nubo' does not "
+            "exist")))
+        self.assertEquals('keypair', prerequisites.missing(Exception(
+            "InvalidKeyPair.NotFound: The key pair 'nubo' does not exist")))
+        self.assertEquals(None, prerequisites.missing(Exception(
+            "RequestLimitExceeded: Request limit exceeded.")))
+
+        # Resources other than prerequisites
+        self.assertEquals(None, prerequisites.missing(Exception(
+            "InvalidAMIID.NotFound: The image id '[ami-1]' does not exist")))
+        self.assertEquals(None, prerequisites.missing(Exception(
+            "Not Found")))
+
+class ImageIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.index = index.ImageIndex()
+        self.index.update([ ('1601', 'CentOS 5.8 x64'),
+                            ('1611', 'CentOS 6.2 x64'),
+                            ('2676', 'Ubuntu 12.04 x64 Server'),
+                            ('1609', 'Ubuntu 11.10 x32 Server'),
+                            ('12573', 'Debian 6.0 x64') ])
+
+    def ids(self, query, limit=None):
+        return [ image_id for image_id, _ in self.index.search(query, limit) ]
+
+    def test_tokenize(self):
+        self.assertEquals([ 'ubuntu', 'precise', '12', '04' ], 
+            index.tokenize('Ubuntu-precise-12.04'))
+
+    def test_search_ranked_by_recency(self):
+        self.assertEquals([ '1611', '1601' ], self.ids('centos'))
+        self.assertEquals([ '1611' ], self.ids('centos', limit=1))
+
+    def test_search_multiple_terms(self):
+        self.assertEquals([ '2676', '1611', '12573', '1601' ], 
+            self.ids('x64'))
+        self.assertEquals([ '12573' ], self.ids('debian x64'))
+        self.assertEquals([], self.ids('debian x32'))
+
+    def test_search_prefix(self):
+        self.assertEquals([ '2676', '1609' ], self.ids('ubu'))
+
+        self.assertEquals([ '1611' ], self.ids('6 cent'))
+
+        # Exact matches come first
+        self.assertEquals([ '2676', '12573' ], self.ids('12'))
+
+    def test_search_by_id(self):
+        self.assertEquals([ '2676' ], self.ids('2676'))
+
+    def test_update(self):
+        changed = self.index.update([ ('1601', 'CentOS 5.8 x64'),
+                                      ('1602', 'CentOS 5.8 x32') ])
+        self.failUnless(changed)
+        self.assertEquals([ '1601', '1602' ], self.ids('centos'))
+        self.assertEquals([], self.ids('ubuntu'))
+        self.failIf('ubuntu' in self.index.tokens)
+
+class HistoryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkstemp()[1]
+
+    def tearDown(self):
+        unlink(self.path)
+
+    def launch(self, phases, provider='EC2_EU_WEST', size='m1.small', 
+               error=None):
+        return { 'provider': provider, 'image': 'ami-27013f53', 
+                 'size': size, 'location': None, 'phases': phases,
+                 'started_at': time.time() - 60, 'error': error }
+
+    def test_entry(self):
+        entry = history.entry(self.launch({ 'prerequisites': 5,
+            'create': 1, 'running': 30, 'ssh': 10 }))
+        self.assertEquals((31, 41), (entry['running'], entry['ssh']))
+
+        # libcloud's deploy_node waits for both
+        entry = history.entry(self.launch({ 'deploy_node': 60 }))
+        self.assertEquals((None, 60), (entry['running'], entry['ssh']))
+
+        # Nodes not waited for
+        self.assertEquals(None, history.entry(self.launch({ 'create': 1 })))
+
+        # Failures to create them
+        entry = history.entry(self.launch({ 'create': 1 }, error='boom'))
+        self.assertEquals((None, None, 'boom'), 
+            (entry['running'], entry['ssh'], entry['error']))
+
+        # Deployments are recorded with the time they started
+        self.failUnless(entry['time'] < time.time() - 59)
+
+    def test_record(self):
+        history.record(self.launch({ 'create': 1, 'running': 30 }), 
+            self.path)
+        open(self.path, 'a').write('garbage\n')
+        history.record(self.launch({ 'deploy_node': 60 }), self.path)
+
+        entries = history.read(self.path)
+        self.assertEquals([ 31, None ], 
+            [ entry['running'] for entry in entries ])
+
+        # Time window: deployments started a minute ago
+        now = time.time()
+        self.assertEquals(2, len(history.read(self.path, since=now - 120)))
+        self.assertEquals(0, len(history.read(self.path, since=now - 30)))
+        self.assertEquals(0, len(history.read(self.path, until=now - 120)))
+
+        self.assertEquals([], history.read(self.path + '.missing'))
+
+    def test_summarize(self):
+        entries = [ history.entry(self.launch({ 'running': idx, 'ssh': 1 }))
+            for idx in range(1, 101) ]
+        entries.append(history.entry(self.launch({ 'running': 1000 }, 
+            error='boom')))
+        entries.append(history.entry(self.launch({ 'running': 1 }, 
+            size='m1.large')))
+
+        summary = history.summarize(entries)
+        self.assertEquals([ 'm1.large', 'm1.small' ], 
+            [ row['size'] for row in summary ])
+
+        row = summary[1]
+        self.assertEquals((101, 1), (row['launches'], row['failed']))
+        self.assertEquals([ 50, 90, 99 ], row['running'].values())
+        self.assertEquals([ 51, 91, 100 ], row['ssh'].values())
+
+        self.assertEquals([ None ] * 3, summary[0]['ssh'].values())
+
+    def test_percentile(self):
+        self.assertEquals(None, history.percentile([], 50))
+        self.assertEquals(3, history.percentile([ 3 ], 99))
+        self.assertEquals(2, history.percentile([ 3, 1, 2, 4 ], 50))
+
+    def test_parse_duration(self):
+        self.assertEquals(90, history.parse_duration('90'))
+        self.assertEquals(1800, history.parse_duration('30m'))
+        self.assertEquals(7 * 86400, history.parse_duration('7d'))
+        self.assertRaises(ValueError, history.parse_duration, '7 days')
+
+class NodePollerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.calls = 0
+
+    def list_nodes(self):
+        self.calls += 1
+        state = self.calls >= 3 and 'RUNNING' or 'PENDING'
+        return [ { 'id': '1', 'state': state },
+                 { 'id': '2', 'state': state },
+                 { 'id': '3', 'state': 'TERMINATED' } ]
+
+    def test_wait(self):
+        node_poller = poller.NodePoller(self.list_nodes, interval=0.01)
+        node = node_poller.wait('1', 10)
+        self.assertEquals('RUNNING', node['state'])
+        self.assertEquals(3, self.calls)
+
+    def test_wait_terminated(self):
+        node_poller = poller.NodePoller(self.list_nodes, interval=0.01)
+        self.assertEquals(None, node_poller.wait('3', 10))
+        self.assertEquals(1, self.calls)
+
+    def test_wait_timeout(self):
+        node_poller = poller.NodePoller(self.list_nodes, interval=0.01)
+
+        start = time.time()
+        self.assertEquals(None, node_poller.wait('42', 0.2))
+        self.failUnless(0.2 <= time.time() - start < 0.5)
+
+        # Backing off from 0.01 seconds
+        self.failUnless(3 <= self.calls < 20)
+
+    def test_wait_throttled(self):
+        def list_nodes():
+            if not self.calls:
+                self.calls += 1
+                raise Exception("RequestLimitExceeded: Request limit exceeded.")
+
+            return self.list_nodes()
+
+        node_poller = poller.NodePoller(list_nodes, interval=0.01)
+        self.assertEquals('RUNNING', node_poller.wait('1', 5)['state'])
+        self.assertEquals(0, node_poller.throttled)
+
+        def fail():
+            raise Exception('boom')
+
+        node_poller = poller.NodePoller(fail, interval=0.01)
+        self.assertRaises(Exception, node_poller.wait, '1', 5)
+
+    def test_shared_polls(self):
+        node_poller = poller.NodePoller(self.list_nodes, interval=0.05)
+        nodes = parallel.parallel_map(lambda node_id: 
+            node_poller.wait(node_id, 10), [ '1', '2' ], 2)
+
+        self.assertEquals([ 'RUNNING', 'RUNNING' ], 
+            [ node['state'] for node in nodes ])
+
+        # Waiting on one node takes 3 calls, waiting on two without sharing
+        # would take 6
+        self.failUnless(self.calls < 6)
+
+class BackoffTest(unittest.TestCase):
+
+    def delays(self, backoff, count):
+        return [ backoff.delay() for _ in range(count) ]
+
+    def test_delay(self):
+        backoff = poller.Backoff(interval=1, max_interval=5, factor=2,
+            jitter=0)
+        self.assertEquals([ 1, 2, 4, 5, 5 ], self.delays(backoff, 5))
+
+    def test_expected(self):
+        # Halving the time left until the expected time
+        backoff = poller.Backoff(expected=60, interval=1, max_interval=100,
+            jitter=0)
+        self.assertAlmostEquals(30, backoff.delay(), 1)
+
+        # Not beyond the maximum interval
+        backoff = poller.Backoff(expected=60, interval=1, max_interval=10,
+            jitter=0)
+        self.assertEquals(10, backoff.delay())
+
+        # Then checking every second
+        backoff.start -= 60
+        self.assertEquals(1, backoff.delay())
+
+    def test_jitter(self):
+        backoff = poller.Backoff(interval=1, factor=1, jitter=0.5)
+        delays = self.delays(backoff, 100)
+
+        self.failUnless(all(0.5 <= delay <= 1 for delay in delays))
+        self.failUnless(len(set(delays)) > 1)
+
+    def test_sleep(self):
+        backoff = poller.Backoff(interval=10, factor=1, jitter=0)
+
+        # Never past the deadline
+        start = time.time()
+        backoff.sleep(events.monotonic() + 0.05)
+        self.failUnless(time.time() - start < 1)
+
+        # Counting the time elapsed since the last check
+        start = time.time()
+        backoff.sleep(events.monotonic() + 20, 
+            since=events.monotonic() - 10)
+        self.failUnless(time.time() - start < 1)
+
+class KeepAliveTest(unittest.TestCase):
+
+    def test_keep_alive(self):
+        connects = []
+
+        class Connection(object):
+            connection = None
+
+            def connect(self, host=None, port=None, base_url=None):
+                connects.append(host)
+                self.connection = object()
+
+        class Driver(object):
+            connection = Connection()
+
+        driver = drivers.keep_alive(Driver(), timeout=0.2)
+        for _ in range(3):
+            driver.connection.connect()
+
+        self.assertEquals([ None ], connects)
+
+        # Explicit hosts and idle connections lead to new connections
+        driver.connection.connect('example.org')
+        time.sleep(0.3)
+        driver.connection.connect()
+        self.assertEquals([ None, 'example.org', None ], connects)
+
+    def test_keep_alive_dropped(self):
+        connects = []
+        closed = set()
+
+        class Connection(object):
+            connection = None
+
+            def connect(self, host=None, port=None, base_url=None):
+                connects.append(host)
+                self.connection = object()
+
+            def request(self, action):
+                self.connect()
+                if self.connection in closed:
+                    raise httplib.BadStatusLine("''")
+                return action
+
+        class Driver(object):
+            def __init__(self):
+                self.connection = Connection()
+
+        driver = drivers.keep_alive(Driver())
+        self.assertEquals('/nodes', driver.connection.request('/nodes'))
+
+        # The server closes the idle connection: the request is retried
+        # once on a new connection
+        closed.add(driver.connection.connection)
+        self.assertEquals('/images', driver.connection.request('/images'))
+        self.assertEquals([ None, None ], connects)
+
+        # Failures on new connections are not retried
+        class Refused(Connection):
+            def request(self, action):
+                self.connect()
+                raise socket.error(111, 'Connection refused')
+
+        driver = Driver()
+        driver.connection = Refused()
+        driver = drivers.keep_alive(driver)
+        self.assertRaises(socket.error, driver.connection.request, '/sizes')
+        self.assertEquals([ None, None, None ], connects)
+
+class MetricsTest(unittest.TestCase):
+
+    def test_histogram(self):
+        histogram = metrics.Histogram(( 0.1, 1 ))
+        for seconds in 0.05, 0.1, 0.5, 2:
+            histogram.observe(seconds)
+
+        self.assertEquals([ (0.1, 2), (1, 3), ('+Inf', 4) ],
+            histogram.cumulative())
+        self.assertEquals(4, histogram.count)
+
+    def test_throttled(self):
+        registry = metrics.DriverMetrics()
+
+        class Driver(object):
+            def list_nodes(self):
+                raise Exception('RequestLimitExceeded: Request limit exceeded.')
+
+        driver = metrics.InstrumentedDriver(Driver(), 'EC2_EU_WEST', registry)
+        self.assertRaises(Exception, driver.list_nodes)
+
+        self.assertEquals(1, registry.count(outcome=metrics.THROTTLED))
+        self.failIf(metrics.is_throttled(Exception('Invalid credentials')))
+
+class FutureTest(unittest.TestCase):
+
+    def test_result(self):
+        future = aio.Future()
+        self.assertRaises(aio.TimeoutError, future.result, 0.01)
+
+        future.set_result(42)
+        self.assertEquals(42, future.result())
+
+        # Completed futures stay as they are
+        self.failIf(future.set_result(43))
+        self.failIf(future.cancel())
+        self.assertEquals(42, future.result())
+
+    def test_exception(self):
+        with aio.Executor(2) as executor:
+            future = executor.submit(int, 'forty-two')
+
+        self.assertRaises(ValueError, future.result, 5)
+        self.assertEquals(ValueError, type(future.exception()))
+
+    def test_shutdown(self):
+        executor = aio.Executor(2)
+        futures = [ executor.submit(time.sleep, 0.05) for _ in range(3) ]
+        workers = executor.pool._pool
+
+        # Submitted calls complete before the threads terminate
+        executor.shutdown()
+        self.failUnless(all(future.done() for future in futures))
+        self.failIf(any(worker.is_alive() for worker in workers))
+        self.assertRaises(RuntimeError, executor.submit, int, '42')
+
+    def test_then(self):
+        executor = aio.Executor(2)
+
+        future = aio.then(executor.submit(len, 'abc'), 
+            lambda length: executor.submit(range, length))
+        self.assertEquals([ 0, 1, 2 ], future.result(5))
+
+        future = aio.then(executor.submit(int, 'x'), lambda value: value)
+        self.assertRaises(ValueError, future.result, 5)
+
+    def test_cancel(self):
+        source = aio.Future()
+        future = aio.then(source, lambda value: value)
+
+        self.failUnless(future.cancel())
+        self.failUnless(source.cancelled())
+        self.assertRaises(aio.CancelledError, future.result)
+
+    def test_cancel_while_starting(self):
+        future = aio.Future()
+
+        class Condition(type(future.cond)):
+            # The operation starts right before cancel gets the lock
+            def __enter__(self):
+                result = super(Condition, self).__enter__()
+                future.state = aio.RUNNING
+                return result
+
+        future.cond = Condition()
+        self.failIf(future.cancel())
+        self.failIf(future.cancelled())
+
+        future.cond = threading.Condition()
+
+        future.set_result(42)
+        self.assertEquals(42, future.result())
+
+    def test_as_completed(self):
+        watcher = aio.Watcher()
+        slow, fast = watcher.sleep(0.2), watcher.sleep(0.01)
+
+        self.assertEquals([ fast, slow ], 
+            list(aio.as_completed([ slow, fast ], timeout=5)))
+
+        self.assertRaises(aio.TimeoutError, list, 
+            aio.as_completed([ aio.Future() ], timeout=0.01))
+
+class WatcherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.calls = 0
+        self.watcher = aio.Watcher(0.01)
+
+    def list_nodes(self):
+        self.calls += 1
+        state = self.calls >= 3 and 'RUNNING' or 'PENDING'
+        return [ { 'id': str(idx), 'state': state } for idx in range(100) ]
+
+    def test_wait_for_nodes(self):
+        node_poller = poller.NodePoller(self.list_nodes, 0.01)
+        futures = [ self.watcher.wait_for_node(node_poller, str(idx), 10)
+            for idx in range(100) ]
+
+        for future in futures:
+            self.assertEquals('RUNNING', future.result(5)['state'])
+
+        # All waits are served by the same calls
+        self.assertEquals(3, self.calls)
+
+    def test_wait_for_node_timeout(self):
+        node_poller = poller.NodePoller(self.list_nodes, 0.01)
+        future = self.watcher.wait_for_node(node_poller, '420', 0.2)
+        self.assertEquals(None, future.result(5))
+
+        # Backing off from 0.01 seconds
+        self.failUnless(3 <= self.calls < 20)
+
+    def test_wait_for_banner(self):
+        server = socket.socket()
+        server.bind(('127.0.0.1', 0))
+        server.listen(1)
+        port = server.getsockname()[1]
+
+        def accept():
+            conn, _ = server.accept()
+            conn.sendall('SSH-2.0-OpenSSH_6.0p1\r\n')
+            conn.close()
+
+        thread = threading.Thread(target=accept)
+        thread.start()
+
+        try:
+            future = self.watcher.wait_for_banner('127.0.0.1', 5, port)
+            self.assertEquals('127.0.0.1', future.result(5))
+            thread.join()
+        finally:
+            server.close()
+
+        future = self.watcher.wait_for_banner('127.0.0.1', 0.05, port)
+        self.assertRaises(aio.TimeoutError, future.result, 5)
+
+class StandbyCloud(object):
+    """Cloud deploying nodes instantly, for StandbyPool"""
+    PROVIDER_NAME = 'DUMMY'
+
+    def __init__(self, ssh_key_name='abcd', login_as='root'):
+        self.ssh_key_name = ssh_key_name
+        self.login_as = login_as
+
+        self.nodes = {}
+        self.deployed = 0
+        self.reachable = True
+
+    def deploy_many(self, image_id, count, name_template, size_idx=0,
+                    parallel=None):
+        results = []
+        for idx in range(count):
+            self.deployed += 1
+            node = Node(str(self.deployed), name_template % (idx + 1), 0,
+                [ '127.0.0.1' ], [], None)
+            self.nodes[node.id] = node
+
+            results.append({ 'name': node.name, 'node': base.node2dict(node),
+                             'error': None })
+
+        return results
+
+    def get_size(self, size_idx):
+        class Size:
+            id = [ 'small', 'large' ][size_idx]
+
+        return Size
+
+    def find_nodes(self, targets=(), name_glob=None):
+        return [ base.NodeRecord(node) for node in self.nodes.values()
+            if base.node_matches(node.id, node.name, targets, name_glob) ]
+
+    def shutdown_many(self, node_ids):
+        return [ { 'id': node_id, 'name': self.nodes.pop(node_id).name,
+                   'ok': True, 'error': None } for node_id in node_ids ]
+
+    def remote_host(self, node):
+        class RemoteHost:
+            ssh_ready = lambda _, timeout: self.reachable
+
+        return RemoteHost()
+
+class StandbyPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = join(self.tmpdir, 'standby')
+        self.cloud = StandbyCloud()
+        self.pool = standby.StandbyPool(self.cloud, 'image', 1, self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_fill_and_take(self):
+        self.pool.configure(target=2)
+        self.assertEquals(2, len(self.pool.fill()))
+        self.assertEquals([], self.pool.fill())
+        self.assertEquals(2, len(self.pool.status()['ready']))
+
+        taken = [ self.pool.take()['id'] for _ in range(2) ]
+        self.assertEquals([ '1', '2' ], taken)
+        self.assertEquals(None, self.pool.take())
+
+        # Taken nodes are not adopted back, even though they are still up
+        self.assertEquals(2, len(self.pool.fill()))
+        self.assertEquals([ '3', '4' ], [ node['id'] for node in
+            self.pool.status()['ready'] ])
+
+        [ pool ] = standby.pools(self.path)
+        self.assertEquals(('DUMMY', 'image', 'large', 2), (pool['provider'],
+            pool['image'], pool['size'], pool['target']))
+
+    def test_key(self):
+        # Nodes are only handed out to those able to log into them
+        for cloud in StandbyCloud('efgh'), StandbyCloud(login_as='ubuntu'):
+            other = standby.StandbyPool(cloud, 'image', 1, self.path)
+            self.failIf(other.key == self.pool.key)
+            self.failIf(other.prefix == self.pool.prefix)
+
+        self.pool.configure(target=1)
+        self.pool.fill()
+
+        cloud = StandbyCloud(login_as='ubuntu')
+        cloud.nodes = self.cloud.nodes
+        other = standby.StandbyPool(cloud, 'image', 1, self.path)
+        self.assertEquals(None, other.take())
+
+        other.reconcile()
+        self.assertEquals([], other.status()['ready'])
+
+    def test_take_concurrently(self):
+        self.pool.configure(target=5)
+        self.pool.fill()
+
+        taken = parallel.parallel_map(lambda _: self.pool.take(), range(10))
+        nodes = [ node['id'] for node in taken if node is not None ]
+        self.assertEquals(5, len(set(nodes)))
+        self.assertEquals(5, taken.count(None))
+
+    def test_retire(self):
+        self.pool.configure(target=2)
+        self.pool.fill()
+
+        # Unreachable nodes are not handed out
+        self.cloud.reachable = False
+        self.assertEquals(None, self.pool.take())
+        self.assertEquals({}, self.cloud.nodes)
+
+        # Neither are nodes older than max_age
+        self.cloud.reachable = True
+        self.pool.fill()
+        self.pool.configure(max_age=-1)
+        self.assertEquals(None, self.pool.take())
+        self.assertEquals({}, self.cloud.nodes)
+
+    def test_reconcile(self):
+        self.pool.configure(target=2)
+        self.pool.fill()
+
+        # Nodes are found again if the state is lost, and forgotten if gone
+        unlink(self.path)
+        del self.cloud.nodes['1']
+
+        self.pool.reconcile()
+        self.assertEquals([ '2' ], [ node['id'] for node in
+            self.pool.status()['ready'] ])
+
+        self.assertEquals([ '2' ], [ node['id']
+            for node in self.pool.drain() ])
+        self.assertEquals([], standby.pools(self.path))
+
+class StartupTest(unittest.TestCase):
+
+    def test_no_heavy_imports(self):
+        # Commands not talking to cloud providers should start fast
+        for args in [], [ 'clouds' ]:
+            self.assertEquals([], startup.measure(args)['heavy_modules'])
+
+class HotPathsTest(unittest.TestCase):
+
+    def test_run(self):
+        results = hotpaths.run(3, api_latency=0, boot_latency=0.1,
+            ssh_latency=0.1, poll_interval=0.05, parallel=3)
+
+        self.assertEquals(0, results['deploy']['errors'])
+        self.assertEquals(3, results['deploy']['api_calls']['create_node'])
+
+        self.assertEquals(1, results['list_nodes']['api_calls']['list_nodes'])
+
+        # Connections are reused once open
+        self.assertEquals(3, results['exec_cold']['ssh_handshakes'])
+        self.assertEquals(0, results['exec_warm']['ssh_handshakes'])
+        self.assertEquals(3, results['exec_warm']['ssh_commands'])
+
 if __name__ == "__main__":
     unittest.main()